@@ -20,7 +20,7 @@ class LSTMCell(nn.Module):
         self.r = r
 
         # Replace W_ih with structured matrices
-        self.W_ih = sl.StructuredLinear(class_type, layer_size=4*hidden_size, r=r, bias=False)
+        self.W_ih = sl.StructuredLinear(class_type, layer_size=input_size, hidden_size=4*hidden_size, r=r, bias=False)
 
         self.W_hh = nn.Parameter(
             torch.FloatTensor(hidden_size, 4 * hidden_size))
@@ -44,9 +44,7 @@ class LSTMCell(nn.Module):
         bias_batch = (self.bias.unsqueeze(0)
                       .expand(batch_size, *self.bias.size()))
         wh_b = torch.addmm(bias_batch, h_0, self.W_hh)
-        z = torch.zeros(input_.size(0),3*self.hidden_size).cuda()
-        input_padded = torch.cat((input_, z), dim=1)
-        wi = self.W_ih(input_padded)
+        wi = self.W_ih(input_)
 
         f, i, o, g = torch.split(wh_b + wi,
                                  split_size_or_sections=self.hidden_size, dim=1)
@@ -21,9 +21,9 @@ def set_masks(net, prune_factor, device):
         mask = generate_mask(layer, prune_factor)
         layer.set_mask(mask, device)
 
-def prune(dataset, net, optimizer, lr_scheduler, epochs, log_freq, log_path, checkpoint_path, result_path, test, save, prune_lr_decay, prune_factor, prune_iters):
+def prune(dataset, net, optimizer, lr_scheduler, epochs, log_freq, log_path, checkpoint_path, result_path, test, save, prune_lr_decay, prune_factor, prune_iters, precision='fp32'):
     # Initial training
-    train.train(dataset, net, optimizer, lr_scheduler, epochs, log_freq, log_path, checkpoint_path, result_path, 0, save)
+    train.train(dataset, net, optimizer, lr_scheduler, epochs, log_freq, log_path, checkpoint_path, result_path, 0, save, precision=precision)
 
     for i in range(prune_iters):
         set_masks(net, prune_factor, device)
@@ -33,4 +33,4 @@ def prune(dataset, net, optimizer, lr_scheduler, epochs, log_freq, log_path, che
             param_group['lr'] = prune_lr_decay*param_group['lr']
 
         # Retrain
-        train.train(dataset, net, optimizer, lr_scheduler, epochs, log_freq, log_path, checkpoint_path, result_path, test, save, (i+1)*epochs)
+        train.train(dataset, net, optimizer, lr_scheduler, epochs, log_freq, log_path, checkpoint_path, result_path, test, save, (i+1)*epochs, precision)
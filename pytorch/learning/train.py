@@ -1,5 +1,6 @@
 import numpy as np
 import os, time, logging
+import contextlib
 import pickle as pkl
 import torch
 import torch.optim as optim
@@ -8,7 +9,28 @@ from tensorboardX import SummaryWriter
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-def test_split(net, dataloader, loss_fn):
+precisions = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+def autocast(precision):
+    """
+    Context manager running the forward pass in mixed precision: 'fp32' (disabled), 'bf16' or 'fp16'.
+    Parameters stay in fp32; the structured multiplies run their FFTs and sums in fp32.
+    """
+    dtype = precisions[precision]
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device.type, dtype=dtype)
+
+def grad_scaler(precision):
+    """
+    Loss scaling, to keep small fp16 gradients from underflowing (only needed, and only enabled, for fp16 on GPU).
+    """
+    enabled = precision == 'fp16' and device.type == 'cuda'
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):  # Pytorch >= 2.3
+        return torch.amp.GradScaler(device.type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+def test_split(net, dataloader, loss_fn, precision='fp32'):
     n = len(dataloader.dataset)
     total_loss = 0.0
     total_acc = 0.0
@@ -16,8 +38,9 @@ def test_split(net, dataloader, loss_fn):
         batch_X, batch_Y = data
         batch_X, batch_Y = batch_X.to(device), batch_Y.to(device)
 
-        output = net(batch_X)
-        loss_batch, acc_batch = loss_fn(output, batch_Y)
+        with autocast(precision):
+            output = net(batch_X)
+            loss_batch, acc_batch = loss_fn(output.float(), batch_Y)
         total_loss += len(batch_X)*loss_batch.data.item()
         total_acc += len(batch_X)*acc_batch.data.item()
     return total_loss/n, total_acc/n
@@ -25,7 +48,7 @@ def test_split(net, dataloader, loss_fn):
 
 # Epoch_offset: to ensure stats are not overwritten when called during pruning
 def train(dataset, net, optimizer, lr_scheduler, epochs, log_freq, log_path, checkpoint_path, result_path,
-    test, save_model, epoch_offset=0):
+    test, save_model, epoch_offset=0, precision='fp32'):
     logging.debug('Tensorboard log path: ' + log_path)
     logging.debug('Tensorboard checkpoint path: ' + checkpoint_path)
     logging.debug('Results directory: ' + result_path)
@@ -35,7 +58,10 @@ def train(dataset, net, optimizer, lr_scheduler, epochs, log_freq, log_path, che
     writer = SummaryWriter(log_path)
     net.to(device)
 
-    logging.debug((torch.cuda.get_device_name(0)))
+    if device.type == 'cuda':
+        logging.debug((torch.cuda.get_device_name(0)))
+    logging.debug('Precision: ' + precision)
+    scaler = grad_scaler(precision)
 
     for name, param in net.named_parameters():
         if param.requires_grad:
@@ -61,7 +87,7 @@ def train(dataset, net, optimizer, lr_scheduler, epochs, log_freq, log_path, che
 
     # Compute initial stats
     t1 = time.time()
-    init_loss, init_accuracy = test_split(net, dataset.val_loader, dataset.loss)
+    init_loss, init_accuracy = test_split(net, dataset.val_loader, dataset.loss, precision)
     log_stats('Initial', 'Val', init_loss, init_accuracy, epoch_offset)
 
     for epoch in range(epochs):
@@ -73,12 +99,15 @@ def train(dataset, net, optimizer, lr_scheduler, epochs, log_freq, log_path, che
 
             optimizer.zero_grad()   # Zero the gradient buffers
 
-            output = net(batch_xs)
-            train_loss, train_accuracy = dataset.loss(output, batch_ys)
+            with autocast(precision):
+                output = net(batch_xs)
+                # Loss in fp32, as autocast does for its own losses
+                train_loss, train_accuracy = dataset.loss(output.float(), batch_ys)
             train_loss += net.loss()
-            train_loss.backward()
+            scaler.scale(train_loss).backward()
 
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
 
             # Log training every log_freq steps
             total_step = (epoch + epoch_offset)*len(dataset.train_loader) + step+1
@@ -91,7 +120,7 @@ def train(dataset, net, optimizer, lr_scheduler, epochs, log_freq, log_path, che
 
         # Validate and checkpoint by epoch
         # Test on validation set
-        val_loss, val_accuracy = test_split(net, dataset.val_loader, dataset.loss)
+        val_loss, val_accuracy = test_split(net, dataset.val_loader, dataset.loss, precision)
         log_stats('Validation', 'Val', val_loss, val_accuracy, epoch+epoch_offset+1)
 
         # Update LR
@@ -110,7 +139,7 @@ def train(dataset, net, optimizer, lr_scheduler, epochs, log_freq, log_path, che
                 best_val_save = save_path
 
             else:
-                test_loss, test_accuracy = test_split(net, dataset.test_loader, dataset.loss)
+                test_loss, test_accuracy = test_split(net, dataset.test_loader, dataset.loss, precision)
                 test_loss_of_best_val = test_loss
                 test_acc_of_best_val = test_accuracy
 
@@ -131,13 +160,13 @@ def train(dataset, net, optimizer, lr_scheduler, epochs, log_freq, log_path, che
             if best_val_save is not None: net.load_state_dict(torch.load(best_val_save))
             logging.debug(f'Loaded best validation checkpoint from: {best_val_save}')
 
-            test_loss, test_accuracy = test_split(net, dataset.test_loader, dataset.loss)
+            test_loss, test_accuracy = test_split(net, dataset.test_loader, dataset.loss, precision)
             log_stats('Test', 'Test', test_loss, test_accuracy, 0)
 
         else:
             log_stats('Test', 'Test', test_loss_of_best_val, test_acc_of_best_val, 0)
 
-        train_loss, train_accuracy = test_split(net, dataset.train_loader, dataset.loss)
+        train_loss, train_accuracy = test_split(net, dataset.train_loader, dataset.loss, precision)
 
         # Log best validation accuracy and training acc for that model
         writer.add_scalar('MaxAcc/Val', best_val_acc)
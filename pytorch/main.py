@@ -48,6 +48,8 @@ parser.add_argument('--prune-factor', type=float, default=1, help='Factor by whi
 parser.add_argument('--prune-iters', type=int, default=1, help='Number of pruning iters')
 parser.add_argument('--save-model', action='store_false', help='Whether to save best model')
 parser.add_argument('--data-dir', default='../../datasets/', help='Data directory')
+parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'fp16'],
+                    help='Mixed precision training with autocast (parameters stay in fp32)')
 
 out_dir = os.path.dirname(pytorch_root) # Repo root
 
@@ -127,10 +129,10 @@ def mlp(args):
                     assert model.class_type in ['unconstrained', 'u'] and args.model in ['MLP','CNN']
                     prune.prune(dataset, model, optimizer, lr_scheduler, args.epochs, args.log_freq, log_path,
                         checkpoint_path, result_path, args.test, args.save_model, args.prune_lr_decay, args.prune_factor,
-                        args.prune_iters)
+                        args.prune_iters, args.precision)
                 else:
                     train.train(dataset, model, optimizer, lr_scheduler, args.epochs, args.log_freq,
-                        log_path, checkpoint_path, result_path, args.test, args.save_model)
+                        log_path, checkpoint_path, result_path, args.test, args.save_model, precision=args.precision)
 
 
 ## Parse
@@ -1,9 +1,7 @@
 from inspect import signature
 import numpy as np
-import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.nn.parameter import Parameter
 
 import structure.LDR as ldr
 import structure.layer as sl
@@ -50,6 +48,47 @@ class ArghModel(nn.Module):
         """
         return 0
 
+    def freeze(self):
+        """
+        Put all structured layers in inference mode, caching their parameter-only computation
+        See structure.layer.Layer.freeze
+        """
+        return freeze(self)
+
+    def unfreeze(self):
+        return unfreeze(self)
+
+
+def freeze(model):
+    """
+    Freeze every structured layer in model (any nn.Module, not only ArghModel)
+    """
+    for module in model.modules():
+        if isinstance(module, sl.Layer):
+            module.freeze()
+    return model
+
+def unfreeze(model):
+    for module in model.modules():
+        if isinstance(module, sl.Layer):
+            module.unfreeze()
+    return model
+
+
+# Smallest out_size / in_size for which output_layer uses Fastfood blocks: they
+# take O(in_size log in_size) per row whatever out_size, so below it (e.g. for
+# 10 classes) the dense layer is faster, see structure.fastfood.fastfood_benchmark
+fastfood_head_min_ratio = 0.5
+
+
+def output_layer(in_size, out_size, fastfood=False):
+    """
+    Dense layer, or stacked Fastfood blocks truncated to out_size outputs if fastfood
+    is True and out_size is at least fastfood_head_min_ratio * in_size
+    """
+    if fastfood and out_size >= fastfood_head_min_ratio * in_size:
+        return sl.StructuredLinear('fastfood', layer_size=in_size, hidden_size=out_size)
+    return nn.Linear(in_size, out_size)
 
 
 # Pytorch tutorial lenet variant
@@ -81,7 +120,7 @@ class CNN(ArghModel):
     """
     def name(self):
         return self.layers[0].name()
-    def args(class_type='unconstrained', layer_size=-1, r=1, bias=True,hidden_size=-1): pass
+    def args(class_type='unconstrained', layer_size=-1, r=1, bias=True,hidden_size=-1, fastfood_head=False): pass
     def reset_parameters(self):
         if self.layer_size == -1:
             self.layer_size = self.in_size
@@ -96,7 +135,7 @@ class CNN(ArghModel):
         layers.append(sl.StructuredLinear(self.class_type, layer_size=self.layer_size, r=self.r, bias=self.bias,
             hidden_size=self.hidden_size))
         self.layers = nn.ModuleList(layers)
-        self.logits = nn.Linear(self.hidden_size, self.out_size)
+        self.logits = output_layer(self.hidden_size, self.out_size, self.fastfood_head)
     def forward(self, x):
         x = x.view(-1, 1, self.d, self.d)
         x = self.pool(F.relu(self.conv1(x)))
@@ -252,7 +291,7 @@ class LDRLDR(ArghModel):
     """
     def name(self):
         # w = 'wide' if not self.channels else ''
-        return self.LDR1.name() + self.LDR211.name()
+        return self.LDR1.name() + self.LDR2.name()
 
     def args(class1='toeplitz', class2='toeplitz', channels=False, rank1=48, rank2=16): pass
     def reset_parameters(self):
@@ -264,13 +303,13 @@ class LDRLDR(ArghModel):
         else:
             self.LDR1 = sl.StructuredLinear(self.class1, layer_size=3*self.n, r=self.rank1)
 
-        self.LDR211 = sl.StructuredLinear(self.class2, layer_size=self.fc_size, r=self.rank2)
-        self.LDR212 = sl.StructuredLinear(self.class2, layer_size=self.fc_size, r=self.rank2)
-        self.LDR221 = sl.StructuredLinear(self.class2, layer_size=self.fc_size, r=self.rank2)
-        self.LDR222 = sl.StructuredLinear(self.class2, layer_size=self.fc_size, r=self.rank2)
-        self.LDR231 = sl.StructuredLinear(self.class2, layer_size=self.fc_size, r=self.rank2)
-        self.LDR232 = sl.StructuredLinear(self.class2, layer_size=self.fc_size, r=self.rank2)
-        self.b = Parameter(torch.zeros(self.fc_size))
+        # 6 layers of size fc_size on the slices of the input, whose outputs are
+        # summed, multiplied together (or one rectangular layer tiled by 6 x 1 blocks)
+        self.groups = 3*self.n // self.fc_size
+        if sl.can_group(self.class2):
+            self.LDR2 = sl.GroupedStructuredLinear(self.class2, self.groups, self.fc_size, sum_groups=True, r=self.rank2)
+        else:
+            self.LDR2 = sl.StructuredLinear(self.class2, layer_size=3*self.n, hidden_size=self.fc_size, r=self.rank2)
         self.logits = nn.Linear(self.fc_size, 10)
 
     def forward(self, x):
@@ -278,17 +317,12 @@ class LDRLDR(ArghModel):
             x = x.view(-1, 3, self.n)
             x = x.transpose(0,1).contiguous().view(3, -1, self.n)
             x = F.relu(self.LDR1(x))
+            x = x.transpose(0,1).reshape(-1, 3*self.n)
         else:
             x = F.relu(self.LDR1(x))
-            x = x.view(-1, 3, self.n)
-            x = x.transpose(0,1).contiguous().view(3, -1, self.n)
-        x11 = x[0][:,:self.fc_size]
-        x12 = x[0][:,self.fc_size:]
-        x21 = x[1][:,:self.fc_size]
-        x22 = x[1][:,self.fc_size:]
-        x31 = x[2][:,:self.fc_size]
-        x32 = x[2][:,self.fc_size:]
-        x = F.relu(self.LDR211(x11) + self.LDR212(x12) + self.LDR221(x21) + self.LDR222(x22) + self.LDR231(x31) + self.LDR232(x32) + self.b)
+        if self.LDR2.groups:
+            x = x.reshape(-1, self.groups, self.fc_size).transpose(0, 1)
+        x = F.relu(self.LDR2(x))
         x = self.logits(x)
         return x
 
@@ -298,27 +332,27 @@ class LDRLDR(ArghModel):
 
 class LDRLDR2(ArghModel):
     """
-    Same as LDRLDR but use larger matrix to represent rectangular LDR
+    Same as LDRLDR but with one wide LDR layer, followed by a rectangular LDR layer
     """
     def name(self):
         return self.LDR1.name() + self.LDR2.name()
 
-    def args(class1='toeplitz', class2='toeplitz', layer_size=-1, channels=3, fc_size=512, rank1=48, rank2=16): pass
+    def args(class1='toeplitz', class2='toeplitz', layer_size=-1, channels=3, fc_size=512, rank1=48, rank2=16,
+             memory_efficient=False): pass
     def reset_parameters(self):
         if self.layer_size == -1:
             self.layer_size = self.in_size
         self.n = self.layer_size
 
-        self.LDR1 = sl.StructuredLinear(self.class1, layer_size=self.channels*self.n, r=self.rank1, bias=True)
-        self.LDR2 = sl.StructuredLinear(self.class2,layer_size=self.channels*self.n, r=self.rank2, bias=True)
+        self.LDR1 = sl.StructuredLinear(self.class1, layer_size=self.in_size, hidden_size=self.channels*self.n, r=self.rank1,
+            bias=True, memory_efficient=self.memory_efficient)
+        self.LDR2 = sl.StructuredLinear(self.class2, layer_size=self.channels*self.n, hidden_size=self.fc_size,
+            r=self.rank2, bias=True, memory_efficient=self.memory_efficient)
         self.logits = nn.Linear(self.fc_size, 10)
 
     def forward(self, x):
-        batch_size, n = x.shape[0], x.shape[1]
-        x = torch.cat((x, torch.zeros(batch_size, self.channels*self.n-n).cuda()), dim=-1)
         x = F.relu(self.LDR1(x))
         x = F.relu(self.LDR2(x))
-        x = x[:,:self.fc_size]
         x = self.logits(x)
         return x
 
@@ -349,10 +383,10 @@ class SHL(SL):
     """
     Single hidden layer
     """
-    def args(class_type='unconstrained', layer_size=-1, r=1, bias=True, hidden_size=-1): pass
+    def args(class_type='unconstrained', layer_size=-1, r=1, bias=True, hidden_size=-1, fastfood_head=False): pass
     def reset_parameters(self):
         super().reset_parameters()
-        self.W2 = nn.Linear(self.hidden_size, self.out_size)
+        self.W2 = output_layer(self.hidden_size, self.out_size, self.fastfood_head)
 
     def forward(self, x):
         return self.W2(F.relu(self.W(x)))
@@ -363,15 +397,17 @@ class MLP(ArghModel):
     """
     def name(self):
         return self.layers[0].name()
-    def args(class_type='unconstrained', layer_size=-1, r=1, bias=True, num_layers=1): pass
+    def args(class_type='unconstrained', layer_size=-1, r=1, bias=True, num_layers=1, memory_efficient=False,
+             fastfood_head=False): pass
     def reset_parameters(self):
         if self.layer_size == -1:
             self.layer_size = self.in_size
         layers = []
         for layer in range(self.num_layers):
-            layers.append(sl.StructuredLinear(self.class_type,layer_size=self.layer_size, r=self.r, bias=self.bias))
+            layers.append(sl.StructuredLinear(self.class_type,layer_size=self.layer_size, r=self.r, bias=self.bias,
+                memory_efficient=self.memory_efficient))
         self.layers = nn.ModuleList(layers)
-        self.W2 = nn.Linear(self.layer_size, self.out_size)
+        self.W2 = output_layer(self.layer_size, self.out_size, self.fastfood_head)
 
     def forward(self, x):
         output = F.relu(self.layers[0](x))
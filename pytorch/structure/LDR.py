@@ -1,10 +1,10 @@
 import torch
-from torch.autograd import Variable
 import torch.nn as nn
 from torch.nn.parameter import Parameter
 
 from . import toeplitz as toep
 from . import krylov as kry
+from .complex_utils import autocast_dtype
 
 # TODO: rewrite with structure.layer
 # TODO: subclass with each DR type
@@ -46,19 +46,17 @@ class LDR(nn.Module):
         _, b, n = x.shape
         assert n == self.n
 
-        # print("shapes ", self.G[0,0].shape, self.H[0,0].shape, x[0].shape)
-        comps = Variable(torch.Tensor(self.in_channels, self.out_channels, b, self.n)).cuda()
-        for i in range(self.in_channels):
-            for j in range(self.out_channels):
-                if self.displacement in ['toeplitz_corner', 'toeplitz', 'tc', 't']:
-                    g = self.G[i,j]
-                    h = self.H[i,j]
-                    comps[i,j] = toep.toeplitz_mult(self.G[i,j], self.H[i,j], x[i], self.corner)
-                elif self.displacement == 'subdiagonal' or self.displacement == 'sd':
-                    comps[i,j] = kry.subdiag_mult_conv(self.subd_A[i,j], self.subd_B[i,j], self.G[i,j], self.H[i,j], x[i])
-        out = torch.sum(comps, dim=0)
+        # All (in_channel, out_channel) pairs at once, summed over in_channels
+        if self.displacement in ['toeplitz_corner', 'toeplitz', 'tc', 't']:
+            out = toep.toeplitz_mult_channels(self.G, self.H, x, self.corner)
+        elif self.displacement == 'subdiagonal' or self.displacement == 'sd':
+            out = kry.subdiag_mult_channels(self.subd_A, self.subd_B, self.G, self.H, x)
+        # Output in the autocast dtype if enabled, as in structure.layer.Layer.apply_bias
+        dtype = autocast_dtype(out.device)
+        if dtype is not None:
+            out = out.to(dtype)
         if self.bias is not None:
-            out += self.bias
+            out = out + self.bias.to(out.dtype)
         return out
 
     def loss(self):
@@ -0,0 +1,292 @@
+'''Autotuned dispatch for multiplying by an LDR matrix with subdiagonal operators.
+
+There are several implementations of the same product in krylov.py: the fast
+algorithm with FFT polynomial multiplication (subdiag_mult, and
+subdiag_mult_corner when A and B have corners), the fast algorithm with conv1d
+for small polynomial degrees (subdiag_mult_conv, whose crossover degree is a
+parameter), and the explicit Krylov constructions
+(subdiag_mult_slow, subdiag_mult_slow_fast, and subdiag_mult_cuda, which uses
+the C++ or CUDA cycle_mult extension). Which one is the fastest depends on n,
+rank, batch size, dtype, device, number of threads, and whether we also need
+the backward pass.
+
+The first time a shape is seen, every candidate is timed on random inputs of
+that shape and the winner is stored in a JSON cache on disk, so later runs
+(and other processes) dispatch directly.
+
+Shapes aren't tuned while a graph is being captured (torch.jit.trace or
+torch.compile), see @lookup.
+
+Environment variables:
+    STRUCTURED_NETS_TUNING_CACHE: path of the cache file
+        (default ~/.cache/structured-nets/subdiag_tuning.json).
+    STRUCTURED_NETS_AUTOTUNE: set to 0 to disable tuning; cached entries are
+        still used, and uncached shapes use the default algorithm.
+'''
+
+import json
+import os
+import statistics
+import time
+
+import numpy as np
+import torch
+
+from . import krylov as kry
+from . import backends
+from .complex_utils import to_compute_dtype
+
+
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+cache_path = os.environ.get('STRUCTURED_NETS_TUNING_CACHE',
+                            os.path.join(os.path.expanduser('~'), '.cache', 'structured-nets', 'subdiag_tuning.json'))
+autotune_enabled = os.environ.get('STRUCTURED_NETS_AUTOTUNE', '1') != '0'
+
+# Don't try the explicit Krylov constructions if the Krylov matrices would have
+# more than this many entries, as they take O(rank * n^2) memory.
+max_slow_numel = 1 << 24
+
+_cache = None
+
+
+def load_cache(path=None):
+    """Load the tuning cache from disk into memory, replacing the current one.
+    Parameters:
+        path: cache file, defaults to cache_path.
+    Returns:
+        cache: dictionary from shape keys to configurations.
+    """
+    global _cache
+    path = cache_path if path is None else path
+    try:
+        with open(path, 'r') as f:
+            _cache = json.load(f)
+    except (OSError, ValueError):
+        _cache = {}
+    return _cache
+
+
+def save_cache(path=None):
+    """Write the in-memory tuning cache to disk.
+    Entries written by other processes in the meantime are kept.
+    """
+    path = cache_path if path is None else path
+    cache = _cache if _cache is not None else {}
+    try:
+        with open(path, 'r') as f:
+            on_disk = json.load(f)
+    except (OSError, ValueError):
+        on_disk = {}
+    on_disk.update(cache)
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(on_disk, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)  # atomic, so concurrent readers never see a partial file
+    except OSError as e:
+        print(f'Could not save tuning cache to {path}: {e}')
+
+
+def shape_key(n, rank, batch_size, dtype, device, corner, backward):
+    """Key of a problem in the tuning cache.
+    Batch sizes are rounded up to a power of 2 so that e.g. the last partial
+    batch of an epoch doesn't trigger another round of tuning.
+    """
+    batch_bucket = 1 << int(np.ceil(np.log2(max(batch_size, 1))))
+    return '|'.join([
+        'sdc' if corner else 'sd',
+        f'n={n}', f'rank={rank}', f'batch={batch_bucket}',
+        f'dtype={str(dtype).replace("torch.", "")}',
+        f'device={torch.device(device).type}',
+        f'threads={torch.get_num_threads()}',
+        'fwd+bwd' if backward else 'fwd',
+    ])
+
+
+def candidates(n, rank, batch_size, dtype, device, corner):
+    """List the configurations that can compute the product for this problem.
+    Returns:
+        configs: list of dictionaries with key 'algorithm' and possibly
+            'conv_threshold', the largest polynomial degree handled by conv1d.
+    """
+    configs = []
+    if corner:
+        configs.append({'algorithm': 'fast_corner'})
+    else:
+        configs.append({'algorithm': 'fast'})
+        m = int(np.ceil(np.log2(n)))
+        # Polynomial degrees at each level of the recursion are 1, 2, ..., n/2
+        configs.extend({'algorithm': 'conv', 'conv_threshold': 1 << d} for d in range(m))
+    if rank * n * n <= max_slow_numel:
+        configs.append({'algorithm': 'slow'})
+        configs.append({'algorithm': 'slow_fast'})
+    if kry.cycle_mult_available(device, dtype):
+        configs.append({'algorithm': 'cuda'})
+    return configs
+
+
+def default_config(corner, device, dtype=torch.float):
+    """Configuration to use when tuning is disabled."""
+    return {'algorithm': 'fast_corner' if corner else 'fast'}
+
+
+def run(config, subdiag_A, subdiag_B, G, H, x, corner_A=0.0, corner_B=0.0):
+    """Multiply \\sum_i Krylov(A, G_i) @ Krylov(B, H_i) @ x with the implementation given by config."""
+    algorithm = config['algorithm']
+    if algorithm == 'fast':
+        return kry.subdiag_mult(subdiag_A, subdiag_B, G, H, x)
+    elif algorithm == 'fast_corner':
+        return kry.subdiag_mult_corner(subdiag_A, subdiag_B, G, H, x, corner_A, corner_B)
+    elif algorithm == 'conv':
+        return kry.subdiag_mult_conv(subdiag_A, subdiag_B, G, H, x, config['conv_threshold'])
+    elif algorithm == 'slow':
+        return kry.subdiag_mult_slow(subdiag_A, subdiag_B, G, H, x, corner_A, corner_B)
+    elif algorithm == 'slow_fast':
+        return kry.subdiag_mult_slow_fast(subdiag_A, subdiag_B, G, H, x, corner_A, corner_B)
+    elif algorithm == 'cuda':
+        return kry.subdiag_mult_cuda(subdiag_A, subdiag_B, G, H, x, corner_A, corner_B)
+    else:
+        assert False, f'Unknown algorithm {algorithm}'
+
+
+def benchmark(config, n, rank, batch_size, dtype, device, corner, backward, repeat=5):
+    """Median time in seconds of one multiply (and its backward pass if backward) on random inputs."""
+    def rand(*shape):
+        return torch.rand(shape, dtype=dtype, device=device, requires_grad=backward)
+    subdiag_A, subdiag_B, G, H, x = rand(n - 1), rand(n - 1), rand(rank, n), rand(rank, n), rand(batch_size, n)
+    inputs = [subdiag_A, subdiag_B, G, H, x]
+    corner_A, corner_B = 0.0, 0.0
+    if corner:
+        corner_A, corner_B = rand(), rand()
+        inputs += [corner_A, corner_B]
+    synchronize = torch.cuda.synchronize if torch.device(device).type == 'cuda' else lambda: None
+    times = []
+    with torch.set_grad_enabled(backward):
+        for _ in range(repeat + 1):  # First iteration is a warmup
+            synchronize()
+            start = time.perf_counter()
+            out = run(config, subdiag_A, subdiag_B, G, H, x, corner_A, corner_B)
+            if backward:
+                torch.autograd.grad(out.sum(), [t for t in inputs if t.requires_grad], allow_unused=True)
+            synchronize()
+            times.append(time.perf_counter() - start)
+    return statistics.median(times[1:])
+
+
+def tune(n, rank, batch_size, dtype=torch.float, device=device, corner=False, backward=True, verbose=False):
+    """Time all candidates for this problem, record the fastest in the cache and save it to disk.
+    Returns:
+        config: the fastest configuration.
+    """
+    if _cache is None:
+        load_cache()
+    key = shape_key(n, rank, batch_size, dtype, device, corner, backward)
+    batch_bucket = 1 << int(np.ceil(np.log2(max(batch_size, 1))))
+    best, best_time = None, float('inf')
+    for config in candidates(n, rank, batch_size, dtype, device, corner):
+        try:
+            t = benchmark(config, n, rank, batch_bucket, dtype, device, corner, backward)
+        except (RuntimeError, NameError) as e:  # e.g. out of memory, or the extension is missing
+            if verbose:
+                print(f'{config}: failed ({e})')
+            continue
+        if verbose:
+            print(f'{config}: {t * 1e3:.3f}ms')
+        if t < best_time:
+            best, best_time = config, t
+    if best is None:
+        best = default_config(corner, device, dtype)
+    _cache[key] = dict(best, time=best_time if best_time < float('inf') else None)
+    save_cache()
+    return best
+
+
+def capturing():
+    """Whether a graph is being captured by torch.jit.trace or torch.compile."""
+    is_compiling = getattr(getattr(torch, 'compiler', None), 'is_compiling', None)  # Pytorch >= 2.3
+    return torch.jit.is_tracing() or (is_compiling is not None and is_compiling())
+
+
+def lookup(n, rank, batch_size, dtype, device, corner, backward):
+    """Return the configuration for this problem, tuning it first if it's not in the cache.
+    Nothing is tuned while a graph is being captured (the candidates would be
+    timed, or compiled, inside the capture): uncached shapes then use the default algorithm.
+    """
+    if _cache is None:
+        load_cache()
+    key = shape_key(n, rank, batch_size, dtype, device, corner, backward)
+    if key not in _cache:
+        if not autotune_enabled or capturing():
+            return default_config(corner, device, dtype)
+        tune(n, rank, batch_size, dtype, device, corner, backward)
+    return _cache[key]
+
+
+def subdiag_mult(subdiag_A, subdiag_B, G, H, x, corner_A=None, corner_B=None):
+    """Multiply \\sum_i Krylov(A, G_i) @ Krylov(B, H_i) @ x when A and B are zero except on the subdiagonal
+    (and the upper right corner, if corner_A and corner_B are given).
+    Dispatches to the implementation that was measured to be fastest for this problem.
+    Parameters:
+        subdiag_A: Tensor of shape (n - 1, )
+        subdiag_B: Tensor of shape (n - 1, )
+        G: Tensor of shape (rank, n)
+        H: Tensor of shape (rank, n)
+        x: Tensor of shape (batch_size, n)
+        corner_A: real number or Tensor of shape (), or None if A has no corner
+        corner_B: real number or Tensor of shape (), or None if B has no corner
+    Returns:
+        product: Tensor of shape (batch_size, n)
+    """
+    rank, n = G.shape
+    batch_size = x.shape[0]
+    corner = corner_A is not None or corner_B is not None
+    params = [subdiag_A, subdiag_B, G, H, x, corner_A, corner_B]
+    backward = torch.is_grad_enabled() and any(isinstance(p, torch.Tensor) and p.requires_grad for p in params)
+    # Half precision inputs are multiplied (and tuned) in single precision
+    subdiag_A, subdiag_B, G, H, x_, corner_A, corner_B = to_compute_dtype(*params)
+    config = lookup(n, rank, batch_size, x_.dtype, x.device, corner, backward)
+    corner_A = 0.0 if corner_A is None else corner_A
+    corner_B = 0.0 if corner_B is None else corner_B
+    return run(config, subdiag_A, subdiag_B, G, H, x_, corner_A, corner_B).to(x.dtype)
+
+
+backends.register('subdiagonal', 'autotune', subdiag_mult)
+backends.register('subdiagonal_corner', 'autotune', subdiag_mult)
+
+
+def test_subdiag_mult():
+    global cache_path
+    import tempfile
+    cache_path = os.path.join(tempfile.mkdtemp(), 'subdiag_tuning.json')
+    load_cache()
+    n = 1 << 8
+    batch_size = 20
+    rank = 4
+    subdiag_A = torch.rand(n - 1, requires_grad=True, device=device)
+    subdiag_B = torch.rand(n - 1, requires_grad=True, device=device)
+    G = torch.rand((rank, n), requires_grad=True, device=device)
+    H = torch.rand((rank, n), requires_grad=True, device=device)
+    x = torch.rand((batch_size, n), requires_grad=True, device=device)
+    corner = torch.tensor(0.5, device=device)
+    result = subdiag_mult(subdiag_A, subdiag_B, G, H, x)
+    result_slow = kry.subdiag_mult_slow(subdiag_A, subdiag_B, G, H, x)
+    result_corner = subdiag_mult(subdiag_A, subdiag_B, G, H, x, corner, corner)
+    result_corner_slow = kry.subdiag_mult_slow(subdiag_A, subdiag_B, G, H, x, corner, corner)
+    print(load_cache())
+    # These max relative differences should be small
+    print(((result - result_slow).abs().max() / result_slow.abs().max()).item())
+    print(((result_corner - result_corner_slow).abs().max() / result_corner_slow.abs().max()).item())
+    # Nothing is tuned while tracing: the new batch size uses the default algorithm
+    import warnings
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # about the sizes converted to Python values
+        args = [t.detach() for t in (subdiag_A, subdiag_B, G, H)]
+        torch.jit.trace(lambda x: subdiag_mult(*args, x), x[:3].detach(), check_trace=False)
+    assert not any('batch=4|' in key for key in load_cache())
+
+
+# TODO: move test into subpackage
+if __name__ == '__main__':
+    test_subdiag_mult()
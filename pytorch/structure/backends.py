@@ -0,0 +1,219 @@
+'''Registry of backends (implementations) of the structured multiplies.
+
+Each class type of structure.layer with registered backends has a multiply
+with a fixed signature, taking the parameters of one (square) block and the
+input x of shape (batch_size, n):
+    'circulant': f(c, x)
+    'toeplitz', 'toeplitz_corner': f(G, H, x)
+    'subdiagonal': f(subdiag_A, subdiag_B, G, H, x)
+    'subdiagonal_corner': f(subdiag_A, subdiag_B, G, H, x, corner_A, corner_B)
+and there are internal kernels shared by several layers:
+    'hadamard': f(x), unnormalized Hadamard transform of the last dimension of
+        the contiguous Tensor x, without autograd. It may be done in place.
+The modules implementing them register their backends with @register, along
+with capability flags: the device types and dtypes they handle, whether
+gradients flow through them, the largest n, and whether n must be a power of 2.
+
+A backend is chosen for each call by @select, in this order:
+1. a backend forced with use_backend(..., force=True) (or
+   STRUCTURED_NETS_BACKEND_FORCE=1), which is an error if it can't handle the call;
+2. the layer's own choice, its multiply_backend attribute;
+3. the innermost use_backend(...) context, then STRUCTURED_NETS_BACKEND;
+4. otherwise, the layer's built-in forward (with the frozen cache, KrylovPlans,
+   autotuned dispatch, etc.), or for the kernels, the first capable backend in
+   registration order.
+Choices that can't handle the call (e.g. the numpy backends when gradients are
+needed) are skipped. This allows A/B testing kernels without editing the layers:
+    with backends.use_backend('numpy', 'sd'):
+        model(x)
+or STRUCTURED_NETS_BACKEND='sd=numpy,hadamard=torch' (a name without a class
+type applies to every class type that has a backend with that name).
+'''
+
+import os
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+# Dictionary from class type to dictionary from name to Backend, in registration order
+registry = {}
+# Abbreviations of the class types (e.g. 'sd' for 'subdiagonal'), filled in by structure.layer
+aliases = {}
+
+
+class Backend:
+    """An implementation of the multiply of a class type, and what it can handle.
+    Parameters:
+        devices: device types ('cpu', 'cuda'), or None for any
+        dtypes: dtypes of the input, or None for any
+        autograd: whether gradients flow through it
+        max_n: largest block size, or None
+        power_of_2: whether the block size must be a power of 2
+        available: bool, or function returning whether it's usable (e.g. the extension is installed)
+    """
+
+    def __init__(self, class_type, name, fn, devices=None, dtypes=None, autograd=True, max_n=None,
+                 power_of_2=False, available=True):
+        self.class_type = class_type
+        self.name = name
+        self.fn = fn
+        self.devices = devices
+        self.dtypes = dtypes
+        self.autograd = autograd
+        self.max_n = max_n
+        self.power_of_2 = power_of_2
+        self.available = available
+
+    def __repr__(self):
+        return f'Backend({self.class_type}, {self.name})'
+
+    def __call__(self, *args):
+        return self.fn(*args)
+
+    def supports(self, device, dtype, n, autograd=False):
+        """Whether this backend can multiply an input of this device type, dtype and size."""
+        available = self.available() if callable(self.available) else self.available
+        return (available
+                and (self.devices is None or device in self.devices)
+                and (self.dtypes is None or dtype in self.dtypes)
+                and (self.autograd or not autograd)
+                and (self.max_n is None or n <= self.max_n)
+                and (not self.power_of_2 or n & (n - 1) == 0))
+
+
+def register(class_type, name, fn=None, **flags):
+    """Register fn as the backend name of class_type, with the capability flags of @Backend.
+    Can be used as a decorator if fn is omitted.
+    """
+    if fn is None:
+        return lambda fn: register(class_type, name, fn, **flags)
+    registry.setdefault(class_type, {})[name] = Backend(class_type, name, fn, **flags)
+    return fn
+
+
+def canonical(class_type):
+    return aliases.get(class_type, class_type)
+
+
+def parse_preferences(spec, force=False):
+    """Parse 'name' or 'class_type=name' entries separated by commas, as in STRUCTURED_NETS_BACKEND."""
+    preferences = []
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        class_type, _, name = entry.rpartition('=')
+        preferences.append((class_type or None, name, force))
+    return preferences
+
+
+# Stack of (class_type or None for all, name, force); later entries take precedence
+_preferences = parse_preferences(os.environ.get('STRUCTURED_NETS_BACKEND', ''),
+                                 force=os.environ.get('STRUCTURED_NETS_BACKEND_FORCE', '0') == '1')
+
+
+@contextmanager
+def use_backend(name, class_type=None, force=False):
+    """Use the backend name for class_type (or every class type with such a backend)
+    within the context, whenever it can handle the call.
+    If force, it's also used instead of the layers' own choices, and it's an
+    error if it can't handle a call.
+    """
+    _preferences.append((class_type, name, force))
+    try:
+        yield
+    finally:
+        _preferences.remove((class_type, name, force))
+
+
+def select(class_type, x, n=None, autograd=False, preference=None, fallback=False):
+    """Choose the backend of class_type for the input x, as described above.
+    Parameters:
+        x: input Tensor, whose device type and dtype the backend must handle
+        n: block size, defaults to the last dimension of x
+        autograd: whether gradients must flow through the multiply
+        preference: name of the backend chosen by the caller (e.g. the layer), or None
+        fallback: whether to fall back to the first capable backend, or return None
+    Returns:
+        backend: Backend, or None to use the caller's built-in implementation
+    """
+    class_type = canonical(class_type)
+    backends = registry.get(class_type)
+    if not backends:
+        return None
+    n = x.shape[-1] if n is None else n
+    args = (x.device.type, x.dtype, n, autograd)
+    preferences = [p for p in reversed(_preferences)
+                   if (p[0] is None or canonical(p[0]) == class_type) and p[1] in backends]
+    for _, name, force in preferences:
+        if force:
+            if not backends[name].supports(*args):
+                raise ValueError(f'Backend {name} of {class_type} was forced but does not support '
+                                 f'device={args[0]}, dtype={args[1]}, n={n}, autograd={autograd}')
+            return backends[name]
+    for name in [preference] + [p[1] for p in preferences]:
+        if name in backends and backends[name].supports(*args):
+            return backends[name]
+    if fallback:
+        for backend in backends.values():
+            if backend.supports(*args):
+                return backend
+    return None
+
+
+def list_backends(class_type, x=None, n=None, autograd=False):
+    """Names of the backends of class_type, only those that can handle the input x if it's given."""
+    backends = registry.get(canonical(class_type), {})
+    if x is None:
+        return list(backends)
+    n = x.shape[-1] if n is None else n
+    return [name for name, b in backends.items() if b.supports(x.device.type, x.dtype, n, autograd)]
+
+
+##### Numpy backends, with pyFFTW if it's installed
+
+def numpy_backend(fn):
+    """Wrap a function of numpy arrays into a backend taking and returning Tensors on the CPU."""
+    def wrapper(*args):
+        x = args[-1]
+        args = [a.detach().numpy() if isinstance(a, torch.Tensor) else a for a in args]
+        return torch.from_numpy(np.ascontiguousarray(fn(*args))).to(x.dtype)
+    return wrapper
+
+
+numpy_flags = dict(devices=('cpu', ), dtypes=(torch.float, torch.double), autograd=False)
+
+register('circulant', 'numpy', numpy_backend(lambda c, x: np.fft.irfft(np.fft.rfft(c) * np.fft.rfft(x), c.shape[-1])),
+         **numpy_flags)
+
+from . import toeplitz_cpu
+# The numpy version divides by 2 in the cyclic case
+register('toeplitz', 'numpy', numpy_backend(lambda G, H, x: toeplitz_cpu.toeplitz_mult(G, H, x, cycle=False)),
+         power_of_2=True, **numpy_flags)
+register('toeplitz_corner', 'numpy', numpy_backend(lambda G, H, x: 2 * toeplitz_cpu.toeplitz_mult(G, H, x, cycle=True)),
+         power_of_2=True, **numpy_flags)
+
+try:
+    from . import krylov_cpu
+    register('subdiagonal', 'numpy', numpy_backend(krylov_cpu.subdiag_mult), **numpy_flags)
+except ImportError:
+    pass
+
+
+def test_select():
+    x = torch.rand(3, 64)
+    print(list_backends('subdiagonal'), list_backends('subdiagonal', x, autograd=True))
+    print(select('subdiagonal', x), select('hadamard', x, fallback=True))
+    with use_backend('slow', 'sd'):
+        print(select('subdiagonal', x), select('subdiagonal', x, preference='fast'), select('toeplitz', x))
+        with use_backend('fast', force=True):
+            print(select('subdiagonal', x, preference='slow'), select('toeplitz', x))
+    with use_backend('numpy'):
+        print(select('subdiagonal', x, autograd=True), select('subdiagonal', x))
+
+
+if __name__ == '__main__':
+    import importlib
+    importlib.import_module('.layer', __package__)  # registers the backends of all the modules
+    test_select()
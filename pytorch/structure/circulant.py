@@ -1,18 +1,60 @@
 import torch
 from scipy.linalg import circulant
-from .complex_utils import complex_mult
+from .complex_utils import rfft, irfft
+from . import backends
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-def circulant_multiply(c, x):
+def circulant_multiply(c, x, c_f=None):
     """ Multiply circulant matrix with first column c by x
     Parameters:
         c: (n, )
         x: (batch_size, n) or (n, )
+        c_f: optional, precomputed rfft(c)
     Return:
         prod: (batch_size, n) or (n, )
     """
-    return torch.irfft(complex_mult(torch.rfft(c, 1), torch.rfft(x, 1)), 1, signal_sizes=(c.shape[-1], ))
+    n = c.shape[-1]
+    if c_f is None:
+        c_f = rfft(c)
+    return irfft(c_f * rfft(x), n).to(x.dtype)
+
+def circulant_multiply_channels(c, x, c_f=None):
+    """ Multiply by a block matrix with in_channels x out_channels circulant blocks:
+    out_j = \sum_i circulant(c_ij) @ x_i.
+    Each input channel is transformed once and the sum is done in the frequency domain.
+    Parameters:
+        c: (in_channels, out_channels, n)
+        x: (in_channels, batch_size, n)
+        c_f: optional, precomputed rfft(c)
+    Return:
+        prod: (out_channels, batch_size, n)
+    """
+    n = c.shape[-1]
+    if c_f is None:
+        c_f = rfft(c)
+    return irfft(torch.einsum('ijf,ibf->jbf', c_f, rfft(x)), n).to(x.dtype)
+
+def circulant_multiply_groups(c, x, c_f=None, sum_groups=False):
+    """ Multiply by groups independent circulant matrices: out_g = circulant(c_g) @ x_g,
+    or by all of them if x is shared by the groups.
+    Parameters:
+        c: (groups, n)
+        x: (groups, batch_size, n), or (batch_size, n) shared by the groups
+        c_f: optional, precomputed rfft(c)
+        sum_groups: return \sum_g out_g, summed in the frequency domain
+    Return:
+        prod: (groups, batch_size, n), or (batch_size, n) if sum_groups
+    """
+    n = c.shape[-1]
+    if c_f is None:
+        c_f = rfft(c)
+    prod_f = c_f.unsqueeze(-2) * rfft(x)
+    if sum_groups:
+        prod_f = prod_f.sum(dim=0)
+    return irfft(prod_f, n).to(x.dtype)
+
+backends.register('circulant', 'fft', circulant_multiply)
 
 def test_circulant_multiply(n):
     c = torch.rand(n, device=device)
@@ -22,6 +64,14 @@ def test_circulant_multiply(n):
     fast = circulant_multiply(c, x)
     print('Error compared to slow multiply: ', (slow - fast).abs().max().item())
 
+def test_circulant_multiply_channels(n, in_channels=3, out_channels=2):
+    c = torch.rand((in_channels, out_channels, n), device=device)
+    x = torch.rand((in_channels, 5, n), device=device)
+    fast = circulant_multiply_channels(c, x)
+    slow = torch.stack([sum(circulant_multiply(c[i, j], x[i]) for i in range(in_channels)) for j in range(out_channels)])
+    print('Error compared to per-channel multiply: ', (slow - fast).abs().max().item())
+
 # TODO: move test into subpackage
 if __name__ == '__main__':
     test_circulant_multiply(100)
+    test_circulant_multiply_channels(100)
@@ -1,19 +1,110 @@
-''' Utility functions for handling complex tensors: conjugate and complex_mult.
-Pytorch (as of 0.4.0) does not support complex tensors, so we store them as
-float tensors where the last dimension is 2 (real and imaginary parts).
+''' Utility functions for handling complex tensors and FFTs.
+Complex numbers are stored as native complex tensors (complex64/complex128),
+and all the fast multiplies go through the FFT wrappers here (rfft, irfft, fft,
+ifft) so that there is a single place that deals with the torch.fft API.
+The FFTs always run in at least single precision: half precision (float16,
+bfloat16) inputs are upcast, since torch.fft doesn't support bfloat16 (nor
+float16 on CPU), and the errors of a length n transform grow with n.
+The other multiplies follow the same policy with @compute_dtype.
+Requires Pytorch >= 1.8.
 '''
 
 import torch
 
+# Half precision dtypes and their single precision counterparts
+_upcast = {torch.float16: torch.float, torch.bfloat16: torch.float, torch.complex32: torch.complex64}
+
 
 def conjugate(X):
-    assert X.shape[-1] == 2, 'Last dimension must be 2'
-    return X * torch.tensor((1, -1), dtype=X.dtype, device=X.device)
+    assert X.is_complex(), 'X must be a complex tensor'
+    return X.conj()
 
 
 def complex_mult(X, Y):
-    assert X.shape[-1] == 2 and Y.shape[-1] == 2, 'Last dimension must be 2'
-    return torch.stack(
-        (X[..., 0] * Y[..., 0] - X[..., 1] * Y[..., 1],
-         X[..., 0] * Y[..., 1] + X[..., 1] * Y[..., 0]),
-        dim=-1)
+    assert X.is_complex() and Y.is_complex(), 'X and Y must be complex tensors'
+    return X * Y
+
+
+def compute_dtype(*tensors):
+    """Real dtype to run a structured multiply in: the promoted dtype of the
+    inputs, but at least float32. FFTs and sums over n terms lose too much
+    accuracy in half precision, so the fast multiplies upcast half precision
+    inputs to this dtype and cast their output back to the dtype of x.
+    """
+    dtype = tensors[0].dtype
+    for t in tensors[1:]:
+        dtype = torch.promote_types(dtype, t.dtype)
+    return torch.promote_types(dtype, torch.float)
+
+
+def to_compute_dtype(*args):
+    """Cast the Tensors among args to their @compute_dtype. Other arguments
+    (e.g. corners that are real numbers, or None) are returned as is.
+    """
+    dtype = compute_dtype(*[a for a in args if isinstance(a, torch.Tensor)])
+    return tuple(a.to(dtype) if isinstance(a, torch.Tensor) else a for a in args)
+
+
+def autocast_dtype(device):
+    """The dtype autocast runs linear layers in on this device, or None if autocast is disabled."""
+    if hasattr(torch, 'get_autocast_dtype'):  # Pytorch >= 2.4
+        enabled = torch.is_autocast_enabled(device.type)
+        return torch.get_autocast_dtype(device.type) if enabled else None
+    if device.type == 'cuda':
+        return torch.get_autocast_gpu_dtype() if torch.is_autocast_enabled() else None
+    return torch.get_autocast_cpu_dtype() if torch.is_autocast_cpu_enabled() else None
+
+
+def upcast(x):
+    """x in single precision if it's in half precision, else x itself."""
+    return x.to(_upcast[x.dtype]) if x.dtype in _upcast else x
+
+
+def next_fast_len(n):
+    """Smallest integer >= n whose only prime factors are 2, 3 and 5.
+    FFTs of these sizes are about as fast as those of powers of 2.
+    """
+    m = max(int(n), 1)  # Sizes are 0-dim Tensors when tracing, and k //= p would modify them in place
+    while True:
+        k = m
+        for p in (2, 3, 5):
+            while k % p == 0:
+                k //= p
+        if k == 1:
+            return m
+        m += 1
+
+
+def rfft(x, n=None, out=None):
+    """FFT of a real signal along the last dimension.
+    Parameters:
+        x: real Tensor of shape (..., m)
+        n: signal length; x is zero-padded (or truncated) to length n. Padding
+           happens inside the FFT so no padded copy of x is allocated.
+        out: optional, preallocated output
+    Returns:
+        x_f: complex Tensor of shape (..., n // 2 + 1)
+    """
+    return torch.fft.rfft(upcast(x), n=n, out=out)
+
+
+def irfft(X, n, out=None):
+    """Inverse of @rfft.
+    Parameters:
+        X: complex Tensor of shape (..., n // 2 + 1)
+        n: length of the real output signal
+        out: optional, preallocated output
+    Returns:
+        x: real Tensor of shape (..., n)
+    """
+    return torch.fft.irfft(upcast(X), n=n, out=out)
+
+
+def fft(x, n=None):
+    """Complex FFT along the last dimension. x can be real or complex."""
+    return torch.fft.fft(upcast(x), n=n)
+
+
+def ifft(X, n=None):
+    """Inverse complex FFT along the last dimension, normalized by 1/n."""
+    return torch.fft.ifft(upcast(X), n=n)
@@ -0,0 +1,239 @@
+'''Compress trained dense layers (nn.Linear or Unconstrained) into structured layers.
+
+The LDR layers multiply by M = \sum_k A^k G^T H (B^T)^k, with A = Z_{f_A} and
+B = Z_{f_B} (the shift down with f in the upper right corner; the subdiagonal
+layers start from A = B = Z_0). Since Z_f^n = f I, such an M satisfies
+    M - A M B^T = (1 - f_A f_B) G^T H,
+so the projection of a dense M is: compute its displacement M - A M B^T in
+O(n^2) with two shifts, take its best rank r approximation by randomized SVD,
+and split it into the generators G, H. There's no Sylvester equation to solve:
+the layer's own multiply reconstructs the matrix from G, H. The result is then
+scaled by the least squares multiple, so the error is never worse than that of
+0. Low rank layers are the truncated SVD of the weight. The projection can be
+followed by a short fine-tune of all the parameters (including the
+subdiagonals) with @fine_tune.
+
+Rectangular layers are projected block by block, with the blocks of
+structure.layer.Layer. The last block is zero-padded when the sizes aren't
+multiples of the block size, so it's only approximately recovered.
+'''
+
+import time
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from . import layer as sl
+
+
+# (f_A, f_B, whether the output is flipped) of the operators of the LDR classes
+ldr_operators = {
+    'toeplitz': (0.0, 0.0, False),
+    'toeplitz_corner': (1.0, -1.0, False),
+    'hankel': (1.0, -1.0, True),
+    'subdiagonal': (0.0, 0.0, False),
+}
+
+
+def shift(M, f, dim):
+    """Multiply M by Z_f along dim (-2 for Z_f @ M, -1 for M @ Z_f^T)."""
+    last = M.narrow(dim, M.shape[dim] - 1, 1)
+    return torch.cat((f * last, M.narrow(dim, 0, M.shape[dim] - 1)), dim=dim)
+
+
+def displacement(M, f_A, f_B):
+    """Stein displacement M - Z_{f_A} @ M @ Z_{f_B}^T of M of shape (..., n, n)."""
+    return M - shift(shift(M, f_A, -2), f_B, -1)
+
+
+def low_rank_factors(E, rank, niter=2, oversample=8):
+    """Best rank rank approximation of E (of shape (..., m, n)) by randomized SVD.
+    Returns:
+        U, V: Tensors of shapes (..., rank, m) and (..., rank, n), E ~= U^T V
+    """
+    q = min(rank + oversample, *E.shape[-2:])
+    U, S, V = torch.svd_lowrank(E, q=q, niter=niter)
+    U, S, V = U[..., :rank], S[..., :rank], V[..., :rank]
+    s = S.sqrt().unsqueeze(-2)
+    return (U * s).transpose(-1, -2), (V * s).transpose(-1, -2)
+
+
+def ldr_project(M, rank, f_A=0.0, f_B=0.0, niter=2):
+    """Generators of the matrix \sum_k Z_{f_A}^k G^T H (Z_{f_B}^T)^k closest to M
+    (under the truncation of the displacement).
+    Parameters:
+        M: Tensor of shape (..., n, n)
+        rank: displacement rank
+    Returns:
+        G, H: Tensors of shape (..., rank, n)
+    """
+    E = displacement(M, f_A, f_B) / (1 - f_A * f_B)
+    G, H = low_rank_factors(E, rank, niter)
+    # Pad with zeros if rank > n
+    return F.pad(G, (0, 0, 0, rank - G.shape[-2])), F.pad(H, (0, 0, 0, rank - H.shape[-2]))
+
+
+def dense_weight(module):
+    """(W, b) of nn.Linear or Unconstrained, with forward(x) = x @ W + b."""
+    if isinstance(module, nn.Linear):
+        return module.weight.t(), module.bias
+    return module.to_dense(), module.b
+
+
+def compress(W, class_type, rank, b=None, niter=2, fine_tune_steps=0, **kwargs):
+    """Project the dense map x -> x @ W + b onto a structured layer.
+    Parameters:
+        W: Tensor of shape (layer_size, hidden_size)
+        class_type: 'toeplitz', 'toeplitz_corner', 'hankel', 'subdiagonal' or
+            'low_rank', or their abbreviations
+        rank: displacement rank (or rank for low_rank)
+        b: bias of shape (hidden_size, ), or None
+        fine_tune_steps: number of steps of @fine_tune after the projection
+        kwargs: passed to @fine_tune
+    Returns:
+        layer: structure.layer.Layer of class class_type, on the device and with the dtype of W
+    """
+    cls = sl.class_map[class_type]
+    layer_size, hidden_size = W.shape
+    layer = cls(layer_size=layer_size, hidden_size=hidden_size, r=rank, bias=b is not None).to(W.device, W.dtype)
+    W_ = W.detach().double()
+    with torch.no_grad():
+        if cls.class_type == 'low_rank':
+            H, G = low_rank_factors(W_, rank, niter)
+            G, H = F.pad(G, (0, 0, 0, rank - G.shape[-2])), F.pad(H, (0, 0, 0, rank - H.shape[-2]))
+        else:
+            assert cls.class_type in ldr_operators, f'Compression to {cls.class_type} is not supported'
+            f_A, f_B, flip = ldr_operators[cls.class_type]
+            n = layer.block_size
+            # Blocks M_ij of the matrix of the layer, M_ij = W_ij^T
+            W_ = F.pad(W_, (0, layer.out_blocks * n - hidden_size, 0, layer.in_blocks * n - layer_size))
+            M = W_.reshape(layer.in_blocks, n, layer.out_blocks, n).permute(0, 2, 3, 1)
+            M = M.reshape(layer.block_shape + (n, n))
+            if flip:
+                M = M.flip(-2)
+            G, H = ldr_project(M, rank, f_A, f_B, niter)
+        layer.G.copy_(G)
+        layer.H.copy_(H)
+        # The truncation error of the displacement is amplified by the
+        # reconstruction, so rescale to the closest multiple of the projection
+        W_proj = layer.to_dense().double() - (layer.b.double() if layer.b is not None else 0)
+        scale = (W_proj * W.double()).sum() / (W_proj ** 2).sum().clamp(min=torch.finfo(torch.double).tiny)
+        layer.G.mul_(scale.to(layer.G.dtype))
+        if b is not None:
+            layer.b.copy_(b)
+    if fine_tune_steps > 0:
+        fine_tune(layer, W, b, steps=fine_tune_steps, **kwargs)
+    return layer
+
+
+def fine_tune(layer, W, b=None, x=None, steps=100, lr=1e-3, batch_size=256):
+    """Fit layer(x) to x @ W + b with Adam, on the rows of x if it's given, or
+    on standard Gaussian inputs, for which the expected loss is the squared
+    Frobenius norm of the difference of the weights.
+    Returns:
+        losses: list of the losses, relative to the norm of the target
+    """
+    W, b = W.detach(), b.detach() if b is not None else None
+    optimizer = torch.optim.Adam(layer.parameters(), lr=lr)
+    losses = []
+    for _ in range(steps):
+        if x is None:
+            batch = torch.randn(batch_size, W.shape[0], dtype=W.dtype, device=W.device)
+        else:
+            batch = x[torch.randint(x.shape[0], (min(batch_size, x.shape[0]), ), device=x.device)]
+        target = batch @ W if b is None else batch @ W + b
+        loss = ((layer(batch) - target) ** 2).sum() / (target ** 2).sum()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        losses.append(loss.item())
+    return losses
+
+
+def time_forward(module, x, repeat=20):
+    """Best time in seconds of a forward pass without gradients."""
+    synchronize = torch.cuda.synchronize if x.is_cuda else lambda: None
+    best = float('inf')
+    with torch.no_grad():
+        module(x)
+        for _ in range(repeat):
+            synchronize()
+            start = time.perf_counter()
+            module(x)
+            synchronize()
+            best = min(best, time.perf_counter() - start)
+    return best
+
+
+def compress_model(model, class_type, rank, include=None, fine_tune_steps=0, batch_size=64, verbose=True, **kwargs):
+    """Replace the dense layers of model (nn.Linear and Unconstrained) by structured layers, in place.
+    Parameters:
+        model: nn.Module
+        class_type, rank, fine_tune_steps, kwargs: as in @compress
+        include: function (name, module) -> whether to compress this layer, defaults to all
+        batch_size: batch size of the timings in the report
+    Returns:
+        report: list with one dictionary per compressed layer: its name, shape,
+            relative error of the weights (Frobenius norm), number of parameters
+            and inference time (without gradients) before and after
+    """
+    targets = [(name, module) for name, module in model.named_modules()
+               if isinstance(module, (nn.Linear, sl.Unconstrained)) and (include is None or include(name, module))]
+    report = []
+    for name, module in targets:
+        W, b = dense_weight(module)
+        layer = compress(W, class_type, rank, b, fine_tune_steps=fine_tune_steps, **kwargs)
+        with torch.no_grad():
+            error = ((layer.to_dense() - W).norm() / W.norm()).item()
+        x = torch.randn(batch_size, W.shape[0], dtype=W.dtype, device=W.device)
+        # Timed in inference mode, see structure.layer.Layer.freeze
+        row = dict(name=name, shape=tuple(W.shape), error=error,
+                   params=sum(p.numel() for p in module.parameters()),
+                   compressed_params=sum(p.numel() for p in layer.parameters()),
+                   time=time_forward(module, x), compressed_time=time_forward(layer.freeze(), x))
+        layer.unfreeze()
+        report.append(row)
+        parent_name, _, child_name = name.rpartition('.')
+        setattr(model.get_submodule(parent_name), child_name, layer)
+        if verbose:
+            print(f'{name} {row["shape"]} -> {layer.name()}: relative error {error:.3f}, '
+                  f'params {row["params"]} -> {row["compressed_params"]}, '
+                  f'time {row["time"] * 1e6:.0f}us -> {row["compressed_time"] * 1e6:.0f}us '
+                  f'(speedup {row["time"] / row["compressed_time"]:.2f}x)')
+    return report
+
+
+def test_compress():
+    torch.manual_seed(0)
+    rank = 2
+    for class_type in ['t', 'tc', 'h', 'sd', 'lr']:
+        for layer_size, hidden_size in [(64, 64), (64, 128), (128, 64), (64, 150)]:
+            # A random layer of the class is recovered exactly, except when the last block is truncated
+            source = sl.StructuredLinear(class_type, layer_size=layer_size, hidden_size=hidden_size, r=rank).double()
+            with torch.no_grad():
+                W = source.to_dense()
+                layer = compress(W, class_type, rank, source.b)
+                x = torch.randn(5, layer_size, dtype=torch.double)
+                # These max relative differences should be small
+                error = ((layer.to_dense() - W).norm() / W.norm()).item()
+                error_forward = ((layer(x) - source(x)).abs().max() / source(x).abs().max()).item()
+            print(class_type, layer_size, hidden_size, error, error_forward)
+    # Projection of a dense matrix then fine-tuning: the error should decrease
+    W = torch.randn(64, 64) / 8 + sl.StructuredLinear('t', layer_size=64, r=2).to_dense().detach()
+    layer = compress(W, 'sd', 4)
+    error = ((layer.to_dense() - W).norm() / W.norm()).item()
+    losses = fine_tune(layer, W, steps=50, lr=1e-2)
+    print(error, losses[0] ** 0.5, losses[-1] ** 0.5)
+
+
+def compress_benchmark(layer_size=1024, rank=4):
+    """Compress an MLP with two dense hidden layers to each class and report the trade-offs."""
+    for class_type in ['t', 'sd', 'lr']:
+        model = nn.Sequential(nn.Linear(layer_size, layer_size), nn.ReLU(), nn.Linear(layer_size, layer_size))
+        compress_model(model, class_type, rank)
+
+
+if __name__ == '__main__':
+    test_compress()
+    compress_benchmark()
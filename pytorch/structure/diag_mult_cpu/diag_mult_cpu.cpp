@@ -0,0 +1,59 @@
+#include <algorithm>
+#include <torch/extension.h>
+
+// Same operation as subdiagMult in diag_mult_cuda_kernel.cu:
+// output[b, pos] = subdiag[b * subdiagOffset + (pos + shiftSubdiag) mod N] * v[b, (pos + shiftV) mod N].
+// Each row is split into the (at most 3) contiguous segments on which neither
+// index wraps around, so the inner loop has no modulo and can be vectorized.
+template <typename scalar_t>
+void subdiagMultCPU(const scalar_t *subdiag, const scalar_t *data, scalar_t *output, int64_t shiftSubdiag, int64_t shiftV,
+                    int64_t batchSize, int64_t N, bool batchedSubdiag) {
+  const int64_t subdiagOffset = batchedSubdiag ? N : 0;
+  shiftSubdiag = ((shiftSubdiag % N) + N) % N;
+  shiftV = ((shiftV % N) + N) % N;
+  #pragma omp parallel for if (batchSize > 1 && batchSize * N >= (1 << 14))
+  for (int64_t b = 0; b < batchSize; ++b) {
+    const scalar_t *sub = subdiag + b * subdiagOffset;
+    const scalar_t *src = data + b * N;
+    scalar_t *dst = output + b * N;
+    int64_t pos = 0;
+    while (pos < N) {
+      const int64_t posSubdiag = (pos + shiftSubdiag) % N;
+      const int64_t posV = (pos + shiftV) % N;
+      const int64_t len = std::min({N - pos, N - posSubdiag, N - posV});
+      const scalar_t *s = sub + posSubdiag;
+      const scalar_t *x = src + posV;
+      scalar_t *y = dst + pos;
+      #pragma omp simd
+      for (int64_t i = 0; i < len; ++i) {
+        y[i] = s[i] * x[i];
+      }
+      pos += len;
+    }
+  }
+}
+
+torch::Tensor cycle_mult(torch::Tensor subdiag, torch::Tensor v, int64_t shiftSubdiag, int64_t shiftV) {
+  TORCH_CHECK(subdiag.device().is_cpu(), "subdiag must be a CPU tensor");
+  TORCH_CHECK(v.device().is_cpu(), "v must be a CPU tensor");
+  TORCH_CHECK(subdiag.scalar_type() == v.scalar_type(), "subdiag and v must have the same dtype");
+  subdiag = subdiag.contiguous();
+  v = v.contiguous();
+  auto n = v.sizes().back();
+  auto batchSize = v.numel() / n;
+  auto output = torch::empty_like(v);
+  bool batchedSubdiag = subdiag.numel() == v.numel();
+  TORCH_CHECK(batchedSubdiag || subdiag.numel() == n, "subdiag must have n or v.numel() elements");
+  if (n == 0) {
+    return output;
+  }
+  AT_DISPATCH_FLOATING_TYPES(v.scalar_type(), "cycle_mult", ([&] {
+    subdiagMultCPU<scalar_t>(subdiag.data_ptr<scalar_t>(), v.data_ptr<scalar_t>(), output.data_ptr<scalar_t>(),
+                             shiftSubdiag, shiftV, batchSize, n, batchedSubdiag);
+  }));
+  return output;
+}
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+  m.def("cycle_mult", &cycle_mult, "Cycle the vector and then do a pointwise multiplication. Shift should be between -n and n - 1.");
+}
@@ -1,18 +1,110 @@
-from .hadamard import hadamard_transform
+'''Multiply by Fastfood matrices S H G P H B (Le et al. 2013), where S, G, B
+are diagonal, P is a permutation and H is the Hadamard matrix.
+
+To map n inputs to more than n outputs, k blocks with their own S, G, B, P are
+stacked vertically (the input is shared), and the output can be truncated to
+any size. Inputs of size smaller than n are zero-padded.
+'''
+
+from .hadamard import hadamard_transform, hadamard_transform_kernel_
+from .complex_utils import to_compute_dtype
 import torch
 import numpy as np
 from scipy.linalg import hadamard
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-# S,G,B: diagonal
-# P: permutation
-# x: batch_size x n_features
-def fastfood_multiply(S,G,B,P,x):
-    HBx = hadamard_transform(B*x)
-    PHBx = HBx[:, P]
-    HGPHBx = hadamard_transform(G*PHBx)
-    return S*HGPHBx
+
+class FastfoodMultiply(torch.autograd.Function):
+    """Fused multiplication by k stacked Fastfood blocks.
+    The forward pass allocates two buffers of shape (batch_size, k, n) besides
+    the output: H B x is computed in place in the first, the permutation is
+    gathered into the second (which is saved as P H B x), and H G P H B x is
+    computed in place in the first one again.
+    Backward, with w = P H B x, h = H G w and grad wrt S h being g:
+        dS = \sum_b g * h
+        dG = \sum_b H (S g) * w
+        dB = \sum_b (H P^T (G H (S g))) * x, and dx = \sum_k B * H P^T (G H (S g))
+    """
+    @staticmethod
+    def forward(ctx, S, G, B, P, x, out_size):
+        batch_size, in_size = x.shape
+        k, n = S.shape
+        u = x.new_zeros(batch_size, k, n) if in_size < n else x.new_empty(batch_size, k, n)
+        torch.mul(x.unsqueeze(1), B[:, :in_size], out=u[..., :in_size])
+        hadamard_transform_kernel_(u)
+        w = torch.gather(u, -1, P.expand(batch_size, k, n))
+        h = hadamard_transform_kernel_(torch.mul(w, G, out=u))
+        out = h.view(batch_size, k * n)[:, :out_size] * S.view(k * n)[:out_size]
+        ctx.out_size = out_size
+        ctx.save_for_backward(S, G, B, P, x, w, h)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad):
+        S, G, B, P, x, w, h = ctx.saved_tensors
+        need_S, need_G, need_B, _, need_x = ctx.needs_input_grad[:5]
+        dS = dG = dB = dx = None
+        batch_size, in_size = x.shape
+        k, n = S.shape
+        g = grad.new_zeros(batch_size, k * n)
+        g[:, :ctx.out_size] = grad
+        g = g.view(batch_size, k, n)
+        if need_S:
+            dS = (g * h).sum(dim=0)
+        if not (need_G or need_B or need_x):
+            return dS, dG, dB, None, dx, None
+        dz = hadamard_transform_kernel_(g.mul_(S))
+        if need_G:
+            dG = (dz * w).sum(dim=0)
+        P_inverse = torch.argsort(P, dim=-1)
+        du = hadamard_transform_kernel_(torch.gather(dz.mul_(G), -1, P_inverse.expand(batch_size, k, n)))
+        du = du[..., :in_size]
+        if need_B:
+            dB = B.new_zeros(k, n)
+            dB[:, :in_size] = (du * x.unsqueeze(1)).sum(dim=0)
+        if need_x:
+            dx = (du * B[:, :in_size]).sum(dim=1)
+        return dS, dG, dB, None, dx, None
+
+
+def fastfood_multiply(S, G, B, P, x, out_size=None):
+    """Multiply by the stacked Fastfood matrix [S_1 H G_1 P_1 H B_1; ...; S_k H G_k P_k H B_k].
+    Uses a fused implementation with a hand-written backward pass (@FastfoodMultiply).
+    Parameters:
+        S, G, B: Tensors of shape (n, ) or (k, n), the diagonals of the k blocks. n must be a power of 2.
+        P: LongTensor of shape (n, ) or (k, n), the permutations of the k blocks
+        x: Tensor of shape (batch_size, in_size), with in_size <= n. It's zero-padded to size n.
+        out_size: number of outputs to keep, at most k * n. Defaults to k * n.
+    Returns:
+        product: Tensor of shape (batch_size, out_size)
+    """
+    n = S.shape[-1]
+    assert n == 1 << int(np.log2(n)), 'n must be a power of 2'
+    assert x.shape[-1] <= n, 'input size must be at most n'
+    S, G, B, P = (t.reshape(-1, n) for t in (S, G, B, P))
+    assert S.shape == G.shape == B.shape == P.shape, 'S, G, B, P must have the same shape'
+    k = S.shape[0]
+    out_size = k * n if out_size is None else out_size
+    assert out_size <= k * n, 'out_size must be at most k * n'
+    # The Hadamard transforms sum n terms, so run them in at least single precision
+    S, G, B, x_ = to_compute_dtype(S, G, B, x)
+    return FastfoodMultiply.apply(S, G, B, P, x_, out_size).to(x.dtype)
+
+
+def fastfood_multiply_slow(S, G, B, P, x, out_size=None):
+    """Same as @fastfood_multiply, one step at a time with autograd.
+    """
+    n = S.shape[-1]
+    S, G, B, P = (t.reshape(-1, n) for t in (S, G, B, P))
+    k = S.shape[0]
+    x = torch.nn.functional.pad(x, (0, n - x.shape[-1]))
+    HBx = hadamard_transform(B * x.unsqueeze(1))
+    PHBx = torch.gather(HBx, -1, P.expand_as(HBx))
+    HGPHBx = hadamard_transform(G * PHBx)
+    out = (S * HGPHBx).reshape(x.shape[0], k * n)
+    return out if out_size is None else out[:, :out_size]
+
 
 def test_fastfood_multiply(n, batch_size):
     S = np.random.randn(n)
@@ -34,8 +126,53 @@ def test_fastfood_multiply(n, batch_size):
 
     output = fastfood_multiply(S,G,B,P,x)
 
-    print(np.linalg.norm(output_explicit - output))
+    print(np.linalg.norm(output_explicit - output.cpu().numpy()))
+
+
+def test_fastfood_multiply_stacked(n, batch_size, k=3, in_size=None, out_size=None):
+    in_size = n if in_size is None else in_size
+    S, G, B = (torch.randn(k, n, dtype=torch.double, device=device, requires_grad=True) for _ in range(3))
+    P = torch.stack([torch.randperm(n, device=device) for _ in range(k)])
+    x = torch.randn(batch_size, in_size, dtype=torch.double, device=device, requires_grad=True)
+    output = fastfood_multiply(S, G, B, P, x, out_size)
+    output_slow = fastfood_multiply_slow(S, G, B, P, x, out_size)
+    grad = torch.autograd.grad(output.sum(), (S, G, B, x))
+    grad_slow = torch.autograd.grad(output_slow.sum(), (S, G, B, x))
+    # These max differences should be small
+    print((output - output_slow).abs().max().item())
+    print(max((g - g_slow).abs().max().item() for g, g_slow in zip(grad, grad_slow)))
+
+
+def fastfood_benchmark(n=1 << 12, batch_size=256, k=2, repeat=20, out_sizes=(10, 1 << 9, 1 << 11, 1 << 12)):
+    """Time the forward and backward passes of the fused and the step by step
+    implementations, and of one truncated Fastfood block against a dense layer
+    (as in the heads of models.nets.output_layer) for each of out_sizes.
+    """
+    import time
+
+    def timeit(name, f, *inputs):
+        f(*inputs).sum().backward()
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            f(*inputs).sum().backward()
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        print(f'{name}: {(time.perf_counter() - start) / repeat * 1e3:.3f}ms')
+
+    S, G, B = (torch.randn(k, n, device=device, requires_grad=True) for _ in range(3))
+    P = torch.stack([torch.randperm(n, device=device) for _ in range(k)])
+    x = torch.randn(batch_size, n, device=device, requires_grad=True)
+    for name, f in [('fused', fastfood_multiply), ('slow', fastfood_multiply_slow)]:
+        timeit(name, f, S, G, B, P, x)
+    for out_size in out_sizes:
+        W = torch.randn(out_size, n, device=device, requires_grad=True)
+        timeit(f'fastfood {n} -> {out_size}', fastfood_multiply, S[0], G[0], B[0], P[0], x, out_size)
+        timeit(f'dense {n} -> {out_size}', torch.nn.functional.linear, x, W)
+
 
 # TODO: move test into subpackage
 if __name__ == '__main__':
     test_fastfood_multiply(128,50)
+    test_fastfood_multiply_stacked(128, 50, k=3, in_size=100, out_size=300)
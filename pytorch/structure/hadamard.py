@@ -18,54 +18,120 @@ except (ImportError, RuntimeError) as e:
     print("CUDA version of Hadamard transform isn't installed. Will use Pytorch's version, which is much slower.")
     use_hadamard_transform_cuda = False
 
+use_hadamard_transform_cpu = True
+try:
+    import hadamard_cpu
+    # import torch.utils.cpp_extension
+    # hadamard_cpu = torch.utils.cpp_extension.load(
+    #     name='hadamard_cpu',
+    #     sources=['hadamard_cpu/hadamard_cpu.cpp'],
+    #     extra_cflags=['-O3', '-fopenmp'],
+    #     extra_ldflags=['-fopenmp'],
+    #     verbose=False
+    #     )
+except (ImportError, RuntimeError):
+    use_hadamard_transform_cpu = False
+
 from scipy.linalg import hadamard
 
+from . import backends
+
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 
+def hadamard_transform_torch_(x):
+    """Unnormalized Hadamard transform of the last dimension of x, in place.
+    At the level with stride h, x is viewed as (..., n / 2h, 2, h) and the two
+    halves of each block are updated with pointwise ops, so nothing is allocated.
+    Parameters:
+        x: contiguous Tensor of shape (..., n), n a power of 2
+    Returns:
+        x
+    """
+    n = x.shape[-1]
+    y = x.view(-1, n)
+    h = 1
+    while h < n:
+        z = y.view(-1, n // (2 * h), 2, h)
+        a, b = z[:, :, 0], z[:, :, 1]
+        a.add_(b)  # a + b
+        b.mul_(-2).add_(a)  # (a + b) - 2b = a - b
+        h *= 2
+    return x
+
+
 def hadamard_transform_torch(u, normalize=False):
     """Multiply H_n @ u where H_n is the Hadamard matrix of dimension n x n.
     n must be a power of 2.
+    The butterflies are done in place on a single copy of u.
     Parameters:
         u: Tensor of shape (..., n)
         normalize: if True, divide the result by 2^{m/2} where m = log_2(n).
     Returns:
         product: Tensor of shape (..., n)
     """
-    batch_size, n = u.shape
+    n = u.shape[-1]
     m = int(np.log2(n))
     assert n == 1 << m, 'n must be a power of 2'
-    x = u[..., np.newaxis]
-    for d in range(m)[::-1]:
-        x = torch.cat((x[..., ::2, :] + x[..., 1::2, :], x[..., ::2, :] - x[..., 1::2, :]), dim=-1)
-    return x.squeeze(-2) / 2**(m / 2) if normalize else x.squeeze(-2)
+    output = hadamard_transform_torch_(u.contiguous().clone())
+    return output.mul_(2**(-m / 2)) if normalize else output
+
+
+def hadamard_transform_kernel(u):
+    """Unnormalized Hadamard transform with the fastest available implementation
+    for the device and dtype of u (CUDA extension, C++ extension, or Pytorch),
+    unless another backend is chosen with structure.backends.use_backend(name, 'hadamard').
+    Doesn't track gradients; use hadamard_transform for that.
+    """
+    with torch.no_grad():
+        return backends.select('hadamard', u, fallback=True)(u.contiguous().clone())
+
 
+def hadamard_transform_kernel_(x):
+    """In-place version of hadamard_transform_kernel, for contiguous x.
+    The CUDA extension isn't in place, so on GPU its output is copied back into x.
+    """
+    with torch.no_grad():
+        out = backends.select('hadamard', x, fallback=True)(x)
+        return out if out is x else x.copy_(out)
+
+
+# Backends of the Hadamard transform of contiguous x, possibly in place, in order of preference
+backends.register('hadamard', 'cuda', lambda x: hadamard_cuda.hadamard_transform(x), devices=('cuda', ),
+                  dtypes=(torch.float, ), available=lambda: use_hadamard_transform_cuda)
+backends.register('hadamard', 'cpp', lambda x: hadamard_cpu.hadamard_transform_(x), devices=('cpu', ),
+                  dtypes=(torch.float, torch.double), available=lambda: use_hadamard_transform_cpu)
+backends.register('hadamard', 'torch', hadamard_transform_torch_)
 
-class HadamardTransformCuda(torch.autograd.Function):
+
+class HadamardTransform(torch.autograd.Function):
     '''The unnormalized Hadamard transform (i.e. without dividing by sqrt(2))
     '''
     @staticmethod
     def forward(ctx, u):
-        return hadamard_cuda.hadamard_transform(u)
+        return hadamard_transform_kernel(u)
 
     @staticmethod
     def backward(ctx, grad):
-        return HadamardTransformCuda.apply(grad)
+        # H_n is symmetric
+        return HadamardTransform.apply(grad)
 
 
-def hadamard_transform_cuda(u, normalize=False):
+def hadamard_transform(u, normalize=False):
     """Multiply H_n @ u where H_n is the Hadamard matrix of dimension n x n.
     n must be a power of 2.
+    Uses the CUDA extension on GPU, the C++ extension on CPU, and the in-place
+    Pytorch version if the extension for the device isn't installed.
     Parameters:
         u: Tensor of shape (..., n)
         normalize: if True, divide the result by 2^{m/2} where m = log_2(n).
     Returns:
         product: Tensor of shape (..., n)
     """
-    _, n = u.shape
+    n = u.shape[-1]
     m = int(np.log2(n))
     assert n == 1 << m, 'n must be a power of 2'
-    output = HadamardTransformCuda.apply(u)
+    output = HadamardTransform.apply(u)
     return output / 2**(m / 2) if normalize else output
 
 
@@ -74,22 +140,42 @@ def test_hadamard_transform():
     n = 1 << m
     batch_size = 50
     u = torch.rand((batch_size, n), requires_grad=True, device=device)
-    result_cuda = hadamard_transform_cuda(u)
-    grad_cuda, = torch.autograd.grad(result_cuda.sum(), u, retain_graph=True)
+    result = hadamard_transform(u)
+    grad, = torch.autograd.grad(result.sum(), u, retain_graph=True)
     result_torch = hadamard_transform_torch(u)
     grad_torch, = torch.autograd.grad(result_torch.sum(), u, retain_graph=True)
     # Explicit construction from scipy
     H = torch.tensor(hadamard(n), dtype=torch.float, device=device)
     result_explicit = u @ H.t()
-    print((result_cuda - result_explicit).abs().max().item())
-    print((result_cuda - result_explicit).abs().mean().item())
+    print((result - result_explicit).abs().max().item())
+    print((result - result_explicit).abs().mean().item())
     print((result_torch - result_explicit).abs().max().item())
     print((result_torch - result_explicit).abs().mean().item())
-    print((grad_cuda - grad_torch).abs().max().item())
-    print((grad_cuda - grad_torch).abs().mean().item())
+    print((grad - grad_torch).abs().max().item())
+    print((grad - grad_torch).abs().mean().item())
+    # Arbitrary leading dimensions
+    v = torch.rand((3, 5, 1 << 6), device=device)
+    H = torch.tensor(hadamard(1 << 6), dtype=torch.float, device=device)
+    print((hadamard_transform(v, normalize=True) - v @ H.t() / 8).abs().max().item())
+    print((hadamard_transform_torch(v, normalize=True) - v @ H.t() / 8).abs().max().item())
+
 
+def hadamard_benchmark(log_sizes=(10, 15), batch_size=256, repeat=20):
+    """Time the forward pass of the Pytorch and the extension versions."""
+    import time
+    for m in log_sizes:
+        u = torch.rand((batch_size, 1 << m), device=device)
+        for name, f in [('torch', hadamard_transform_torch), ('kernel', hadamard_transform_kernel)]:
+            f(u)
+            if u.is_cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            for _ in range(repeat):
+                f(u)
+            if u.is_cuda:
+                torch.cuda.synchronize()
+            print(f'n=2^{m}, {name}: {(time.perf_counter() - start) / repeat * 1e3:.3f}ms')
 
-hadamard_transform = hadamard_transform_cuda if use_hadamard_transform_cuda else hadamard_transform_torch
 
 if __name__ == '__main__':
     test_hadamard_transform()
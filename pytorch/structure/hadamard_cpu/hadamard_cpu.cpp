@@ -0,0 +1,57 @@
+#include <cmath>
+#include <torch/extension.h>
+
+// In-place fast Walsh-Hadamard transform of each row of x (batchSize rows of length 2^log2N).
+// Rows are processed in parallel; the butterflies of each level are contiguous so the inner loop vectorizes.
+template <typename scalar_t>
+void fwtBatchCPU(scalar_t *x, int64_t batchSize, int log2N) {
+  const int64_t N = int64_t(1) << log2N;
+  #pragma omp parallel for if (batchSize > 1 && batchSize * N >= (1 << 14))
+  for (int64_t b = 0; b < batchSize; ++b) {
+    scalar_t *row = x + b * N;
+    for (int64_t h = 1; h < N; h *= 2) {
+      for (int64_t i = 0; i < N; i += 2 * h) {
+        scalar_t *lo = row + i;
+        scalar_t *hi = row + i + h;
+        #pragma omp simd
+        for (int64_t j = 0; j < h; ++j) {
+          const scalar_t u = lo[j];
+          const scalar_t v = hi[j];
+          lo[j] = u + v;
+          hi[j] = u - v;
+        }
+      }
+    }
+  }
+}
+
+torch::Tensor hadamard_transform(torch::Tensor x) {
+  TORCH_CHECK(x.device().is_cpu(), "x must be a CPU tensor");
+  auto n = x.size(-1);
+  auto log2N = long(log2(n));
+  TORCH_CHECK(n == 1 << log2N, "n must be a power of 2");
+  auto output = x.clone(at::MemoryFormat::Contiguous);
+  auto batchSize = x.numel() / (1 << log2N);
+  AT_DISPATCH_FLOATING_TYPES(x.scalar_type(), "hadamard_transform", ([&] {
+    fwtBatchCPU<scalar_t>(output.data_ptr<scalar_t>(), batchSize, log2N);
+  }));
+  return output;
+}
+
+torch::Tensor hadamard_transform_(torch::Tensor x) {
+  TORCH_CHECK(x.device().is_cpu(), "x must be a CPU tensor");
+  TORCH_CHECK(x.is_contiguous(), "x must be contiguous");
+  auto n = x.size(-1);
+  auto log2N = long(log2(n));
+  TORCH_CHECK(n == 1 << log2N, "n must be a power of 2");
+  auto batchSize = x.numel() / (1 << log2N);
+  AT_DISPATCH_FLOATING_TYPES(x.scalar_type(), "hadamard_transform_", ([&] {
+    fwtBatchCPU<scalar_t>(x.data_ptr<scalar_t>(), batchSize, log2N);
+  }));
+  return x;
+}
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+  m.def("hadamard_transform", &hadamard_transform, "Fast Hadamard transform");
+  m.def("hadamard_transform_", &hadamard_transform_, "Fast Hadamard transform, in place");
+}
@@ -0,0 +1,16 @@
+from setuptools import setup
+from torch.utils.cpp_extension import CppExtension, BuildExtension
+
+ext_modules = [
+    CppExtension(
+        'hadamard_cpu', [
+            'hadamard_cpu.cpp'
+        ],
+        extra_compile_args=['-O3', '-fopenmp'],
+        extra_link_args=['-fopenmp'])
+]
+
+setup(
+    name='hadamard_cpu',
+    ext_modules=ext_modules,
+    cmdclass={'build_ext': BuildExtension})
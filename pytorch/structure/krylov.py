@@ -6,7 +6,15 @@ This comprises two steps: Krylov(g) @ Krylov(h)^T @ u, which are Krylov
 transpose multiply and Krylov multiply.
 
 For tridiagonal case, we implement the slow multiplication algorithm: construct
-the Krylov matrix then call regular matrix multiply.
+the Krylov matrix then call regular matrix multiply. We also implement a
+blocked algorithm (baby-step giant-step on the powers of the operator) that
+needs m + n / m sequential steps instead of n, with m about sqrt(n) up to 32
+(so about n / 32 steps for large n), and doesn't construct the Krylov matrices.
+It still does O(batch_size * rank * n^2) work, but as a single batched matmul.
+
+The Python loops of the fast multiplies only depend on the shapes, so they
+can be traced (torch.jit.trace) or captured as a single graph (torch.compile)
+for a given shape, see structure.layer.Layer.specialize.
 '''
 
 import functools
@@ -16,8 +24,10 @@ import torch
 from torch.nn import functional as F
 
 from .scratch.krylovslow import krylov_construct
-from .complex_utils import complex_mult, conjugate
+from .complex_utils import complex_mult, conjugate, rfft, irfft, next_fast_len, to_compute_dtype
+from . import backends
 
+use_diag_mult_cuda = True
 try:
     import diag_mult_cuda
     # import torch.utils.cpp_extension
@@ -32,11 +42,30 @@ try:
     #     )
 except (ImportError, RuntimeError) as e:
     print("CUDA version of slow Krylov multiply isn't installed.")
+    use_diag_mult_cuda = False
+
+use_diag_mult_cpu = True
+try:
+    import diag_mult_cpu
+    # import torch.utils.cpp_extension
+    # diag_mult_cpu = torch.utils.cpp_extension.load(
+    #     name='diag_mult_cpu',
+    #     sources=['diag_mult_cpu/diag_mult_cpu.cpp'],
+    #     extra_cflags=['-O3', '-fopenmp'],
+    #     extra_ldflags=['-fopenmp'],
+    #     verbose=False
+    #     )
+except (ImportError, RuntimeError):
+    use_diag_mult_cpu = False
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 ##### Fast multiplication for the subdiagonal case
 
+# Largest number of entries of the intermediate product for which @poly_mult_sum
+# and @poly_mult_sum_backward multiply in the frequency domain with broadcasting
+broadcast_max_numel = 1 << 20
+
 def poly_mult_sum_benchmark(p, q):
     """Multiply and sum two sets of polynomials.
     Parameters:
@@ -62,13 +91,10 @@ def poly_mult_sum_benchmark(p, q):
     n1, n2 = p.shape[1], p.shape[2]
     start = time.perf_counter()
     for _ in range(100):
-        S = torch.cat((torch.cat((q, p)),
-                       torch.zeros((rank + batch_size, p.shape[1], p.shape[2]), dtype=q.dtype, device=q.device)), dim=-1)
-        S_f = torch.rfft(S, 1)
+        S_f = rfft(torch.cat((q, p)), 2 * n2)
         S0_10_f, S1_01_f = S_f[:rank], S_f[rank:rank+batch_size]
-        prod = (S1_01_f[:, np.newaxis, ..., np.newaxis] * S0_10_f[np.newaxis, ..., np.newaxis, :]).sum(dim=2)
-        T_00_f_sum = torch.stack((prod[..., 0, 0] - prod[..., 1, 1], prod[..., 0, 1] + prod[..., 1, 0]), dim=-1)
-        T_00_sum = torch.irfft(T_00_f_sum, 1, signal_sizes=(2 * n2, ))[..., :-1]
+        T_00_f_sum = torch.einsum('bnm,rnm->brm', S1_01_f, S0_10_f)
+        T_00_sum = irfft(T_00_f_sum, 2 * n2)[..., :-1]
         g = torch.autograd.grad(T_00_sum.sum(), (p, q), retain_graph=True)
     torch.cuda.synchronize()
     end = time.perf_counter()
@@ -98,18 +124,13 @@ def poly_mult_sum_backward_benchmark(grad, q):
     end = time.perf_counter()
     print(f'Elapsed time conv1d: {end - start}s.')
 
-    batch_size, rank = grad.shape[0], q.shape[0]
     n1, n2 = q.shape[1], q.shape[2]
     start = time.perf_counter()
     for _ in range(100):
-        dT_00_sum = torch.cat((grad, torch.zeros((batch_size, rank, 1), dtype=grad.dtype, device=grad.device)), dim=-1)
-        dT_00_sum_f = torch.rfft(dT_00_sum, 1)
-        S0_10_f = torch.rfft(torch.cat((q, torch.zeros_like(q)), dim=-1), 1)
-        # dS1_01_f = complex_mult(conjugate(S0_10_f), dT_00_sum_f[:, :, np.newaxis]).sum(dim=1)
-        # Manually doing complex multiply
-        prod = (S0_10_f[..., np.newaxis] * dT_00_sum_f[:, :, np.newaxis, :, np.newaxis, :]).sum(dim=1)
-        dS1_01_f = torch.stack((prod[..., 0, 0] + prod[..., 1, 1], prod[..., 0, 1] - prod[..., 1, 0]), dim=-1)
-        dp = torch.irfft(dS1_01_f, 1, signal_sizes=(2 * n2, ))[:, :, :n2]
+        dT_00_sum_f = rfft(grad, 2 * n2)
+        S0_10_f = rfft(q, 2 * n2)
+        dS1_01_f = torch.einsum('rnm,brm->bnm', conjugate(S0_10_f), dT_00_sum_f)
+        dp = irfft(dS1_01_f, 2 * n2)[:, :, :n2]
         g = torch.autograd.grad(dp.sum(), (grad, q), retain_graph=True)
     torch.cuda.synchronize()
     end = time.perf_counter()
@@ -118,184 +139,368 @@ def poly_mult_sum_backward_benchmark(grad, q):
     return F.conv_transpose1d(grad, q.flip(2), padding=q.shape[-1] - 1)
 
 
-def krylov_transpose_multiply_conv(subdiag, v, u):
-    """Multiply Krylov(A, v_i)^T @ u when A is zero except on the subdiagonal.
-    Use either Pytorch's conv1d or FFT for polynomial multiplication, depending
-    on polynomial degree. This is the fastest implementation.
+def poly_mult_sum(p, q, len_q, n_fft):
+    """Multiply and sum (over n1) two sets of polynomials, of possibly different degrees.
     Parameters:
-        subdiag: Tensor of shape (n - 1, )
-        v: Tensor of shape (rank, n)
-        u: Tensor of shape (batch_size, n)
+        p: (..., batch_size, n1, len_p)
+        q: (..., rank, n1, len_q), or its FFT of size n_fft, of shape (..., rank, n1, n_fft // 2 + 1).
+           If q is real, conv1d is used instead of FFT.
+           The leading dimensions of p and q (if any) must be the same.
+        len_q: number of coefficients of q
+        n_fft: FFT size, at least len_p + len_q - 1
+    Output:
+        o: (..., batch_size, rank, len_p + len_q - 1)
+    """
+    if not q.is_complex():
+        if p.dim() == 3:
+            return F.conv1d(p, q.flip(q.dim() - 1), padding=len_q - 1)
+        # One group per index of the leading dimensions
+        lead, (batch_size, n1, len_p), rank = p.shape[:-3], p.shape[-3:], q.shape[-3]
+        p = p.reshape(-1, batch_size, n1, len_p).transpose(0, 1).reshape(batch_size, -1, len_p)
+        q = q.reshape(-1, n1, len_q)
+        o = F.conv1d(p, q.flip(-1), padding=len_q - 1, groups=q.shape[0] // rank)
+        return o.reshape(batch_size, -1, rank, o.shape[-1]).transpose(0, 1).reshape(lead + (batch_size, rank, -1))
+    # rfft zero-pads to length n_fft, so no need to concatenate zeros
+    p_f = rfft(p, n_fft)
+    if p.shape[-2] == 1:  # Outer product, broadcasting is faster than a matmul with inner dimension 1
+        o_f = p_f * q.transpose(-3, -2)
+    elif p_f.numel() * q.shape[-3] <= broadcast_max_numel:
+        # Small products (e.g. small batches): multiplying with broadcasting and summing is faster than a
+        # complex batched matmul, which allocates and copies each matrix of the batch on CPU
+        o_f = (p_f.unsqueeze(-3) * q.unsqueeze(-4)).sum(dim=-2)
+    else:
+        # Complex einsum, i.e. a batched complex matmul over n1
+        o_f = torch.einsum('...bnm,...rnm->...brm', p_f, q)
+    return irfft(o_f, n_fft)[..., :p.shape[-1] + len_q - 1]
+
+
+def poly_mult_sum_backward(grad, q, len_q, len_p, n_fft):
+    """Backward pass of @poly_mult_sum with respect to p.
+    Parameters:
+        grad: (..., batch_size, rank, len_p + len_q - 1)
+        q: (..., rank, n1, len_q), or its FFT of size n_fft. If q is real,
+           conv_transpose1d is used instead of FFT.
+        len_q: number of coefficients of q
+        len_p: number of coefficients of p
+        n_fft: FFT size, at least len_p + len_q - 1
+    Output:
+        dp: (..., batch_size, n1, len_p)
+    """
+    if not q.is_complex():
+        if grad.dim() == 3:
+            return F.conv_transpose1d(grad, q.flip(q.dim() - 1), padding=len_q - 1)
+        lead, (batch_size, rank, len_o), n1 = grad.shape[:-3], grad.shape[-3:], q.shape[-2]
+        grad = grad.reshape(-1, batch_size, rank, len_o).transpose(0, 1).reshape(batch_size, -1, len_o)
+        q = q.reshape(-1, n1, len_q)
+        dp = F.conv_transpose1d(grad, q.flip(-1), padding=len_q - 1, groups=q.shape[0] // rank)
+        return dp.reshape(batch_size, -1, n1, len_p).transpose(0, 1).reshape(lead + (batch_size, n1, len_p))
+    grad_f = rfft(grad, n_fft)
+    if q.shape[-2] == 1:
+        dp_f = (grad_f * conjugate(q).transpose(-3, -2)).sum(dim=-2, keepdim=True)
+    elif grad_f.numel() * q.shape[-2] <= broadcast_max_numel:
+        dp_f = (grad_f.unsqueeze(-2) * conjugate(q).unsqueeze(-4)).sum(dim=-3)
+    else:
+        dp_f = torch.einsum('...rnm,...brm->...bnm', conjugate(q), grad_f)
+    return irfft(dp_f, n_fft)[..., :len_p]
+
+
+def krylov_precompute(subdiag, v, conv_threshold=0):
+    """Compute the intermediate values of Krylov(A, v_i)^T @ u and
+    \sum_i Krylov(A, v_i) @ w_i that only depend on A and v (and not on u or w).
+    This is the forward pass of @krylov_transpose_multiply specialized to u = 0.
+
+    The recursion merges adjacent blocks of equal size, starting from blocks of
+    size 1. When n isn't a power of 2, some level has an odd number of blocks:
+    the last block is then set aside, and the blocks set aside are merged at
+    the end, from right to left (e.g. 784 = 512 + 256 + 16). The FFTs of these
+    merges have size about len0 + len1 instead of twice the next power of 2, and
+    no padded copy of the input is made.
+    Parameters:
+        subdiag: Tensor of shape (n - 1, ), or (..., n - 1) for a batch of operators
+        v: Tensor of shape (rank, n), or (..., rank, n) with the same leading dimensions as subdiag
+        conv_threshold: polynomial multiplications where both polynomials have
+            at most this many coefficients are done with conv1d later, so their
+            FFT isn't taken.
     Returns:
-        product: Tensor of shape (batch_size, rank, n)
+        precomputed: tuple (levels, merges).
+            levels: list with one entry per level of the recursion, from the
+                smallest blocks up. Entry is (S0_10_mult_subdiag, S0_11_mult_subdiag, odd):
+                S0_10_mult_subdiag has shape (..., rank, n1, n2), or is its FFT of size
+                2 * n2, of shape (..., rank, n1, n2 + 1); S0_11_mult_subdiag has shape
+                (..., n1); odd is whether the last block was set aside at this level.
+            merges: list with one entry per merge of the blocks set aside, from
+                right to left. Entry is (S0_10_mult_subdiag, S0_11_mult_subdiag, len0):
+                S0_10_mult_subdiag has shape (..., rank, 1, len0), or is its FFT of size
+                next_fast_len(len0 + len1 - 1); S0_11_mult_subdiag has shape (...);
+                len0 is the size of the left block.
     """
-    batch_size, n = u.shape
-    rank, n_ = v.shape
+    rank, n = v.shape[-2:]
+    levels, leftovers = [], []
+    T_10 = v[..., np.newaxis]
+    T_11 = torch.ones(subdiag.shape[:-1] + (n, ), dtype=v.dtype, device=v.device)
+    while T_10.shape[-2] > 1:
+        odd = T_10.shape[-2] % 2 == 1
+        if odd:  # The last block has no neighbor to merge with at this level
+            leftovers.append((T_10[..., -1, :], T_11[..., -1]))
+            T_10, T_11 = T_10[..., :-1, :], T_11[..., :-1]
+        n1, n2 = T_10.shape[-2] // 2, T_10.shape[-1]
+        S_10, S_11 = T_10, T_11
+        subdiag_mid = subdiag[..., (n2 - 1):(2 * n1 * n2):(2 * n2)]
+        S0_10_mult_subdiag = S_10[..., ::2, :] * subdiag_mid[..., np.newaxis, :, np.newaxis]
+        T_10 = torch.cat((S_10[..., 1::2, :], S0_10_mult_subdiag * S_11[..., np.newaxis, 1::2, np.newaxis]), dim=-1)
+        S0_11_mult_subdiag = S_11[..., ::2] * subdiag_mid
+        T_11 = S0_11_mult_subdiag * S_11[..., 1::2]
+        if n2 > conv_threshold:
+            S0_10_mult_subdiag = rfft(S0_10_mult_subdiag, 2 * n2)
+        levels.append((S0_10_mult_subdiag, S0_11_mult_subdiag, odd))
+    # Blocks from left to right are the result of the levels, then the blocks
+    # set aside, in reverse order. Merge them from right to left.
+    blocks = [(T_10[..., 0, :], T_11[..., 0])] + leftovers[::-1]
+    T_10, T_11 = blocks.pop()
+    merges = []
+    while blocks:
+        S_10, S_11 = blocks.pop()
+        len0, len1 = S_10.shape[-1], T_10.shape[-1]
+        subdiag_mid = subdiag[..., n - len1 - 1]
+        S0_10_mult_subdiag = S_10 * subdiag_mid[..., np.newaxis, np.newaxis]
+        T_10 = torch.cat((T_10, S0_10_mult_subdiag * T_11[..., np.newaxis, np.newaxis]), dim=-1)
+        S0_11_mult_subdiag = S_11 * subdiag_mid
+        T_11 = S0_11_mult_subdiag * T_11
+        S0_10_mult_subdiag = S0_10_mult_subdiag[..., np.newaxis, :]
+        if max(len0, len1) > conv_threshold:
+            S0_10_mult_subdiag = rfft(S0_10_mult_subdiag, next_fast_len(len0 + len1 - 1))
+        merges.append((S0_10_mult_subdiag, S0_11_mult_subdiag, len0))
+    return levels, merges
+
+
+def krylov_transpose_level(T_01, level, poly_mult=True):
+    """One level of the recursion of @krylov_transpose_multiply_precomputed.
+    Parameters:
+        T_01: Tensor of shape (..., batch_size, n1, n2), the blocks of u
+        level: entry of the levels of krylov_precompute(subdiag, v)
+        poly_mult: whether to compute T_00_sum, which the next levels don't need
+    Returns:
+        T_00_sum: Tensor of shape (..., batch_size, rank, 2 * n2 - 1), to be
+            added to the product from its second entry, or None if not poly_mult
+        T_01: Tensor of shape (..., batch_size, n1 // 2, 2 * n2), the merged blocks of u
+        leftover: Tensor of shape (..., batch_size, n2), the block set aside if n1 is odd, else None
+    """
+    S0_10_mult_subdiag, S0_11_mult_subdiag, odd = level
+    leftover = None
+    if odd:
+        leftover, T_01 = T_01[..., -1, :], T_01[..., :-1, :]
+    n2 = T_01.shape[-1]
+    S_01 = T_01
+    # polynomial multiplications
+    T_00_sum = poly_mult_sum(S_01[..., 1::2, :], S0_10_mult_subdiag, n2, 2 * n2) if poly_mult else None
+    T_01 = torch.cat((S_01[..., ::2, :], S_01[..., 1::2, :] * S0_11_mult_subdiag[..., np.newaxis, :, np.newaxis]), dim=-1)
+    return T_00_sum, T_01, leftover
+
+
+def krylov_transpose_merge(S_01, T_01, merge, poly_mult=True):
+    """One merge of the blocks set aside in @krylov_transpose_multiply_precomputed.
+    Parameters:
+        S_01: Tensor of shape (..., batch_size, len0), the left block of u
+        T_01: Tensor of shape (..., batch_size, len1), the right block of u
+        merge: entry of the merges of krylov_precompute(subdiag, v)
+        poly_mult: whether to compute T_00_sum, which the next merges don't need
+    Returns:
+        T_00_sum: Tensor of shape (..., batch_size, rank, len0 + len1 - 1), to be
+            added to the product from its second entry, or None if not poly_mult
+        T_01: Tensor of shape (..., batch_size, len0 + len1), the merged block of u
+    """
+    S0_10_mult_subdiag, S0_11_mult_subdiag, len0 = merge
+    len1 = T_01.shape[-1]
+    T_00_sum = None
+    if poly_mult:
+        T_00_sum = poly_mult_sum(T_01[..., np.newaxis, :], S0_10_mult_subdiag, len0, next_fast_len(len0 + len1 - 1))
+    T_01 = torch.cat((S_01, T_01 * S0_11_mult_subdiag[..., np.newaxis, np.newaxis]), dim=-1)
+    return T_00_sum, T_01
+
+
+def krylov_transpose_multiply_precomputed(v, precomputed, u):
+    """Multiply Krylov(A, v_i)^T @ u when A is zero except on the subdiagonal,
+    using the values from @krylov_precompute. Only the work that depends on u is done.
+    Parameters:
+        v: Tensor of shape (rank, n), or (..., rank, n) for a batch of operators
+        precomputed: output of krylov_precompute(subdiag, v)
+        u: Tensor of shape (batch_size, n), or (..., batch_size, n); its leading
+           dimensions are broadcast against those of v.
+    Returns:
+        product: Tensor of shape (..., batch_size, rank, n)
+    """
+    batch_size, n = u.shape[-2:]
+    rank, n_ = v.shape[-2:]
     assert n == n_, 'u and v must have the same last dimension'
-    m = int(np.log2(n))
-    assert n == 1 << m, 'n must be a power of 2'
+    levels, merges = precomputed
+    lead = torch.broadcast_shapes(u.shape[:-2], v.shape[:-2])
+    u = u.expand(lead + (batch_size, n))
 
-    result = torch.zeros((batch_size, rank, n), dtype=u.dtype, device=u.device)
-    T_00_sum = u @ v.t()
-    result[:, :, 0] += T_00_sum
+    result = torch.zeros(lead + (batch_size, rank, n), dtype=u.dtype, device=u.device)
+    # T_00_sum = (u[:, np.newaxis, ..., np.newaxis] * v[np.newaxis, ..., np.newaxis]).sum(dim=2)
+    result[..., 0] = u @ v.transpose(-1, -2)
     T_01 = u[..., np.newaxis]
-    T_10 = v[..., np.newaxis]
-    T_11 = torch.ones(n, device=T_00_sum.device)
-    for d in range(m)[::-1]:
-        n1, n2 = 1 << d, 1 << (m - d - 1)
-        S_00_sum, S_01, S_10, S_11 = T_00_sum, T_01, T_10, T_11
-        S0_10_mult_subdiag = S_10[:, ::2] * subdiag[(n2 - 1)::(2 * n2), np.newaxis]
-        # polynomial multiplication
-        # T_00_sum = poly_mult_sum_benchmark(S_01[:, 1::2], S0_10_mult_subdiag)
-        if n2 <= 128:  # Pick between 2 implementations based on polynomial degree n2
-            T_00_sum = F.conv1d(S_01[:, 1::2], S0_10_mult_subdiag.flip(2), padding=n2 - 1)
-        else:
-            S = torch.cat((torch.cat((S0_10_mult_subdiag, S_01[:, 1::2])),
-                           torch.zeros((rank + batch_size, n1, n2), dtype=S_10.dtype, device=S_10.device)), dim=-1)
-            S_f = torch.rfft(S, 1)
-            S0_10_f, S1_01_f = S_f[:rank], S_f[rank:rank+batch_size]
-            # Different ways to compute the same expression, for speed vs readability
-            # Option 1: call complex_mult, slowest
-            # T_00_f_sum = complex_mult(S1_01_f[:, np.newaxis], S0_10_f[np.newaxis]).sum(dim=2)
-            # Option 2: multiply and sum
-            # prod = (S1_01_f[:, np.newaxis, ..., np.newaxis] * S0_10_f[np.newaxis, ..., np.newaxis, :]).sum(dim=2)
-            # Option 3: einsum
-            prod = torch.einsum('bnmo,rnmp->brmop', S1_01_f, S0_10_f)
-            # Option 4: manually doing permute and reshape and bmm, only 3% faster than einsum.
-            # temp1 = S1_01_f.permute(2, 0, 3, 1).reshape((-1, batch_size * 2, n1))
-            # temp2 = S0_10_f.permute(2, 1, 0, 3).reshape((-1, n1, rank * 2))
-            # prod = (temp1 @ temp2).reshape((-1, batch_size, 2, rank, 2)).permute(1, 3, 0, 2, 4)
-            T_00_f_sum = torch.stack((prod[..., 0, 0] - prod[..., 1, 1], prod[..., 0, 1] + prod[..., 1, 0]), dim=-1)
-            T_00_sum = torch.irfft(T_00_f_sum, 1, signal_sizes=(2 * n2, ))[..., :-1]
+    leftovers = []
+    for level in levels:
+        T_00_sum, T_01, leftover = krylov_transpose_level(T_01, level)
+        if leftover is not None:
+            leftovers.append(leftover)
         # polynomial additions
-        result[:, :, 1:2*n2] += T_00_sum
-        S0_11_mult_subdiag = S_11[::2] * subdiag[(n2 - 1)::(2 * n2)]
-        T_01 = torch.cat((S_01[:, ::2], S_01[:, 1::2] * S0_11_mult_subdiag[:, np.newaxis]), dim=-1)
-        T_10 = torch.cat((S_10[:, 1::2], S0_10_mult_subdiag * S_11[1::2][:, np.newaxis]), dim=-1)
-        T_11 = S0_11_mult_subdiag * S_11[1::2]
+        result[..., 1:T_00_sum.shape[-1] + 1] += T_00_sum
+    blocks = [T_01[..., 0, :]] + leftovers[::-1]
+    T_01 = blocks.pop()
+    for merge in merges:
+        T_00_sum, T_01 = krylov_transpose_merge(blocks.pop(), T_01, merge)
+        result[..., 1:T_00_sum.shape[-1] + 1] += T_00_sum
     return result
 
 
-def krylov_transpose_multiply(subdiag, v, u):
-    """Multiply Krylov(A, v_i)^T @ u when A is zero except on the subdiagonal.
+def krylov_transpose_multiply_backward(subdiag, v, u, grad, need_v=True):
+    """Backward pass of Krylov(A, v_i)^T @ u with respect to subdiag and v, when
+    A is zero except on the subdiagonal.
+    The part that depends on u is differentiated one level (or merge) of the
+    recursion at a time: the inputs of the levels are just rescaled blocks of u,
+    computed without the polynomial multiplications, and each level is
+    recomputed with autograd by itself. Only the part that doesn't depend on u
+    (@krylov_precompute) is differentiated as a whole, and its memory doesn't
+    grow with the batch size.
     Parameters:
         subdiag: Tensor of shape (n - 1, )
         v: Tensor of shape (rank, n)
         u: Tensor of shape (batch_size, n)
+        grad: Tensor of shape (batch_size, rank, n), gradient with respect to the product
+        need_v: whether to compute dv
     Returns:
-        product: Tensor of shape (batch_size, rank, n)
+        d_subdiag: Tensor of shape (n - 1, )
+        dv: Tensor of shape (rank, n), or None if not need_v
     """
-    batch_size, n = u.shape
-    rank, n_ = v.shape
-    assert n == n_, 'u and v must have the same last dimension'
-    m = int(np.log2(n))
-    assert n == 1 << m, 'n must be a power of 2'
-
-    result = torch.zeros((batch_size, rank, n), dtype=u.dtype, device=u.device)
-    # T_00_sum = (u[:, np.newaxis, ..., np.newaxis] * v[np.newaxis, ..., np.newaxis]).sum(dim=2)
-    T_00_sum = u @ v.t()
-    result[:, :, 0] = T_00_sum
-    T_01 = u[..., np.newaxis]
-    T_10 = v[..., np.newaxis]
-    T_11 = torch.ones(n, device=T_00_sum.device)
-    for d in range(m)[::-1]:
-        n1, n2 = 1 << d, 1 << (m - d - 1)
-        S_01, S_10, S_11 = T_01, T_10, T_11
-        # S0_10 = torch.cat((S_10[:, ::2], torch.zeros_like(S_10[:, ::2])), dim=-1)
-        # S1_01 = torch.cat((S_01[:, 1::2], torch.zeros_like(S_01[:, 1::2])), dim=-1)
-        # S = torch.cat((S0_10, S1_01))
-        S0_10_mult_subdiag = S_10[:, ::2] * subdiag[(n2 - 1)::(2 * n2), np.newaxis]
-        S = torch.cat((torch.cat((S0_10_mult_subdiag, S_01[:, 1::2])),
-                       torch.zeros((rank + batch_size, n1, n2), dtype=S_10.dtype, device=S_10.device)), dim=-1)
-
-        # polynomial multiplications
-        S_f = torch.rfft(S, 1)
-        S0_10_f, S1_01_f = S_f[:rank], S_f[rank:rank+batch_size]
-        # Different ways to compute the same expression, for speed vs readability
-        # Option 1: call complex_mult, slowest
-        # T_00_f_sum = complex_mult(S1_01_f[:, np.newaxis], S0_10_f[np.newaxis]).sum(dim=2)
-        # Option 2: multiply and sum
-        # Manually doing complex multiply, somehow this is faster than Cupy's complex mult
-        # prod = (S1_01_f[:, np.newaxis, ..., np.newaxis] * S0_10_f[np.newaxis, ..., np.newaxis, :]).sum(dim=2)
-        # Option 3: einsum
-        prod = torch.einsum('bnmo,rnmp->brmop', S1_01_f, S0_10_f)
-        # Option 4: manually doing permute and reshape and bmm, only 3% faster than einsum.
-        # temp1 = S1_01_f.permute(2, 0, 3, 1).reshape((-1, batch_size * 2, n1))
-        # temp2 = S0_10_f.permute(2, 1, 0, 3).reshape((-1, n1, rank * 2))
-        # prod = (temp1 @ temp2).reshape((-1, batch_size, 2, rank, 2)).permute(1, 3, 0, 2, 4)
-        # prod = (S1_01_f[:, np.newaxis, ..., np.newaxis] * S0_10_f[np.newaxis, ..., np.newaxis, :]).sum(dim=2)
-        T_00_f_sum = torch.stack((prod[..., 0, 0] - prod[..., 1, 1], prod[..., 0, 1] + prod[..., 1, 0]), dim=-1)
-        T_00_sum = torch.irfft(T_00_f_sum, 1, signal_sizes=(2 * n2, ))[..., :-1]
-
-        # polynomial additions
-        result[:, :, 1:2*n2] += T_00_sum
-        S0_11_mult_subdiag = S_11[::2] * subdiag[(n2 - 1)::(2 * n2)]
-        T_01 = torch.cat((S_01[:, ::2], S_01[:, 1::2] * S0_11_mult_subdiag[:, np.newaxis]), dim=-1)
-        T_10 = torch.cat((S_10[:, 1::2], S0_10_mult_subdiag * S_11[1::2][:, np.newaxis]), dim=-1)
-        T_11 = S0_11_mult_subdiag * S_11[1::2]
+    with torch.enable_grad():
+        subdiag_ = subdiag.detach().requires_grad_()
+        v_ = v.detach().requires_grad_(need_v)
+        levels, merges = krylov_precompute(subdiag_, v_)
+    with torch.no_grad():
+        T_01, level_inputs, leftovers = u[..., np.newaxis], [], []
+        for S0_10_mult_subdiag, S0_11_mult_subdiag, odd in levels:
+            level_inputs.append(T_01)
+            _, T_01, leftover = krylov_transpose_level(T_01, (None, S0_11_mult_subdiag, odd), poly_mult=False)
+            if leftover is not None:
+                leftovers.append(leftover)
+        blocks = [T_01[..., 0, :]] + leftovers[::-1]
+        T_01, merge_inputs = blocks.pop(), []
+        for S0_10_mult_subdiag, S0_11_mult_subdiag, len0 in merges:
+            merge_inputs.append((blocks[-1], T_01))
+            _, T_01 = krylov_transpose_merge(blocks.pop(), T_01, (None, S0_11_mult_subdiag, len0), poly_mult=False)
+
+    def step_backward(step, inputs, params, d_outputs):
+        """Gradients with respect to the inputs and params of one step, only keeping its own graph."""
+        with torch.enable_grad():
+            inputs_ = [t.detach().requires_grad_() for t in inputs]
+            params_ = [t.detach().requires_grad_() for t in params[:2]]
+            outputs = step(*inputs_, (*params_, params[2]))
+            outputs, d_outputs = zip(*[(o, d) for o, d in zip(outputs, d_outputs) if d is not None])
+            d_inputs = torch.autograd.grad(outputs, inputs_ + params_, d_outputs, allow_unused=True)
+        d_params.extend(zip(params[:2], d_inputs[-2:]))
+        return d_inputs[:-2]
+
+    # The output of the last merge isn't used, and the output of each step
+    # gets the gradient of the product from its second entry
+    d_params, dT_01, d_blocks = [], None, []
+    for (S_01, T_01), merge in zip(merge_inputs[::-1], merges[::-1]):
+        len_o = S_01.shape[-1] + T_01.shape[-1] - 1
+        dS_01, dT_01 = step_backward(krylov_transpose_merge, (S_01, T_01), merge, (grad[..., 1:len_o + 1], dT_01))
+        d_blocks.append(dS_01)
+    d_blocks.append(dT_01)
+    dT_01, d_leftovers = d_blocks[0], d_blocks[1:]
+    dT_01 = None if dT_01 is None else dT_01[..., np.newaxis, :]
+    for T_01, level in zip(level_inputs[::-1], levels[::-1]):
+        d_leftover = d_leftovers.pop(0) if level[2] else None
+        len_o = 2 * T_01.shape[-1] - 1
+        dT_01, = step_backward(krylov_transpose_level, (T_01, ), level, (grad[..., 1:len_o + 1], dT_01, d_leftover))
+
+    params, d_params = zip(*[(t, d) for t, d in d_params if d is not None])
+    d_subdiag, *dv = torch.autograd.grad(params, (subdiag_, v_) if need_v else (subdiag_, ), d_params, allow_unused=True)
+    if d_subdiag is None:
+        d_subdiag = torch.zeros_like(subdiag)
+    if not need_v:
+        return d_subdiag, None
+    # result[..., 0] = u @ v^T
+    dv = grad[..., 0].transpose(-1, -2) @ u + (0 if dv[0] is None else dv[0])
+    return d_subdiag, dv
+
+
+def krylov_multiply_precomputed(v, precomputed, w):
+    """Multiply \sum_i Krylov(A, v_i) @ w_i when A is zero except on the subdiagonal,
+    using the values from @krylov_precompute. This is the backward pass of
+    @krylov_transpose_multiply_precomputed with respect to u.
+    Parameters:
+        v: Tensor of shape (rank, n), or (..., rank, n) for a batch of operators
+        precomputed: output of krylov_precompute(subdiag, v)
+        w: Tensor of shape (batch_size, rank, n), or (..., batch_size, rank, n)
+           with the same leading dimensions as v.
+    Returns:
+        product: Tensor of shape (..., batch_size, n)
+    """
+    batch_size, rank, n = w.shape[-3:]
+    rank_, n_ = v.shape[-2:]
+    assert n == n_, 'w and v must have the same last dimension'
+    assert rank == rank_, 'w and v must have the same rank'
+    levels, merges = precomputed
+    lead = w.shape[:-3]
+
+    # Undo the merges of the blocks set aside, from left to right
+    dT_01 = torch.zeros(lead + (batch_size, n), dtype=w.dtype, device=w.device)
+    d_blocks = []
+    for S0_10_mult_subdiag, S0_11_mult_subdiag, len0 in merges[::-1]:
+        len1 = dT_01.shape[-1] - len0
+        d_blocks.append(dT_01[..., :len0])
+        dS1_01 = poly_mult_sum_backward(w[..., 1:len0+len1], S0_10_mult_subdiag, len0, len1,
+                                        next_fast_len(len0 + len1 - 1))
+        dT_01 = dT_01[..., len0:] * S0_11_mult_subdiag[..., np.newaxis, np.newaxis] + dS1_01.squeeze(-2)
+    d_blocks.append(dT_01)
+    dT_01 = d_blocks[0][..., np.newaxis, :]
+    d_leftovers = d_blocks[1:]
+    for S0_10_mult_subdiag, S0_11_mult_subdiag, odd in levels[::-1]:
+        n1, n2 = dT_01.shape[-2], dT_01.shape[-1] // 2
+        dS_01 = torch.empty(lead + (batch_size, 2 * n1, n2), dtype=w.dtype, device=w.device)
+        dS_01[..., ::2, :] = dT_01[..., :n2]
+        dS1_01 = poly_mult_sum_backward(w[..., 1:2*n2], S0_10_mult_subdiag, n2, n2, 2 * n2)
+        dS_01[..., 1::2, :] = dT_01[..., n2:] * S0_11_mult_subdiag[..., np.newaxis, :, np.newaxis] + dS1_01
+        if odd:
+            dS_01 = torch.cat((dS_01, d_leftovers.pop(0)[..., np.newaxis, :]), dim=-2)
+        dT_01 = dS_01
 
-    return result
+    # du = ((dT_00_sum[:, :, np.newaxis] * v[np.newaxis, :, :, np.newaxis]).sum(dim=1) + dT_01).squeeze(dim=-1)
+    du = w[..., 0] @ v + dT_01.squeeze(dim=-1)
+    return du
 
 
-def KTu_traceable(subdiag, v, u):
+def krylov_transpose_multiply_conv(subdiag, v, u, conv_threshold=128):
     """Multiply Krylov(A, v_i)^T @ u when A is zero except on the subdiagonal.
-    (WIP) Written to be traceable by Pytorch 1.0 JIT compiler.
+    Use either Pytorch's conv1d or FFT for polynomial multiplication, depending
+    on polynomial degree. This is the fastest implementation.
     Parameters:
         subdiag: Tensor of shape (n - 1, )
         v: Tensor of shape (rank, n)
         u: Tensor of shape (batch_size, n)
+        conv_threshold: use conv1d at the levels where the polynomial degree n2
+            is at most this, and FFT at the other levels.
     Returns:
         product: Tensor of shape (batch_size, rank, n)
     """
-    batch_size, n = u.shape
-    rank, n_ = v.shape
-    # assert n == n_, 'u and v must have the same last dimension'
-    m = int(np.log2(n))
-    # assert n == 1 << m, 'n must be a power of 2'
+    return krylov_transpose_multiply_precomputed(v, krylov_precompute(subdiag, v, conv_threshold), u)
 
-    # T_00_sum = (u[:, np.newaxis, ..., np.newaxis] * v[np.newaxis, ..., np.newaxis]).sum(dim=2)
-    T_00_sum = u @ v.t()
-    result = T_00_sum.unsqueeze(-1)
-    T_01 = u[..., np.newaxis]
-    T_10 = v[..., np.newaxis]
-    T_11 = torch.ones(n, device=T_00_sum.device)
-    for d in range(m)[::-1]:
-        n1, n2 = 1 << d, 1 << (m - d - 1)
-        S_01, S_10, S_11 = T_01, T_10, T_11
-        # S0_10 = torch.cat((S_10[:, ::2], torch.zeros_like(S_10[:, ::2])), dim=-1)
-        # S1_01 = torch.cat((S_01[:, 1::2], torch.zeros_like(S_01[:, 1::2])), dim=-1)
-        # S = torch.cat((S0_10, S1_01))
-        S0_10_mult_subdiag = S_10[:, ::2] * subdiag[(n2 - 1)::(2 * n2), np.newaxis]
-        S = torch.cat((torch.cat((S0_10_mult_subdiag, S_01[:, 1::2])),
-                       torch.zeros((rank + batch_size, n1, n2), dtype=S_10.dtype, device=S_10.device)), dim=-1)
 
-        # polynomial multiplications
-        S_f = torch.rfft(S, 1)
-        S0_10_f, S1_01_f = S_f[:rank], S_f[rank:rank+batch_size]
-        # Different ways to compute the same expression, for speed vs readability
-        # Option 1: call complex_mult, slowest
-        # T_00_f_sum = complex_mult(S1_01_f[:, np.newaxis], S0_10_f[np.newaxis]).sum(dim=2)
-        # Option 2: multiply and sum
-        # Manually doing complex multiply, somehow this is faster than Cupy's complex mult
-        # prod = (S1_01_f[:, np.newaxis, ..., np.newaxis] * S0_10_f[np.newaxis, ..., np.newaxis, :]).sum(dim=2)
-        # Option 3: einsum
-        prod = torch.einsum('bnmo,rnmp->brmop', S1_01_f, S0_10_f)
-        # Option 4: manually doing permute and reshape and bmm, only 3% faster than einsum.
-        # temp1 = S1_01_f.permute(2, 0, 3, 1).reshape((-1, batch_size * 2, n1))
-        # temp2 = S0_10_f.permute(2, 1, 0, 3).reshape((-1, n1, rank * 2))
-        # prod = (temp1 @ temp2).reshape((-1, batch_size, 2, rank, 2)).permute(1, 3, 0, 2, 4)
-        # prod = (S1_01_f[:, np.newaxis, ..., np.newaxis] * S0_10_f[np.newaxis, ..., np.newaxis, :]).sum(dim=2)
-        T_00_f_sum = torch.stack((prod[..., 0, 0] - prod[..., 1, 1], prod[..., 0, 1] + prod[..., 1, 0]), dim=-1)
-        T_00_sum = torch.irfft(T_00_f_sum, 1, signal_sizes=(2 * n2, ))[..., :-1]
-
-        # polynomial additions
-        result = torch.cat((result[:, :, :1], result[:, :, 1:] + T_00_sum[:, :, :n2 - 1], T_00_sum[:, :, n2 - 1:]), dim=-1)
-        S0_11_mult_subdiag = S_11[::2] * subdiag[(n2 - 1)::(2 * n2)]
-        T_01 = torch.cat((S_01[:, ::2], S_01[:, 1::2] * S0_11_mult_subdiag[:, np.newaxis]), dim=-1)
-        T_10 = torch.cat((S_10[:, 1::2], S0_10_mult_subdiag * S_11[1::2][:, np.newaxis]), dim=-1)
-        T_11 = S0_11_mult_subdiag * S_11[1::2]
-
-    return result
+def krylov_transpose_multiply(subdiag, v, u):
+    """Multiply Krylov(A, v_i)^T @ u when A is zero except on the subdiagonal.
+    n doesn't need to be a power of 2 (see @krylov_precompute).
+    Parameters:
+        subdiag: Tensor of shape (n - 1, )
+        v: Tensor of shape (rank, n)
+        u: Tensor of shape (batch_size, n)
+    Returns:
+        product: Tensor of shape (batch_size, rank, n)
+    """
+    return krylov_transpose_multiply_precomputed(v, krylov_precompute(subdiag, v), u)
 
 
 def krylov_transpose_multiply_old(subdiag, v, u):
@@ -317,18 +522,14 @@ def krylov_transpose_multiply_old(subdiag, v, u):
     T_00 = u[:, np.newaxis, ..., np.newaxis] * v[np.newaxis, ..., np.newaxis]
     T_01 = u[..., np.newaxis]
     T_10 = v[..., np.newaxis]
-    T_11 = torch.ones((n, 1), device=T_00.device)
+    T_11 = torch.ones((n, 1), dtype=T_00.dtype, device=T_00.device)
     for d in range(m)[::-1]:
         n1, n2 = 1 << d, 1 << (m - d - 1)
         S_00, S_01, S_10, S_11 = T_00, T_01, T_10, T_11
-        S0_10 = torch.cat((S_10[:, ::2], torch.zeros_like(S_10[:, ::2])), dim=-1)
-        S1_01 = torch.cat((S_01[:, 1::2], torch.zeros_like(S_01[:, 1::2])), dim=-1)
-        S0_11 = torch.cat((S_11[::2], torch.zeros_like(S_11[::2])), dim=-1)
-        S1_11 = torch.cat((S_11[1::2], torch.zeros_like(S_11[1::2])), dim=-1)
-        S = torch.cat((S0_10, S0_11[np.newaxis], S1_01, S1_11[np.newaxis]))
+        S = torch.cat((S_10[:, ::2], S_11[np.newaxis, ::2], S_01[:, 1::2], S_11[np.newaxis, 1::2]))
 
         # polynomial multiplications
-        S_f = torch.rfft(S, 1)
+        S_f = rfft(S, 2 * n2)
         # S0_10_f, S0_11_f, S1_01_f, S1_11_f = S_f[:rank], S_f[rank], S_f[rank+1:rank+1+batch_size], S_f[-1]
         # T_00_f = complex_mult(S1_01_f[:, np.newaxis], S0_10_f[np.newaxis])
         # T_01_f = complex_mult(S1_01_f, S0_11_f)
@@ -341,7 +542,7 @@ def krylov_transpose_multiply_old(subdiag, v, u):
         # I didn't realize you could just batch all 4 multiplications like this
         T_f = complex_mult(S_f[rank+1:, np.newaxis], S_f[:rank+1])
 
-        T = torch.irfft(T_f, 1, signal_sizes=(2 * n2, )) * subdiag[(n2 - 1)::(2 * n2), np.newaxis]
+        T = irfft(T_f, 2 * n2) * subdiag[(n2 - 1)::(2 * n2), np.newaxis]
         T_00, T_01, T_10, T_11 = T[:batch_size, :rank], T[:batch_size, -1], T[-1, :rank], T[-1, -1]
 
         # polynomial additions
@@ -352,7 +553,7 @@ def krylov_transpose_multiply_old(subdiag, v, u):
     return T_00.squeeze(dim=2).flip(2)
 
 
-def krylov_multiply_conv(subdiag, v, w):
+def krylov_multiply_conv(subdiag, v, w, conv_threshold=128):
     """Multiply \sum_i Krylov(A, v_i) @ w_i when A is zero except on the subdiagonal.
     Since K @ w can be computed by autodiffing K^T @ u, the algorithm is just
     hand-differentiating the code of @krylov_transpose_multiply.
@@ -362,65 +563,21 @@ def krylov_multiply_conv(subdiag, v, w):
         subdiag: Tensor of shape (n - 1, )
         v: Tensor of shape (rank, n)
         w: Tensor of shape (batch_size, rank, n)
+        conv_threshold: use conv_transpose1d at the levels where the polynomial
+            degree n2 is at most this, and FFT at the other levels.
     Returns:
         product: Tensor of shape (batch_size, n)
     """
-    batch_size, rank, n = w.shape
-    rank_, n_ = v.shape
-    assert n == n_, 'w and v must have the same last dimension'
-    assert rank == rank_, 'w and v must have the same rank'
-    m = int(np.log2(n))
-    assert n == 1 << m, 'n must be a power of 2'
-
     # Forward pass. Since K @ w can be computed by autodiffing K^T @ u, we
     # carry out the forward pass K^T @ u for u = 0 here to save the
-    # intermediate values. This code is exactly the same as the function
-    # @krylov_transpose_multiply, specialized to the case where u = 0.
-    save_for_backward = [None] * m
-    T_10 = v[..., np.newaxis]
-    T_11 = torch.ones((n), device=T_10.device)
-    for d in range(m)[::-1]:
-        n1, n2 = 1 << d, 1 << (m - d - 1)
-        S_10, S_11 = T_10, T_11
-        S0_10_mult_subdiag = S_10[:, ::2] * subdiag[(n2 - 1)::(2 * n2), np.newaxis]
-        T_10 = torch.cat((S_10[:, 1::2], S0_10_mult_subdiag * S_11[1::2][:, np.newaxis]), dim=-1)
-        S0_11_mult_subdiag = S_11[::2] * subdiag[(n2 - 1)::(2 * n2)]
-        save_for_backward[d] = S0_10_mult_subdiag, S0_11_mult_subdiag
-        T_11 = S0_11_mult_subdiag * S_11[1::2]
-
-    # Backward pass
-    dT_01 = torch.zeros((batch_size, 1, n), dtype=w.dtype, device=w.device)
-
-    for d in range(m):
-        n1, n2 = 1 << d, 1 << (m - d - 1)
-        S0_10_mult_subdiag, S0_11_mult_subdiag = save_for_backward[d]
-        dS_01 = torch.empty((batch_size, 2 * n1, n2), device=w.device)
-        dS_01[:, ::2] = dT_01[:, :, :n2]
-        # dS1_01 = poly_mult_sum_backward_benchmark(w[:, :, 1:2*n2], S0_10_mult_subdiag)
-        if n2 <= 128:
-            dS1_01 = F.conv_transpose1d(w[:, :, 1:2*n2], S0_10_mult_subdiag.flip(2), padding=n2 - 1)
-        else:
-            dT_00_sum = torch.cat((w[:, :, 1:2*n2], torch.zeros((batch_size, rank, 1), dtype=w.dtype, device=w.device)), dim=-1)
-            dT_00_sum_f = torch.rfft(dT_00_sum, 1)
-            S0_10_f = torch.rfft(torch.cat((S0_10_mult_subdiag, torch.zeros_like(S0_10_mult_subdiag)), dim=-1), 1)
-            # dS1_01_f = complex_mult(conjugate(S0_10_f), dT_00_sum_f[:, :, np.newaxis]).sum(dim=1)
-            # Manually doing complex multiply
-            # prod = (S0_10_f[..., np.newaxis] * dT_00_sum_f[:, :, np.newaxis, :, np.newaxis, :]).sum(dim=1)
-            prod = torch.einsum('rnmo,brmp->bnmop', S0_10_f, dT_00_sum_f)
-            dS1_01_f = torch.stack((prod[..., 0, 0] + prod[..., 1, 1], prod[..., 0, 1] - prod[..., 1, 0]), dim=-1)
-            dS1_01 = torch.irfft(dS1_01_f, 1, signal_sizes=(2 * n2, ))[:, :, :n2]
-        dS_01[:, 1::2] = dT_01[:, :, n2:] * S0_11_mult_subdiag[:, np.newaxis] + dS1_01
-
-        dT_01 = dS_01
-
-    # du = ((dT_00_sum[:, :, np.newaxis] * v[np.newaxis, :, :, np.newaxis]).sum(dim=1) + dT_01).squeeze(dim=-1)
-    du = w[:, :, 0] @ v + dT_01.squeeze(dim=-1)
-    return du
+    # intermediate values, then do the backward pass.
+    return krylov_multiply_precomputed(v, krylov_precompute(subdiag, v, conv_threshold), w)
 
 def krylov_multiply(subdiag, v, w):
     """Multiply \sum_i Krylov(A, v_i) @ w_i when A is zero except on the subdiagonal.
     Since K @ w can be computed by autodiffing K^T @ u, the algorithm is just
     hand-differentiating the code of @krylov_transpose_multiply.
+    n doesn't need to be a power of 2 (see @krylov_precompute).
     Parameters:
         subdiag: Tensor of shape (n - 1, )
         v: Tensor of shape (rank, n)
@@ -428,54 +585,10 @@ def krylov_multiply(subdiag, v, w):
     Returns:
         product: Tensor of shape (batch_size, n)
     """
-    batch_size, rank, n = w.shape
-    rank_, n_ = v.shape
-    assert n == n_, 'w and v must have the same last dimension'
-    assert rank == rank_, 'w and v must have the same rank'
-    m = int(np.log2(n))
-    assert n == 1 << m, 'n must be a power of 2'
-
     # Forward pass. Since K @ w can be computed by autodiffing K^T @ u, we
     # carry out the forward pass K^T @ u for u = 0 here to save the
-    # intermediate values. This code is exactly the same as the function
-    # @krylov_transpose_multiply, specialized to the case where u = 0.
-    save_for_backward = [None] * m
-    T_10 = v[..., np.newaxis]
-    T_11 = torch.ones((n), device=T_10.device)
-    for d in range(m)[::-1]:
-        n1, n2 = 1 << d, 1 << (m - d - 1)
-        S_10, S_11 = T_10, T_11
-        S0_10_mult_subdiag = S_10[:, ::2] * subdiag[(n2 - 1)::(2 * n2), np.newaxis]
-        T_10 = torch.cat((S_10[:, 1::2], S0_10_mult_subdiag * S_11[1::2][:, np.newaxis]), dim=-1)
-        S0_11_mult_subdiag = S_11[::2] * subdiag[(n2 - 1)::(2 * n2)]
-        save_for_backward[d] = S0_10_mult_subdiag, S0_11_mult_subdiag
-        T_11 = S0_11_mult_subdiag * S_11[1::2]
-
-    # Backward pass
-    dT_01 = torch.zeros((batch_size, 1, n), dtype=w.dtype, device=w.device)
-
-    for d in range(m):
-        n1, n2 = 1 << d, 1 << (m - d - 1)
-        S0_10_mult_subdiag, S0_11_mult_subdiag = save_for_backward[d]
-        dS_01 = torch.empty((batch_size, 2 * n1, n2), device=w.device)
-        dS_01[:, ::2] = dT_01[:, :, :n2]
-        dT_00_sum = torch.cat((w[:, :, 1:2*n2], torch.zeros((batch_size, rank, 1), dtype=w.dtype, device=w.device)), dim=-1)
-
-        dT_00_sum_f = torch.rfft(dT_00_sum, 1)
-        S0_10_f = torch.rfft(torch.cat((S0_10_mult_subdiag, torch.zeros_like(S0_10_mult_subdiag)), dim=-1), 1)
-        # dS1_01_f = complex_mult(conjugate(S0_10_f), dT_00_sum_f[:, :, np.newaxis]).sum(dim=1)
-        # Manually doing complex multiply
-        # prod = (S0_10_f[..., np.newaxis] * dT_00_sum_f[:, :, np.newaxis, :, np.newaxis, :]).sum(dim=1)
-        prod = torch.einsum('rnmo,brmp->bnmop', S0_10_f, dT_00_sum_f)
-        dS1_01_f = torch.stack((prod[..., 0, 0] + prod[..., 1, 1], prod[..., 0, 1] - prod[..., 1, 0]), dim=-1)
-        dS1_01 = torch.irfft(dS1_01_f, 1, signal_sizes=(2 * n2, ))[:, :, :n2]
-        dS_01[:, 1::2] = dT_01[:, :, n2:] * S0_11_mult_subdiag[:, np.newaxis] + dS1_01
-
-        dT_01 = dS_01
-
-    # du = ((dT_00_sum[:, :, np.newaxis] * v[np.newaxis, :, :, np.newaxis]).sum(dim=1) + dT_01).squeeze(dim=-1)
-    du = w[:, :, 0] @ v + dT_01.squeeze(dim=-1)
-    return du
+    # intermediate values, then do the backward pass.
+    return krylov_multiply_precomputed(v, krylov_precompute(subdiag, v), w)
 
 def krylov_multiply_by_autodiff(subdiag, v, w):
     """Multiply \sum_i Krylov(A, v_i) @ w_i when A is zero except on the subdiagonal, using Pytorch's autodiff.
@@ -518,17 +631,14 @@ def krylov_multiply_forward_old_(subdiag, v):
 
     save_for_backward = [None] * m
     T_10 = v[..., np.newaxis]
-    T_11 = torch.ones((n, 1), device=T_10.device)
+    T_11 = torch.ones((n, 1), dtype=T_10.dtype, device=T_10.device)
     for d in range(m)[::-1]:
         n1, n2 = 1 << d, 1 << (m - d - 1)
         S_10, S_11 = T_10, T_11
-        S0_10 = torch.cat((S_10[:, ::2], torch.zeros_like(S_10[:, ::2])), dim=-1)
-        S0_11 = torch.cat((S_11[::2], torch.zeros_like(S_11[::2])), dim=-1)
-        S1_11 = torch.cat((S_11[1::2], torch.zeros_like(S_11[1::2])), dim=-1)
-        S = torch.cat((S0_10, S0_11[np.newaxis], S1_11[np.newaxis]))
+        S = torch.cat((S_10[:, ::2], S_11[np.newaxis, ::2], S_11[np.newaxis, 1::2]))
 
         # polynomial multiplications
-        S_f = torch.rfft(S, 1)
+        S_f = rfft(S, 2 * n2)
         # S0_10_f, S0_11_f, S1_11_f = S_f[:rank], S_f[-2], S_f[-1]
         # save_for_backward[d] = (S0_10_f, S0_11_f)
 
@@ -540,7 +650,7 @@ def krylov_multiply_forward_old_(subdiag, v):
         save_for_backward[d] = S_f[:rank+1]
         T_f = complex_mult(S_f[-1], S_f[:rank+1])
 
-        T = torch.irfft(T_f, 1, signal_sizes=(2 * n2, )) * subdiag[(n2 - 1)::(2 * n2), np.newaxis]
+        T = irfft(T_f, 2 * n2) * subdiag[(n2 - 1)::(2 * n2), np.newaxis]
         T_10, T_11 = T[:rank], T[-1]
 
         # polynomial additions
@@ -573,16 +683,16 @@ def krylov_multiply_old(subdiag, v, w):
 
     for d in range(m):
         n1, n2 = 1 << d, 1 << (m - d - 1)
-        dS_00 = torch.empty((batch_size, rank, 2 * n1, n2), device=w.device)
+        dS_00 = torch.empty((batch_size, rank, 2 * n1, n2), dtype=w.dtype, device=w.device)
         dS_00[:, :, ::2] = dT_00[:, :, :, n2:]
         dS_00[:, :, 1::2] = dT_00[:, :, :, n2:]
-        dS_01 = torch.empty((batch_size, 2 * n1, n2), device=w.device)
+        dS_01 = torch.empty((batch_size, 2 * n1, n2), dtype=w.dtype, device=w.device)
         dS_01[:, ::2] = dT_01[:, :, n2:]
 
         dT = torch.cat((dT_00, dT_01[:, np.newaxis]), dim=1)
         dT = dT * subdiag[(n2 - 1)::(2 * n2), np.newaxis]
 
-        dT_f = torch.rfft(dT, 1) / (2 * n2)
+        dT_f = rfft(dT) / (2 * n2)
         # dT_00_f, dT_01_f = dT_f[:, :rank], dT_f[:, -1]
 
         # S0_10_f, S0_11_f = save_for_backward[d]
@@ -590,7 +700,7 @@ def krylov_multiply_old(subdiag, v, w):
 
         dS1_01_f = complex_mult(conjugate(save_for_backward[d]), dT_f).sum(dim=1)
 
-        dS1_01 = torch.irfft(dS1_01_f, 1, signal_sizes=(2 * n2, )) * (2 * n2)
+        dS1_01 = irfft(dS1_01_f, 2 * n2) * (2 * n2)
         dS_01[:, 1::2] = dS1_01[:, :, :n2]
 
         dT_00, dT_01 = dS_00, dS_01
@@ -598,7 +708,7 @@ def krylov_multiply_old(subdiag, v, w):
     du = ((dT_00 * v[np.newaxis, :, :, np.newaxis]).sum(dim=1) + dT_01).squeeze(dim=-1)
     return du
 
-def subdiag_mult_conv(subdiag_A, subdiag_B, G, H, x):
+def subdiag_mult_conv(subdiag_A, subdiag_B, G, H, x, conv_threshold=128):
     """Multiply \sum_i Krylov(A, G_i) @ Krylov(B, H_i) @ x when A and B are zero except on the subdiagonal.
     Uses the fast algorithm.
     Use either Pytorch's conv1d or FFT for polynomial multiplication, depending
@@ -609,24 +719,14 @@ def subdiag_mult_conv(subdiag_A, subdiag_B, G, H, x):
         G: Tensor of shape (rank, n)
         H: Tensor of shape (rank, n)
         x: Tensor of shape (batch_size, n)
+        conv_threshold: largest polynomial degree for which conv1d is used
+            instead of FFT.
     Returns:
         product: Tensor of shape (batch_size, n)
     """
-    rank, n = G.shape
-    batch_size = x.shape[0]
-    # if not power of 2, round everything up
-    # TODO: this can maybe be handled better. also should benchmark how much speed non-po2 FFT loses
-    m = int(np.ceil(np.log2(n)))
-    n_extended = 1 << m
-    if n != n_extended:
-        x = torch.cat((x, torch.zeros(batch_size, n_extended - n, dtype=x.dtype, device=x.device)), dim=-1)
-        G = torch.cat((G, torch.zeros(rank, n_extended - n, dtype=G.dtype, device=G.device)), dim=-1)
-        H = torch.cat((H, torch.zeros(rank, n_extended - n, dtype=H.dtype, device=H.device)), dim=-1)
-        subdiag_A = torch.cat((subdiag_A, torch.zeros(n_extended - n, dtype=subdiag_A.dtype, device=subdiag_A.device)))
-        subdiag_B = torch.cat((subdiag_B, torch.zeros(n_extended - n, dtype=subdiag_B.dtype, device=subdiag_B.device)))
-    KT_out = krylov_transpose_multiply_conv(subdiag_B, H, x)
-    K_out = krylov_multiply_conv(subdiag_A, G, KT_out)
-    return K_out[:, :n] if n != n_extended else K_out
+    subdiag_A, subdiag_B, G, H, x_ = to_compute_dtype(subdiag_A, subdiag_B, G, H, x)
+    KT_out = krylov_transpose_multiply_conv(subdiag_B, H, x_, conv_threshold)
+    return krylov_multiply_conv(subdiag_A, G, KT_out, conv_threshold).to(x.dtype)
 
 
 def subdiag_mult(subdiag_A, subdiag_B, G, H, x):
@@ -641,21 +741,488 @@ def subdiag_mult(subdiag_A, subdiag_B, G, H, x):
     Returns:
         product: Tensor of shape (batch_size, n)
     """
-    rank, n = G.shape
-    batch_size = x.shape[0]
-    # if not power of 2, round everything up
-    # TODO: this can maybe be handled better. also should benchmark how much speed non-po2 FFT loses
-    m = int(np.ceil(np.log2(n)))
-    n_extended = 1 << m
-    if n != n_extended:
-        x = torch.cat((x, torch.zeros(batch_size, n_extended - n, dtype=x.dtype, device=x.device)), dim=-1)
-        G = torch.cat((G, torch.zeros(rank, n_extended - n, dtype=G.dtype, device=G.device)), dim=-1)
-        H = torch.cat((H, torch.zeros(rank, n_extended - n, dtype=H.dtype, device=H.device)), dim=-1)
-        subdiag_A = torch.cat((subdiag_A, torch.zeros(n_extended - n, dtype=subdiag_A.dtype, device=subdiag_A.device)))
-        subdiag_B = torch.cat((subdiag_B, torch.zeros(n_extended - n, dtype=subdiag_B.dtype, device=subdiag_B.device)))
-    KT_out = krylov_transpose_multiply(subdiag_B, H, x)
-    K_out = krylov_multiply(subdiag_A, G, KT_out)
-    return K_out[:, :n] if n != n_extended else K_out
+    subdiag_A, subdiag_B, G, H, x_ = to_compute_dtype(subdiag_A, subdiag_B, G, H, x)
+    KT_out = krylov_transpose_multiply(subdiag_B, H, x_)
+    return krylov_multiply(subdiag_A, G, KT_out).to(x.dtype)
+
+def subdiag_mult_channels(subdiag_A, subdiag_B, G, H, x, conv_threshold=8, precomputed=None, plan=None):
+    """Multiply by a block matrix with in_channels x out_channels blocks, each an
+    LDR matrix with its own subdiagonal operators:
+    out_j = \sum_i \sum_r Krylov(A_ij, G_ijr) @ Krylov(B_ij, H_ijr)^T @ x_i.
+    All the blocks go through the fast algorithm together (see the leading
+    dimensions of @krylov_precompute), with conv1d for small polynomial degrees.
+    Parameters:
+        subdiag_A: Tensor of shape (in_channels, out_channels, n - 1)
+        subdiag_B: Tensor of shape (in_channels, out_channels, n - 1)
+        G: Tensor of shape (in_channels, out_channels, rank, n)
+        H: Tensor of shape (in_channels, out_channels, rank, n)
+        x: Tensor of shape (in_channels, batch_size, n)
+        conv_threshold: largest polynomial degree for which conv1d is used
+            instead of FFT. The grouped conv1d over all the blocks is slower
+            than that of a single block, hence the smaller default.
+        precomputed: optional, output of subdiag_mult_precompute(subdiag_A, subdiag_B, G, H)
+        plan: optional, KrylovPlan(n, rank, batch_size, G.dtype, G.device, lead=(in_channels, out_channels)),
+            used when no gradient is needed
+    Returns:
+        product: Tensor of shape (out_channels, batch_size, n)
+    """
+    if precomputed is None:
+        subdiag_A, subdiag_B, G, H = to_compute_dtype(subdiag_A, subdiag_B, G, H, x)[:4]
+        precomputed = G, H, krylov_precompute(subdiag_A, G, conv_threshold), krylov_precompute(subdiag_B, H, conv_threshold)
+    G, H, precomputed_A, precomputed_B = precomputed
+    x_ = x[:, np.newaxis].to(G.dtype)
+    if plan_applies(plan, precomputed, x_):
+        return plan.multiply(G, precomputed_A, plan.transpose_multiply(H, precomputed_B, x_)).sum(dim=0).to(x.dtype)
+    KT_out = krylov_transpose_multiply_precomputed(H, precomputed_B, x_)
+    return krylov_multiply_precomputed(G, precomputed_A, KT_out).sum(dim=0).to(x.dtype)
+
+def subdiag_mult_groups(subdiag_A, subdiag_B, G, H, x, conv_threshold=8, precomputed=None, plan=None,
+                       sum_groups=False):
+    """Multiply by groups independent LDR matrices with subdiagonal operators:
+    out_g = \sum_r Krylov(A_g, G_gr) @ Krylov(B_g, H_gr)^T @ x_g,
+    or by all of them if x is shared by the groups. All the groups go through
+    the fast algorithm together, as in @subdiag_mult_channels.
+    Parameters:
+        subdiag_A: Tensor of shape (groups, n - 1)
+        subdiag_B: Tensor of shape (groups, n - 1)
+        G: Tensor of shape (groups, rank, n)
+        H: Tensor of shape (groups, rank, n)
+        x: Tensor of shape (groups, batch_size, n), or (batch_size, n) shared by the groups
+        conv_threshold: as in @subdiag_mult_channels
+        precomputed: optional, output of subdiag_mult_precompute(subdiag_A, subdiag_B, G, H)
+        plan: optional, KrylovPlan(n, rank, batch_size, G.dtype, G.device, lead=(groups, )),
+            used when no gradient is needed
+        sum_groups: whether to return the sum of the outputs of the groups
+    Returns:
+        product: Tensor of shape (groups, batch_size, n), or (batch_size, n) if sum_groups
+    """
+    if precomputed is None:
+        subdiag_A, subdiag_B, G, H = to_compute_dtype(subdiag_A, subdiag_B, G, H, x)[:4]
+        precomputed = G, H, krylov_precompute(subdiag_A, G, conv_threshold), krylov_precompute(subdiag_B, H, conv_threshold)
+    G, H, precomputed_A, precomputed_B = precomputed
+    x_ = x.to(G.dtype)
+    if plan_applies(plan, precomputed, x_):
+        out = plan.multiply(G, precomputed_A, plan.transpose_multiply(H, precomputed_B, x_))
+    else:
+        KT_out = krylov_transpose_multiply_precomputed(H, precomputed_B, x_)
+        out = krylov_multiply_precomputed(G, precomputed_A, KT_out)
+    return (out.sum(dim=0) if sum_groups else out).to(x.dtype)
+
+##### Precomputation of the parameter-only part, for inference
+
+def subdiag_mult_precompute(subdiag_A, subdiag_B, G, H):
+    """Compute the part of \sum_i Krylov(A, G_i) @ Krylov(B, H_i) @ x that only
+    depends on the parameters, to be passed to @subdiag_mult_precomputed.
+    Parameters:
+        subdiag_A: Tensor of shape (n - 1, )
+        subdiag_B: Tensor of shape (n - 1, )
+        G: Tensor of shape (rank, n)
+        H: Tensor of shape (rank, n)
+    Returns:
+        precomputed: tuple (G, H, precomputed_A, precomputed_B), in at least single precision.
+    """
+    subdiag_A, subdiag_B, G, H = to_compute_dtype(subdiag_A, subdiag_B, G, H)
+    return G, H, krylov_precompute(subdiag_A, G), krylov_precompute(subdiag_B, H)
+
+
+def subdiag_mult_precomputed(precomputed, x, plan=None):
+    """Multiply \sum_i Krylov(A, G_i) @ Krylov(B, H_i) @ x when A and B are zero except on the subdiagonal.
+    Uses the fast algorithm, with the parameter-only part already computed.
+    Parameters:
+        precomputed: output of subdiag_mult_precompute(subdiag_A, subdiag_B, G, H)
+        x: Tensor of shape (batch_size, n)
+        plan: optional, KrylovPlan(n, rank, batch_size, G.dtype, G.device), used when no gradient is needed
+    Returns:
+        product: Tensor of shape (batch_size, n)
+    """
+    G, H, precomputed_A, precomputed_B = precomputed
+    x_ = x.to(G.dtype)
+    if plan_applies(plan, precomputed, x_):
+        return plan.multiply(G, precomputed_A, plan.transpose_multiply(H, precomputed_B, x_)).to(x.dtype)
+    KT_out = krylov_transpose_multiply_precomputed(H, precomputed_B, x_)
+    return krylov_multiply_precomputed(G, precomputed_A, KT_out).to(x.dtype)
+
+class KrylovPlan:
+    """Shape-only data and workspaces for @krylov_transpose_multiply_precomputed
+    and @krylov_multiply_precomputed, for one shape of inputs. Meant to be
+    created once and reused across calls, e.g. cached by a layer, when no
+    gradient is needed.
+    The recursion is laid out once: the sizes of the levels and merges, and
+    views of preallocated ping-pong buffers for the blocks of each level, and of
+    workspaces for the polynomial multiplications in the frequency domain.
+    Each call then only does the arithmetic, in place, instead of slicing and
+    allocating new Tensors (cat, zeros, FFTs, products) at every level.
+    Parameters:
+        n: size of the operators
+        rank: number of generators
+        batch_size: number of inputs
+        dtype: dtype of the precomputed values (the compute dtype, see @subdiag_mult_precompute)
+        device: device of the precomputed values
+        lead: leading dimensions of the operators (see @krylov_precompute)
+    """
+
+    def __init__(self, n, rank, batch_size, dtype=torch.float, device=device, lead=()):
+        self.n, self.rank, self.batch_size = n, rank, batch_size
+        self.dtype, self.device, self.lead = dtype, torch.device(device), tuple(lead)
+        # Same recursion as krylov_precompute, on the sizes only.
+        # levels: (n1, n2, odd), n1 pairs of blocks of size n2 are merged
+        # merges: (len0, len1, n_fft), the left and right block sizes and the FFT size
+        self.levels, leftovers = [], []
+        n_blocks, n2 = n, 1
+        while n_blocks > 1:
+            odd = n_blocks % 2 == 1
+            if odd:
+                leftovers.append(n2)
+            self.levels.append((n_blocks // 2, n2, odd))
+            n_blocks, n2 = n_blocks // 2, 2 * n2
+        self.main_size = n2
+        blocks = [n2] + leftovers[::-1]
+        len1 = blocks.pop()
+        self.merges = []
+        while blocks:
+            len0 = blocks.pop()
+            self.merges.append((len0, len1, next_fast_len(len0 + len1 - 1)))
+            len1 += len0
+
+        complex_dtype = torch.promote_types(dtype, torch.complex64)
+        def workspace(numel, dtype=dtype):
+            return torch.empty(numel, dtype=dtype, device=device)
+        def view(workspace, *shape):
+            """Contiguous view of the start of the workspace, with the leading dimensions."""
+            shape = self.lead + shape
+            return workspace[:int(np.prod(shape))].view(shape)
+        lead_numel = int(np.prod(self.lead))
+        self.result = torch.empty(self.lead + (batch_size, rank, n), dtype=dtype, device=device)
+        self.merged = torch.empty(self.lead + (batch_size, n), dtype=dtype, device=device)
+        buffers = workspace(lead_numel * batch_size * n), workspace(lead_numel * batch_size * n)
+        # Frequency domain products, for the levels where broadcasting is used (see @poly_mult_sum)
+        max_m = max([n2 + 1 for n1, n2, _ in self.levels
+                     if lead_numel * batch_size * rank * n1 * (n2 + 1) <= broadcast_max_numel], default=0)
+        max_numel = lead_numel * batch_size * rank * n
+        p_f, prod, o_f, o = (workspace(max_numel, complex_dtype), workspace(max_numel, complex_dtype),
+                             workspace(lead_numel * batch_size * rank * max_m, complex_dtype), workspace(max_numel))
+
+        # Views used at each level of krylov_transpose_multiply. The input u is copied to buffers[1].
+        self.transpose_levels = []
+        end = n
+        for i, (n1, n2, odd) in enumerate(self.levels):
+            m = n2 + 1
+            S_01 = view(buffers[(i + 1) % 2], batch_size, 2 * n1 + odd, n2)
+            T_01 = view(buffers[i % 2], batch_size, n1, 2 * n2)
+            level = {'S_01_even': S_01[..., :2*n1:2, :], 'S_01_odd': S_01[..., 1:2*n1:2, :],
+                     'T_01_left': T_01[..., :n2], 'T_01_right': T_01[..., n2:],
+                     'result': self.result[..., 1:2*n2], 'broadcast': m <= max_m}
+            if odd:  # The last block goes directly to its place in merged
+                level['leftover'], level['leftover_merged'] = S_01[..., -1, :], self.merged[..., end - n2:end]
+                end -= n2
+            if level['broadcast']:
+                level['p_f'] = view(p_f, batch_size, n1, m)
+                level['prod'] = view(prod, batch_size, rank, n1, m)
+                level['o_f'] = view(o_f, batch_size, rank, m)
+                level['o'] = view(o, batch_size, rank, 2 * n2)
+            self.transpose_levels.append(level)
+        self.u = view(buffers[1], batch_size, n)
+
+        # Views used at each level of krylov_multiply, in reverse order
+        self.multiply_levels = []
+        for i, (n1, n2, odd) in enumerate(self.levels[::-1]):
+            m = n2 + 1
+            dT_01 = view(buffers[(i + 1) % 2], batch_size, n1, 2 * n2) if i > 0 else self.merged[..., :n2 * 2].unsqueeze(-2)
+            dS_01 = view(buffers[i % 2], batch_size, 2 * n1 + odd, n2)
+            level = {'dT_01_left': dT_01[..., :n2], 'dT_01_right': dT_01[..., n2:],
+                     'dS_01_even': dS_01[..., :2*n1:2, :], 'dS_01_odd': dS_01[..., 1:2*n1:2, :],
+                     'broadcast': m <= max_m}
+            if odd:
+                level['leftover'] = dS_01[..., -1, :]
+            if level['broadcast']:
+                level['grad_f'] = view(o_f, batch_size, rank, m)
+                level['prod'] = view(prod, batch_size, rank, n1, m)
+                level['dp_f'] = view(p_f, batch_size, n1, m)
+                level['dp'] = view(o, batch_size, n1, 2 * n2)
+            self.multiply_levels.append(level)
+        self.dT_01 = dS_01 if self.levels else self.merged.unsqueeze(-2)
+
+    def matches(self, v, u):
+        """Whether the plan is for operators like v, of shape (..., rank, n), and inputs like u, of shape (..., batch_size, n)."""
+        return (v.shape[-2:] == (self.rank, self.n) and u.shape[-2:] == (self.batch_size, self.n)
+                and torch.broadcast_shapes(u.shape[:-2], v.shape[:-2]) == self.lead
+                and v.dtype == self.dtype and v.device == self.device)
+
+    def transpose_multiply(self, v, precomputed, u):
+        """Same as krylov_transpose_multiply_precomputed(v, precomputed, u).
+        The output is a workspace of the plan: it's overwritten by the next call.
+        """
+        levels, merges = precomputed
+        n = self.n
+        result = self.result
+        self.u.copy_(u.expand(self.u.shape))
+        result[..., 0] = self.u @ v.transpose(-1, -2)
+        result[..., 1:].zero_()
+        for (S0_10_mult_subdiag, S0_11_mult_subdiag, _), (n1, n2, odd), level in zip(levels, self.levels, self.transpose_levels):
+            if odd:
+                level['leftover_merged'].copy_(level['leftover'])
+            S1_01 = level['S_01_odd']
+            # polynomial multiplications and additions
+            if level['broadcast'] and S0_10_mult_subdiag.is_complex():
+                p_f = rfft(S1_01, 2 * n2, out=level['p_f'])
+                torch.mul(p_f.unsqueeze(-3), S0_10_mult_subdiag.unsqueeze(-4), out=level['prod'])
+                o = irfft(torch.sum(level['prod'], dim=-2, out=level['o_f']), 2 * n2, out=level['o'])
+                level['result'] += o[..., :-1]
+            else:
+                level['result'] += poly_mult_sum(S1_01, S0_10_mult_subdiag, n2, 2 * n2)
+            level['T_01_left'].copy_(level['S_01_even'])
+            torch.mul(S1_01, S0_11_mult_subdiag[..., np.newaxis, :, np.newaxis], out=level['T_01_right'])
+        # Merge the blocks set aside, from right to left: T_01 = merged[..., n - len1:]. The left
+        # block of each merge is already in place, and the leftmost block isn't needed.
+        for (S0_10_mult_subdiag, S0_11_mult_subdiag, _), (len0, len1, n_fft) in zip(merges, self.merges):
+            T_01 = self.merged[..., n - len1:]
+            result[..., 1:len0+len1] += poly_mult_sum(T_01[..., np.newaxis, :], S0_10_mult_subdiag, len0, n_fft)
+            T_01 *= S0_11_mult_subdiag[..., np.newaxis, np.newaxis]
+        return result
+
+    def multiply(self, v, precomputed, w):
+        """Same as krylov_multiply_precomputed(v, precomputed, w). The output is a new Tensor.
+        """
+        levels, merges = precomputed
+        # Undo the merges of the blocks set aside, from left to right: dT_01 = merged[..., start:].
+        # The gradients of the blocks set aside are left in place in merged.
+        self.merged.zero_()
+        start = 0
+        for (S0_10_mult_subdiag, S0_11_mult_subdiag, _), (len0, len1, n_fft) in zip(merges[::-1], self.merges[::-1]):
+            dS1_01 = poly_mult_sum_backward(w[..., 1:len0+len1], S0_10_mult_subdiag, len0, len1, n_fft)
+            start += len0
+            dT_01 = self.merged[..., start:]
+            dT_01 *= S0_11_mult_subdiag[..., np.newaxis, np.newaxis]
+            dT_01 += dS1_01.squeeze(-2)
+        end = self.main_size
+        for (S0_10_mult_subdiag, S0_11_mult_subdiag, _), (n1, n2, odd), level in zip(levels[::-1], self.levels[::-1], self.multiply_levels):
+            level['dS_01_even'].copy_(level['dT_01_left'])
+            dS1_01 = level['dS_01_odd']
+            torch.mul(level['dT_01_right'], S0_11_mult_subdiag[..., np.newaxis, :, np.newaxis], out=dS1_01)
+            if level['broadcast'] and S0_10_mult_subdiag.is_complex():
+                grad_f = rfft(w[..., 1:2*n2], 2 * n2, out=level['grad_f'])
+                torch.mul(grad_f.unsqueeze(-2), conjugate(S0_10_mult_subdiag).unsqueeze(-4), out=level['prod'])
+                dp = irfft(torch.sum(level['prod'], dim=-3, out=level['dp_f']), 2 * n2, out=level['dp'])
+                dS1_01 += dp[..., :n2]
+            else:
+                dS1_01 += poly_mult_sum_backward(w[..., 1:2*n2], S0_10_mult_subdiag, n2, n2, 2 * n2)
+            if odd:
+                level['leftover'].copy_(self.merged[..., end:end + n2])
+                end += n2
+        du = w[..., 0] @ v
+        du += self.dT_01.squeeze(-1)
+        return du
+
+
+def plan_applies(plan, precomputed, x):
+    """Whether plan (a KrylovPlan or None) can be used with the output of
+    @subdiag_mult_precompute and the input x: the plan doesn't record the
+    operations for autograd, so no gradient must be needed.
+    """
+    if plan is None or not torch.is_grad_enabled():
+        return plan is not None
+    G, H, precomputed_A, precomputed_B = precomputed
+    tensors = [x, G, H]
+    for levels, merges in (precomputed_A, precomputed_B):
+        tensors += [t for level in levels + merges for t in level[:2]]
+    return not any(t.requires_grad for t in tensors)
+
+
+##### Fast multiplication for the subdiagonal case with an upper right corner
+
+def subdiag_corner_precompute(subdiag, v, precomputed):
+    """Compute the terms of the correction of Krylov(A, v_i) for the upper right
+    corner c of A. The powers A^k v for k < n wrap around the corner at most
+    once, so with A_0 the subdiagonal part of A,
+        Krylov(A, v) = Krylov(A_0, v) + c diag(z) T(y),
+    where z[i] = subdiag[0] ... subdiag[i - 1], y = Krylov(A_0, v)^T e_{n-1} is
+    the last row of Krylov(A_0, v), and T(y)[i, k] = y[k - i - 1] for k > i
+    (and 0 otherwise) is strictly upper triangular Toeplitz. The products by
+    T(y) and T(y)^T are convolutions, so the correction costs O(n log n) on top
+    of the fast algorithm for A_0.
+    Parameters:
+        subdiag: Tensor of shape (n - 1, )
+        v: Tensor of shape (rank, n)
+        precomputed: output of krylov_precompute(subdiag, v)
+    Returns:
+        z: Tensor of shape (n, )
+        y_f: complex Tensor of shape (rank, n + 1), the FFT of size 2n of y
+    """
+    n = v.shape[-1]
+    e = torch.zeros((1, n), dtype=v.dtype, device=v.device)
+    e[0, -1] = 1.0
+    y = krylov_transpose_multiply_precomputed(v, precomputed, e)[0]
+    z = torch.cat((torch.ones(1, dtype=subdiag.dtype, device=subdiag.device), subdiag.cumprod(dim=0)))
+    return z, rfft(y, 2 * n)
+
+
+def krylov_corner_transpose_multiply(z, y_f, corner, u, product):
+    """Add the corner term to product = Krylov(A_0, v_i)^T @ u, see @subdiag_corner_precompute.
+    Parameters:
+        z, y_f: output of subdiag_corner_precompute
+        corner: real number or Tensor of shape ()
+        u: Tensor of shape (batch_size, n)
+        product: Tensor of shape (batch_size, rank, n)
+    Returns:
+        product: Tensor of shape (batch_size, rank, n), Krylov(A, v_i)^T @ u
+    """
+    n = u.shape[-1]
+    # (T(y)^T @ a)[k] = \sum_{i < k} y[k - i - 1] a[i], the convolution of y and a, shifted by one
+    conv = irfft(rfft(z * u, 2 * n)[:, np.newaxis] * y_f, 2 * n)[..., :n - 1]
+    return product + corner * F.pad(conv, (1, 0))
+
+
+def krylov_corner_multiply(z, y_f, corner, w, product):
+    """Add the corner term to product = \sum_i Krylov(A_0, v_i) @ w_i, see @subdiag_corner_precompute.
+    Parameters:
+        z, y_f: output of subdiag_corner_precompute
+        corner: real number or Tensor of shape ()
+        w: Tensor of shape (batch_size, rank, n)
+        product: Tensor of shape (batch_size, n)
+    Returns:
+        product: Tensor of shape (batch_size, n), \sum_i Krylov(A, v_i) @ w_i
+    """
+    n = w.shape[-1]
+    # (T(y) @ w)[i] = \sum_m y[m] w[i + 1 + m], the correlation of y and w shifted by one
+    corr = irfft((rfft(w[..., 1:], 2 * n) * y_f.conj()).sum(dim=-2), 2 * n)[..., :n]
+    return product + corner * z * corr
+
+
+def subdiag_mult_corner_precompute(subdiag_A, subdiag_B, G, H, corner_A=0.0, corner_B=0.0):
+    """Compute the part of \sum_i Krylov(A, G_i) @ Krylov(B, H_i) @ x that only
+    depends on the parameters when A and B have upper right corners, to be
+    passed to @subdiag_mult_corner_precomputed.
+    Parameters:
+        subdiag_A: Tensor of shape (n - 1, )
+        subdiag_B: Tensor of shape (n - 1, )
+        G: Tensor of shape (rank, n)
+        H: Tensor of shape (rank, n)
+        corner_A: real number or Tensor of shape ()
+        corner_B: real number or Tensor of shape ()
+    Returns:
+        precomputed: tuple (G, H, precomputed_A, precomputed_B, corner_A, corner_B, terms_A, terms_B),
+            in at least single precision.
+    """
+    subdiag_A, subdiag_B, G, H, corner_A, corner_B = to_compute_dtype(subdiag_A, subdiag_B, G, H, corner_A, corner_B)
+    precomputed_A, precomputed_B = krylov_precompute(subdiag_A, G), krylov_precompute(subdiag_B, H)
+    return (G, H, precomputed_A, precomputed_B, corner_A, corner_B,
+            subdiag_corner_precompute(subdiag_A, G, precomputed_A), subdiag_corner_precompute(subdiag_B, H, precomputed_B))
+
+
+def subdiag_mult_corner_precomputed(precomputed, x):
+    """Multiply \sum_i Krylov(A, G_i) @ Krylov(B, H_i) @ x when A and B are zero
+    except on the subdiagonal and the upper right corner.
+    Uses the fast algorithm, with the parameter-only part already computed.
+    Parameters:
+        precomputed: output of subdiag_mult_corner_precompute(subdiag_A, subdiag_B, G, H, corner_A, corner_B)
+        x: Tensor of shape (batch_size, n)
+    Returns:
+        product: Tensor of shape (batch_size, n)
+    """
+    G, H, precomputed_A, precomputed_B, corner_A, corner_B, terms_A, terms_B = precomputed
+    x_ = x.to(G.dtype)
+    KT_out = krylov_transpose_multiply_precomputed(H, precomputed_B, x_)
+    KT_out = krylov_corner_transpose_multiply(*terms_B, corner_B, x_, KT_out)
+    out = krylov_corner_multiply(*terms_A, corner_A, KT_out, krylov_multiply_precomputed(G, precomputed_A, KT_out))
+    return out.to(x.dtype)
+
+
+def subdiag_mult_corner(subdiag_A, subdiag_B, G, H, x, corner_A=0.0, corner_B=0.0):
+    """Multiply \sum_i Krylov(A, G_i) @ Krylov(B, H_i) @ x when A and B are zero
+    except on the subdiagonal and the upper right corner.
+    Uses the fast algorithm for the subdiagonal parts, with the corrections of
+    @subdiag_corner_precompute, so it's O(n log^2 n) like @subdiag_mult, and
+    the gradients flow to the corners if they are Tensors.
+    Parameters:
+        subdiag_A: Tensor of shape (n - 1, )
+        subdiag_B: Tensor of shape (n - 1, )
+        G: Tensor of shape (rank, n)
+        H: Tensor of shape (rank, n)
+        x: Tensor of shape (batch_size, n)
+        corner_A: real number or Tensor of shape ()
+        corner_B: real number or Tensor of shape ()
+    Returns:
+        product: Tensor of shape (batch_size, n)
+    """
+    return subdiag_mult_corner_precomputed(subdiag_mult_corner_precompute(subdiag_A, subdiag_B, G, H, corner_A, corner_B), x)
+
+
+##### Memory-efficient fast multiplication for the subdiagonal case
+
+class SubdiagMult(torch.autograd.Function):
+    """Multiply \sum_i Krylov(A, G_i) @ Krylov(B, H_i) @ x when A and B are zero except on the subdiagonal.
+    Same as @subdiag_mult, but as a single autograd node: autograd doesn't keep
+    the intermediate values of every level of the recursion. We save the inputs,
+    the parameter-only values from @krylov_precompute (which don't depend on
+    the batch size), and optionally the intermediate KT_out = Krylov(B, H)^T @ x.
+    Backward:
+        dx = Krylov(B, H) @ (Krylov(A, G)^T @ grad)
+        dG_i = J \sum_b Krylov(A', J grad_b) @ KT_out[b, i], where J is the
+            reversal permutation and A' = J A^T J is subdiagonal with the
+            reversed subdiagonal of A (similarly for dH_i).
+        dsubdiag: from <grad, Krylov(A, G) @ KT_out> = <Krylov(A, G)^T @ grad, KT_out>
+            (resp. <dKT_out, Krylov(B, H)^T @ x>), one level of the recursion
+            at a time, see @krylov_transpose_multiply_backward.
+    """
+    @staticmethod
+    def forward(ctx, subdiag_A, subdiag_B, G, H, x, recompute=True):
+        precomputed_A = krylov_precompute(subdiag_A, G)
+        precomputed_B = krylov_precompute(subdiag_B, H)
+        KT_out = krylov_transpose_multiply_precomputed(H, precomputed_B, x)
+        K_out = krylov_multiply_precomputed(G, precomputed_A, KT_out)
+        # The tensors of the precomputed values are saved flat, with the rest of their structure on ctx
+        ctx.structure = [(len(levels), [entry[2] for entry in levels + merges])
+                         for levels, merges in (precomputed_A, precomputed_B)]
+        ctx.save_for_backward(subdiag_A, subdiag_B, G, H, x, None if recompute else KT_out,
+                              *[t for levels, merges in (precomputed_A, precomputed_B)
+                                for entry in levels + merges for t in entry[:2]])
+        return K_out
+
+    @staticmethod
+    def backward(ctx, grad):
+        subdiag_A, subdiag_B, G, H, x, KT_out, *saved = ctx.saved_tensors
+        saved, precomputed = iter(saved), []
+        for num_levels, lasts in ctx.structure:
+            entries = [(next(saved), next(saved), last) for last in lasts]
+            precomputed.append((entries[:num_levels], entries[num_levels:]))
+        precomputed_A, precomputed_B = precomputed
+        need_subdiag_A, need_subdiag_B, need_G, need_H, need_x = ctx.needs_input_grad[:5]
+        d_subdiag_A = d_subdiag_B = dG = dH = dx = None
+        if KT_out is None:  # Recompute the intermediate instead of storing it
+            KT_out = krylov_transpose_multiply_precomputed(H, precomputed_B, x)
+        dKT_out = krylov_transpose_multiply_precomputed(G, precomputed_A, grad)
+        if need_x:
+            dx = krylov_multiply_precomputed(H, precomputed_B, dKT_out)
+        # <grad, Krylov(A, G) @ KT_out> = <Krylov(A, G)^T @ grad, KT_out>
+        if need_subdiag_A:
+            d_subdiag_A, dG = krylov_transpose_multiply_backward(subdiag_A, G, grad, KT_out, need_G)
+        elif need_G:
+            dG = krylov_multiply(subdiag_A.flip(0), grad.flip(-1), KT_out.transpose(0, 1)).flip(-1)
+        # <dKT_out, Krylov(B, H)^T @ x>
+        if need_subdiag_B:
+            d_subdiag_B, dH = krylov_transpose_multiply_backward(subdiag_B, H, x, dKT_out, need_H)
+        elif need_H:
+            dH = krylov_multiply(subdiag_B.flip(0), x.flip(-1), dKT_out.transpose(0, 1)).flip(-1)
+        return d_subdiag_A, d_subdiag_B, dG, dH, dx, None
+
+
+def subdiag_mult_lean(subdiag_A, subdiag_B, G, H, x, recompute=True):
+    """Multiply \sum_i Krylov(A, G_i) @ Krylov(B, H_i) @ x when A and B are zero except on the subdiagonal.
+    Uses the fast algorithm, with a hand-written backward pass that needs much
+    less memory than autodiffing @subdiag_mult (see @SubdiagMult).
+    Parameters:
+        subdiag_A: Tensor of shape (n - 1, )
+        subdiag_B: Tensor of shape (n - 1, )
+        G: Tensor of shape (rank, n)
+        H: Tensor of shape (rank, n)
+        x: Tensor of shape (batch_size, n)
+        recompute: if True, recompute Krylov(B, H)^T @ x in the backward pass
+            instead of storing it (batch_size * rank * n entries).
+    Returns:
+        product: Tensor of shape (batch_size, n)
+    """
+    subdiag_A, subdiag_B, G, H, x_ = to_compute_dtype(subdiag_A, subdiag_B, G, H, x)
+    return SubdiagMult.apply(subdiag_A, subdiag_B, G, H, x_, recompute).to(x.dtype)
 
 ##### Slow multiplication for the subdiagonal case
 
@@ -705,7 +1272,7 @@ def subdiag_linear_map(subdiag, upper_right_corner=0.0):
     """
     n = subdiag.size(0) + 1
     shift_down = torch.arange(-1, n - 1, device=subdiag.device)
-    subdiag_extended = torch.cat((torch.tensor([upper_right_corner], dtype=subdiag.dtype, device=subdiag.device), subdiag))
+    subdiag_extended = torch.cat((torch.as_tensor(upper_right_corner, dtype=subdiag.dtype, device=subdiag.device).reshape(1), subdiag))
     # Pytorch 1.0 has torch.roll that should be much faster
     # return lambda v: subdiag_extended * v.roll(1, dims=-1)
     return lambda v: subdiag_extended * v[..., shift_down]
@@ -731,7 +1298,7 @@ def krylov_subdiag_fast(subdiag, v, upper_right_corner=0.0):
     b = -a
     indices = a[:, np.newaxis] + b[np.newaxis]
     v_circulant = v[:, indices]
-    subdiag_extended = torch.cat((torch.tensor([upper_right_corner], dtype=subdiag.dtype, device=subdiag.device), subdiag))
+    subdiag_extended = torch.cat((torch.as_tensor(upper_right_corner, dtype=subdiag.dtype, device=subdiag.device).reshape(1), subdiag))
     subdiag_circulant = subdiag_extended[indices]
     subdiag_cumprod = subdiag_circulant.cumprod(dim=1)
     K = v_circulant
@@ -782,7 +1349,7 @@ def subdiag_mult_slow(subdiag_A, subdiag_B, G, H, x, corner_A=0.0, corner_B=0.0)
         return ((x @ K_H) @ K_G.transpose(1, 2)).sum(dim=0)
 
 
-def subdiag_mult_slow_fast(subdiag_A, subdiag_B, G, H, x):
+def subdiag_mult_slow_fast(subdiag_A, subdiag_B, G, H, x, corner_A=0.0, corner_B=0.0):
     """Multiply \sum_i Krylov(A, G_i) @ Krylov(B, H_i) @ x when A and B are zero except on the subdiagonal.
     Uses the fast construction of Krylov matrix.
     Parameters:
@@ -794,24 +1361,45 @@ def subdiag_mult_slow_fast(subdiag_A, subdiag_B, G, H, x):
     Returns:
         product: Tensor of shape (batch_size, n)
     """
-    K_G, K_H = krylov_subdiag_fast(subdiag_A, G), krylov_subdiag_fast(subdiag_B, H)
+    K_G, K_H = krylov_subdiag_fast(subdiag_A, G, corner_A), krylov_subdiag_fast(subdiag_B, H, corner_B)
     return ((x @ K_H) @ K_G.transpose(1, 2)).sum(dim=0)
 
 
-class CycleDownMultCuda(torch.autograd.Function):
+def cycle_mult_available(device, dtype=torch.float):
+    """Whether the C++ (on CPU) or CUDA (on GPU) cycle_mult extension can handle tensors of this device and dtype."""
+    if torch.device(device).type == 'cuda':
+        return use_diag_mult_cuda and dtype == torch.float
+    return use_diag_mult_cpu and dtype in (torch.float, torch.double)
+
+
+def cycle_mult(subdiag, v, shift_subdiag, shift_v):
+    """Cycle v by shift_v and subdiag by shift_subdiag, then multiply pointwise.
+    Runs the CUDA kernel for GPU tensors and the C++ (OpenMP) one for CPU tensors.
+    Parameters:
+        subdiag: Tensor of shape (n, ) or of the same shape as v
+        v: Tensor of shape (..., n)
+        shift_subdiag, shift_v: integers between -n and n - 1
+    Returns:
+        product: Tensor of shape (..., n), product[..., i] = subdiag[..., i + shift_subdiag] * v[..., i + shift_v]
+    """
+    extension = diag_mult_cuda if v.is_cuda else diag_mult_cpu
+    return extension.cycle_mult(subdiag, v, shift_subdiag, shift_v)
+
+
+class CycleDownMult(torch.autograd.Function):
     '''Cycle v down and do pointwise multiplication with subdiag.
     '''
     @staticmethod
     def forward(ctx, subdiag, v):
         ctx.save_for_backward(subdiag, v)
-        return diag_mult_cuda.cycle_mult(subdiag, v, 0, -1)
+        return cycle_mult(subdiag, v, 0, -1)
 
     @staticmethod
     def backward(ctx, grad):
         subdiag, v = ctx.saved_tensors
-        return diag_mult_cuda.cycle_mult(grad, v, 0, -1).sum(dim=0), diag_mult_cuda.cycle_mult(subdiag, grad, 1, 1)
+        return cycle_mult(grad, v, 0, -1).sum(dim=0), cycle_mult(subdiag, grad, 1, 1)
 
-cycle_down_mult = CycleDownMultCuda.apply
+cycle_down_mult = CycleDownMult.apply
 
 def test_cycle_down_mult():
     n = 1 << 10
@@ -831,20 +1419,23 @@ def test_cycle_down_mult():
 
 def subdiag_linear_map_cuda(subdiag, upper_right_corner=0.0):
     """Construct the linear map for multiplying with a subdiagonal matrix (possibly with an upper right corner).
-    Uses the construction in CUDA, so it's pretty fast.
+    Uses the cycle_mult extension for the device of subdiag (CUDA on GPU, C++ on CPU), so it's pretty fast.
+    Falls back to the Pytorch version (subdiag_linear_map) if that extension isn't installed.
     Parameters:
         subdiag: (n - 1, )
         upper_right_corner: real number
     Returns:
         linear_map: v -> product, with v of shape either (n, ) or (rank, n)
     """
-    subdiag_extended = torch.cat((torch.tensor([upper_right_corner], dtype=subdiag.dtype, device=subdiag.device), subdiag))
+    if not cycle_mult_available(subdiag.device, subdiag.dtype):
+        return subdiag_linear_map(subdiag, upper_right_corner)
+    subdiag_extended = torch.cat((torch.as_tensor(upper_right_corner, dtype=subdiag.dtype, device=subdiag.device).reshape(1), subdiag))
     return lambda v: cycle_down_mult(subdiag_extended, v)
 
 
 def subdiag_mult_cuda(subdiag_A, subdiag_B, G, H, x, corner_A=0.0, corner_B=0.0):
     """Multiply \sum_i Krylov(A, G_i) @ Krylov(B, H_i) @ x when A and B are zero except on the subdiagonal.
-    Uses the explicit Krylov construction in CUDA.
+    Uses the explicit Krylov construction with the cycle_mult extension (CUDA on GPU, C++ on CPU).
     Parameters:
         subdiag_A: Tensor of shape (n - 1, )
         subdiag_B: Tensor of shape (n - 1, )
@@ -860,6 +1451,27 @@ def subdiag_mult_cuda(subdiag_A, subdiag_B, G, H, x, corner_A=0.0, corner_B=0.0)
 
 ##### Slow multiplication for the tridiagonal case
 
+def tridiag_diags(subdiag, diag, superdiag, upper_right_corner=0.0, lower_left_corner=0.0):
+    """Stack the diagonals of a tridiagonal matrix A (possibly with upper right
+    and lower left corners), so that (A @ v)[i] = \sum_e diags[e + 1, i] * v[(i + e) mod n]
+    for e in {-1, 0, 1}.
+    Parameters:
+        subdiag: (n - 1, )
+        diag: (n, )
+        superdiag: (n - 1, )
+        upper_right_corner: real number or Tensor of shape ()
+        lower_left_corner: real number or Tensor of shape ()
+    Returns:
+        diags: (3, n)
+    """
+    # as_tensor keeps track of the gradient if the corner is a Tensor
+    upper_right_corner = torch.as_tensor(upper_right_corner, dtype=diag.dtype, device=diag.device).reshape(1)
+    lower_left_corner = torch.as_tensor(lower_left_corner, dtype=diag.dtype, device=diag.device).reshape(1)
+    subdiag_extended = torch.cat((upper_right_corner, subdiag))
+    superdiag_extended = torch.cat((superdiag, lower_left_corner))
+    return torch.stack((subdiag_extended, diag, superdiag_extended))
+
+
 def tridiag_linear_map(subdiag, diag, superdiag, upper_right_corner=0.0, lower_left_corner=0.0):
     """Construct the linear map for multiplying with a tridiagonal matrix
     (possibly with upper right and lower left corners).
@@ -880,9 +1492,7 @@ def tridiag_linear_map(subdiag, diag, superdiag, upper_right_corner=0.0, lower_l
     shift_down = shift_none - 1
     shift_up = (shift_none + 1) % n
     shifts = torch.stack((shift_down, shift_none, shift_up))
-    subdiag_extended = torch.cat((torch.tensor([upper_right_corner], dtype=subdiag.dtype, device=subdiag.device), subdiag))
-    superdiag_extended = torch.cat((superdiag, torch.tensor([lower_left_corner], dtype=superdiag.dtype, device=superdiag.device)))
-    diags = torch.stack((subdiag_extended, diag, superdiag_extended))
+    diags = tridiag_diags(subdiag, diag, superdiag, upper_right_corner, lower_left_corner)
     return lambda v: (diags * v[..., shifts]).sum(dim=-2)
 
 
@@ -930,6 +1540,203 @@ def tridiag_mult_slow(subdiag_A, diag_A, superdiag_A, subdiag_B, diag_B, superdi
         return ((x @ K_H) @ K_G.transpose(1, 2)).sum(dim=0)
 
 
+##### Blocked multiplication for the tridiagonal case
+
+def band_shifts(w, n, device=device):
+    """Indices (i + e) mod n for e in [-w, w], of shape (2w + 1, n)."""
+    return (torch.arange(n, device=device) + torch.arange(-w, w + 1, device=device)[:, np.newaxis]) % n
+
+
+def banded_multiply(D, v):
+    """Multiply by a banded matrix (with wraparound) M, where
+    (M @ v)[i] = \sum_{e=-w}^{w} D[w + e, i] * v[(i + e) mod n].
+    A tridiagonal matrix with corners has w = 1, see @tridiag_diags.
+    Parameters:
+        D: (2w + 1, n)
+        v: (..., n)
+    Returns:
+        prod: (..., n)
+    """
+    w = (D.shape[0] - 1) // 2
+    n = D.shape[-1]
+    if w >= n:  # The band wraps around more than once
+        return (D * v[..., band_shifts(w, n, D.device)]).sum(dim=-2)
+    # Windows v[i - w], ..., v[i + w] of the circularly padded v, without copying
+    v_windows = torch.cat((v[..., n - w:], v, v[..., :w]), dim=-1).unfold(-1, 2 * w + 1, 1)
+    return (v_windows * D.t()).sum(dim=-1)
+
+
+def banded_transpose(D):
+    """Band of M^T, for M given by its band D of shape (2w + 1, n) as in @banded_multiply."""
+    w = (D.shape[0] - 1) // 2
+    # M^T[i, i + e] = M[i + e, i] = D[w - e, i + e]
+    return D.flip(0).gather(1, band_shifts(w, D.shape[-1], D.device))
+
+
+def banded_mult(D1, D2):
+    """Band of M1 @ M2, for M1 and M2 given by their bands as in @banded_multiply.
+    Parameters:
+        D1: (2w1 + 1, n)
+        D2: (2w2 + 1, n)
+    Returns:
+        D: (2(w1 + w2) + 1, n)
+    """
+    w1, w2 = (D1.shape[0] - 1) // 2, (D2.shape[0] - 1) // 2
+    n = D1.shape[-1]
+    # (M1 @ M2)[i, i + e1 + e2] = \sum M1[i, i + e1] * M2[i + e1, i + e1 + e2]
+    prod = D1 * D2[:, band_shifts(w1, n, D1.device)]
+    idx = (torch.arange(2 * w2 + 1, device=D1.device)[:, np.newaxis] + torch.arange(2 * w1 + 1, device=D1.device)).flatten()
+    return D1.new_zeros((2 * (w1 + w2) + 1, n)).index_add(0, idx, prod.reshape(-1, n))
+
+
+def banded_power(D, m):
+    """Band of M^m (m >= 1), by repeated squaring."""
+    result = None
+    while m > 0:
+        if m & 1:
+            result = D if result is None else banded_mult(result, D)
+        m >>= 1
+        if m > 0:
+            D = banded_mult(D, D)
+    return result
+
+
+def tridiag_block_size(n, max_block_size=32):
+    """Number m of baby steps for @tridiag_krylov_transpose_multiply and
+    @tridiag_krylov_multiply. There are m + n / m sequential steps, so m is
+    the power of 2 closest to sqrt(n), up to max_block_size: beyond that, the
+    sequential steps are O(n / max_block_size), not O(sqrt(n)). The cap is
+    because squaring the band of A up to A^m takes (m + 1)^2 n entries, i.e.
+    O(n^2) for m = sqrt(n), which also costs more time on CPU than the giant
+    steps it saves (see @tridiag_mult_benchmark).
+    """
+    n = int(n)  # n is a 0-dim Tensor when tracing
+    return max(1, min(1 << int(round(np.log2(n) / 2)), max_block_size, n))
+
+
+def tridiag_giant_steps(diags, v, m, n_giant):
+    """Compute A^{i m} @ v for i < n_giant.
+    Parameters:
+        diags: (3, n), see @tridiag_diags
+        v: (rank, n)
+    Returns:
+        V: (rank, n_giant, n)
+    """
+    diags_m = banded_power(diags, m)
+    V = [v]
+    for _ in range(n_giant - 1):
+        V.append(banded_multiply(diags_m, V[-1]))
+    return torch.stack(V, dim=1)
+
+
+def tridiag_krylov_transpose_multiply(diags, v, u, block_size=None):
+    """Multiply Krylov(A, v_i)^T @ u when A is tridiagonal (possibly with corners).
+    The powers k = i * m + j are split into m baby steps on u and n / m giant
+    steps on v: u^T A^k v = ((A^T)^j u)^T (A^{i m} v), where A^m is banded with
+    2m + 1 diagonals. This takes m + n / m sequential steps instead of n (i.e.
+    n / 32 + 32 for n >= 2^11 with the default m, see @tridiag_block_size), and
+    doesn't construct the (rank, n, n) Krylov matrix.
+    The products of the baby and giant steps are still O(batch_size * rank * n^2)
+    work, done by a single einsum.
+    Parameters:
+        diags: Tensor of shape (3, n), see @tridiag_diags
+        v: Tensor of shape (rank, n)
+        u: Tensor of shape (batch_size, n)
+        block_size: number m of baby steps, defaults to @tridiag_block_size.
+    Returns:
+        product: Tensor of shape (batch_size, rank, n)
+    """
+    batch_size, n = u.shape
+    rank, n_ = v.shape
+    assert n == n_, 'u and v must have the same last dimension'
+    m = tridiag_block_size(n) if block_size is None else block_size
+    n_giant = (n + m - 1) // m
+    diags_T = banded_transpose(diags)
+    U = [u]
+    for _ in range(m - 1):
+        U.append(banded_multiply(diags_T, U[-1]))
+    U = torch.stack(U, dim=1)
+    V = tridiag_giant_steps(diags, v, m, n_giant)
+    result = torch.einsum('bjn,rin->brij', U, V).reshape(batch_size, rank, n_giant * m)
+    return result[..., :n]
+
+
+def tridiag_krylov_multiply(diags, v, w, block_size=None):
+    """Multiply \sum_i Krylov(A, v_i) @ w_i when A is tridiagonal (possibly with corners).
+    Same blocking as @tridiag_krylov_transpose_multiply:
+    \sum_k w_k A^k v = \sum_j A^j (\sum_i w_{i m + j} A^{i m} v), where the
+    outer sum is evaluated with Horner's rule.
+    Parameters:
+        diags: Tensor of shape (3, n), see @tridiag_diags
+        v: Tensor of shape (rank, n)
+        w: Tensor of shape (batch_size, rank, n)
+        block_size: number m of baby steps, defaults to @tridiag_block_size.
+    Returns:
+        product: Tensor of shape (batch_size, n)
+    """
+    batch_size, rank, n = w.shape
+    rank_, n_ = v.shape
+    assert n == n_, 'w and v must have the same last dimension'
+    assert rank == rank_, 'w and v must have the same rank'
+    m = tridiag_block_size(n) if block_size is None else block_size
+    n_giant = (n + m - 1) // m
+    V = tridiag_giant_steps(diags, v, m, n_giant)
+    if n_giant * m != n:
+        w = torch.cat((w, w.new_zeros((batch_size, rank, n_giant * m - n))), dim=-1)
+    Z = torch.einsum('brij,rin->bjn', w.reshape(batch_size, rank, n_giant, m), V)
+    result = Z[:, -1]
+    for j in range(m - 2, -1, -1):
+        result = banded_multiply(diags, result) + Z[:, j]
+    return result
+
+
+def tridiag_mult(subdiag_A, diag_A, superdiag_A, subdiag_B, diag_B, superdiag_B, G, H, x, corners_A=(0.0, 0.0), corners_B=(0.0, 0.0), block_size=None):
+    """Multiply \sum_i Krylov(A, G_i) @ Krylov(B, H_i) @ x when A and B are tridiagonal
+    (possibly with corners). Uses the blocked algorithm in @tridiag_krylov_transpose_multiply
+    and @tridiag_krylov_multiply, which supports autograd wrt all operator
+    parameters, including corners that are tensors.
+    Parameters:
+        subdiag_A: Tensor of shape (n - 1, )
+        diag_A: Tensor of shape (n, )
+        superdiag_A: Tensor of shape (n - 1, )
+        subdiag_B: Tensor of shape (n - 1, )
+        diag_B: Tensor of shape (n, )
+        superdiag_B: Tensor of shape (n - 1, )
+        G: Tensor of shape (rank, n)
+        H: Tensor of shape (rank, n)
+        x: Tensor of shape (batch_size, n)
+        corners_A: the upper right and lower left corners of A, real numbers or Tensors of shape ().
+        corners_B: the upper right and lower left corners of B, real numbers or Tensors of shape ().
+        block_size: number of baby steps, defaults to @tridiag_block_size.
+    Returns:
+        product: Tensor of shape (batch_size, n)
+    """
+    subdiag_A, diag_A, superdiag_A, subdiag_B, diag_B, superdiag_B, G, H, x_ = to_compute_dtype(
+        subdiag_A, diag_A, superdiag_A, subdiag_B, diag_B, superdiag_B, G, H, x)
+    diags_A = tridiag_diags(subdiag_A, diag_A, superdiag_A, *corners_A)
+    diags_B = tridiag_diags(subdiag_B, diag_B, superdiag_B, *corners_B)
+    KT_out = tridiag_krylov_transpose_multiply(diags_B, H, x_, block_size)
+    return tridiag_krylov_multiply(diags_A, G, KT_out, block_size).to(x.dtype)
+
+
+##### Backends of the subdiagonal multiplies, see structure.backends
+
+# The explicit Krylov constructions take O(rank * n^2) memory
+slow_max_n = 1 << 12
+
+backends.register('subdiagonal', 'fast', subdiag_mult)
+backends.register('subdiagonal', 'conv', subdiag_mult_conv)
+backends.register('subdiagonal', 'lean', subdiag_mult_lean)
+backends.register('subdiagonal_corner', 'fast', subdiag_mult_corner)
+for class_type in ['subdiagonal', 'subdiagonal_corner']:
+    backends.register(class_type, 'slow', subdiag_mult_slow, max_n=slow_max_n)
+    backends.register(class_type, 'slow_fast', subdiag_mult_slow_fast, max_n=slow_max_n)
+    backends.register(class_type, 'cuda', subdiag_mult_cuda, max_n=slow_max_n, devices=('cuda', ),
+                      dtypes=(torch.float, ), available=lambda: use_diag_mult_cuda)
+    backends.register(class_type, 'cpp', subdiag_mult_cuda, max_n=slow_max_n, devices=('cpu', ),
+                      dtypes=(torch.float, torch.double), available=lambda: use_diag_mult_cpu)
+
+
 def test_krylov_transpose_multiply():
     m = 10
     n = 1 << m
@@ -940,7 +1747,6 @@ def test_krylov_transpose_multiply():
     u = torch.rand((batch_size, n), requires_grad=True, device=device)
     v = torch.rand((rank, n), requires_grad=True, device=device)
     # Fast algorithm on GPU
-    # KTu_traced = torch.jit.trace(KTu_traceable, (subdiag, v, u))
     result = krylov_transpose_multiply(subdiag, v, u)
     # result = krylov_transpose_multiply_conv(subdiag, v, u)
     # result = krylov_transpose_multiply_old(subdiag, v, u)
@@ -1074,20 +1880,274 @@ def test_subdiag_mult():
     print((grad - grad_cuda).abs().mean().item())
 
 
+def test_subdiag_mult_corner():
+    rank, batch_size = 3, 5
+    for n in [64, 100]:
+        rand = lambda *shape: torch.randn(shape, dtype=torch.double, device=device, requires_grad=True)
+        subdiag_A, subdiag_B, G, H, x, corner_A, corner_B = rand(n - 1), rand(n - 1), rand(rank, n), rand(rank, n), rand(batch_size, n), rand(), rand()
+        inputs = [subdiag_A, subdiag_B, G, H, x, corner_A, corner_B]
+        result = subdiag_mult_corner(*inputs)
+        grad = torch.autograd.grad(result.sum(), inputs)
+        result_slow = subdiag_mult_slow(*inputs)
+        grad_slow = torch.autograd.grad(result_slow.sum(), inputs)
+        with torch.no_grad():
+            result_precomputed = subdiag_mult_corner_precomputed(subdiag_mult_corner_precompute(*inputs[:4], *inputs[5:]), x)
+        # These max relative differences should be small, including the gradients of the corners
+        print(n, ((result - result_slow).abs().max() / result_slow.abs().max()).item(),
+              [((g - g_slow).abs().max() / g_slow.abs().max()).item() for g, g_slow in zip(grad, grad_slow)],
+              ((result_precomputed - result_slow).abs().max() / result_slow.abs().max()).item())
+        # Without corners, it's the same as subdiag_mult
+        print((subdiag_mult_corner(*inputs[:5]) - subdiag_mult(*inputs[:5])).abs().max().item())
+
+
+def subdiag_mult_corner_benchmark(sizes=(256, 1024, 4096), batch_size=64, rank=4, repeat=5):
+    """Compare the training step (forward and backward) of the subdiagonal multiply
+    with corners, fast and with the explicit Krylov matrices, with that of @subdiag_mult.
+    """
+    import time
+    synchronize = torch.cuda.synchronize if device.type == 'cuda' else lambda: None
+    for n in sizes:
+        rand = lambda *shape: torch.rand(shape, device=device, requires_grad=True)
+        inputs = [rand(n - 1), rand(n - 1), rand(rank, n), rand(rank, n), rand(batch_size, n), rand(), rand()]
+        setups = [('sd', subdiag_mult, inputs[:5]), ('sdc fast', subdiag_mult_corner, inputs)]
+        if n <= slow_max_n:
+            setups.append(('sdc slow_fast', subdiag_mult_slow_fast, inputs))
+        elapsed = {}
+        for name, f, args in setups:
+            best = np.inf
+            for _ in range(repeat):
+                synchronize()
+                start = time.perf_counter()
+                torch.autograd.grad(f(*args).sum(), args)
+                synchronize()
+                best = min(best, time.perf_counter() - start)
+            elapsed[name] = best
+        print(f'n={n} batch_size={batch_size} fwd+bwd: ' + ', '.join(f'{name} {t * 1e3:.2f}ms' for name, t in elapsed.items()))
+
+def test_subdiag_mult_precomputed():
+    n = 1000
+    batch_size = 50
+    rank = 16
+    subdiag_A = torch.rand(n-1, device=device)
+    subdiag_B = torch.rand(n-1, device=device)
+    G = torch.rand((rank, n), device=device)
+    H = torch.rand((rank, n), device=device)
+    x = torch.rand((batch_size, n), device=device)
+    result = subdiag_mult(subdiag_A, subdiag_B, G, H, x)
+    precomputed = subdiag_mult_precompute(subdiag_A, subdiag_B, G, H)
+    result_precomputed = subdiag_mult_precomputed(precomputed, x)
+    # These max and mean differences should be small
+    print((result - result_precomputed).abs().max().item())
+    print((result - result_precomputed).abs().mean().item())
+
+def test_subdiag_mult_lean():
+    n = 1000
+    batch_size = 50
+    rank = 16
+    subdiag_A = torch.rand(n-1, requires_grad=True, device=device)
+    subdiag_B = torch.rand(n-1, requires_grad=True, device=device)
+    G = torch.rand((rank, n), requires_grad=True, device=device)
+    H = torch.rand((rank, n), requires_grad=True, device=device)
+    x = torch.rand((batch_size, n), requires_grad=True, device=device)
+    inputs = (subdiag_A, subdiag_B, G, H, x)
+    result = subdiag_mult(*inputs)
+    grad_output = torch.rand_like(result)
+    grads = torch.autograd.grad(result, inputs, grad_output)
+    for recompute in [True, False]:
+        result_lean = subdiag_mult_lean(*inputs, recompute=recompute)
+        grads_lean = torch.autograd.grad(result_lean, inputs, grad_output)
+        # These max relative differences should be small
+        print(((result - result_lean).abs().max() / result.abs().max()).item())
+        for g, g_lean in zip(grads, grads_lean):
+            print(((g - g_lean).abs().max() / g.abs().max()).item())
+    # Gradients wrt G and H when the operators are fixed use a different code path
+    subdiag_A, subdiag_B = subdiag_A.detach(), subdiag_B.detach()
+    result = subdiag_mult(subdiag_A, subdiag_B, G, H, x)
+    grads = torch.autograd.grad(result, (G, H), grad_output)
+    result_lean = subdiag_mult_lean(subdiag_A, subdiag_B, G, H, x)
+    grads_lean = torch.autograd.grad(result_lean, (G, H), grad_output)
+    for g, g_lean in zip(grads, grads_lean):
+        print(((g - g_lean).abs().max() / g.abs().max()).item())
+
+def test_subdiag_mult_non_power_of_2():
+    batch_size = 50
+    rank = 16
+    for n in [784, 1000, 3 * 1024]:
+        subdiag_A = torch.rand(n-1, requires_grad=True, device=device)
+        subdiag_B = torch.rand(n-1, requires_grad=True, device=device)
+        G = torch.rand((rank, n), requires_grad=True, device=device)
+        H = torch.rand((rank, n), requires_grad=True, device=device)
+        x = torch.rand((batch_size, n), requires_grad=True, device=device)
+        inputs = (subdiag_A, subdiag_B, G, H, x)
+        result = subdiag_mult(*inputs)
+        grads = torch.autograd.grad(result.sum(), inputs)
+        result_conv = subdiag_mult_conv(*inputs)
+        result_slow = subdiag_mult_slow(*inputs)
+        grads_slow = torch.autograd.grad(result_slow.sum(), inputs)
+        # These max relative differences should be small
+        print(((result - result_slow).abs().max() / result_slow.abs().max()).item())
+        print(((result_conv - result_slow).abs().max() / result_slow.abs().max()).item())
+        for g, g_slow in zip(grads, grads_slow):
+            print(((g - g_slow).abs().max() / g_slow.abs().max()).item())
+
+
+def subdiag_mult_benchmark(sizes=(784, 1000, 3 * 1024), batch_size=256, rank=4, repeat=20):
+    """Compare the throughput of @subdiag_mult on n that aren't powers of 2
+    against zero-padding the inputs to the next power of 2.
+    """
+    import time
+    synchronize = torch.cuda.synchronize if device.type == 'cuda' else lambda: None
+
+    def pad(t, n_extended):
+        return torch.cat((t, t.new_zeros(t.shape[:-1] + (n_extended - t.shape[-1], ))), dim=-1)
+
+    def subdiag_mult_padded(subdiag_A, subdiag_B, G, H, x):
+        n = x.shape[-1]
+        n_extended = 1 << int(np.ceil(np.log2(n)))
+        out = subdiag_mult(pad(subdiag_A, n_extended - 1), pad(subdiag_B, n_extended - 1),
+                           pad(G, n_extended), pad(H, n_extended), pad(x, n_extended))
+        return out[:, :n]
+
+    for n in sizes:
+        subdiag_A = torch.rand(n-1, requires_grad=True, device=device)
+        subdiag_B = torch.rand(n-1, requires_grad=True, device=device)
+        G = torch.rand((rank, n), requires_grad=True, device=device)
+        H = torch.rand((rank, n), requires_grad=True, device=device)
+        x = torch.rand((batch_size, n), requires_grad=True, device=device)
+        inputs = (subdiag_A, subdiag_B, G, H, x)
+        for name, f in [('native', subdiag_mult), ('padded', subdiag_mult_padded)]:
+            for backward in [False, True]:
+                with torch.set_grad_enabled(backward):
+                    f(*inputs)  # warmup
+                    synchronize()
+                    start = time.perf_counter()
+                    for _ in range(repeat):
+                        out = f(*inputs)
+                        if backward:
+                            torch.autograd.grad(out.sum(), inputs)
+                    synchronize()
+                    elapsed = (time.perf_counter() - start) / repeat
+                print(f'n={n} {name} {"fwd+bwd" if backward else "fwd"}: {elapsed * 1e3:.2f}ms, '
+                      f'{batch_size / elapsed:.0f} samples/s')
+
+
+def test_krylov_plan():
+    rank, batch_size = 4, 5
+    for n, lead, conv_threshold in [(1024, (), 0), (1000, (), 8), (100, (3, 2), 8)]:
+        subdiag_A = torch.rand(lead + (n-1, ), device=device)
+        subdiag_B = torch.rand(lead + (n-1, ), device=device)
+        G = torch.rand(lead + (rank, n), device=device)
+        H = torch.rand(lead + (rank, n), device=device)
+        x = torch.rand(lead[:1] + (1, ) * len(lead[1:]) + (batch_size, n), device=device)
+        precomputed = (G, H, krylov_precompute(subdiag_A, G, conv_threshold), krylov_precompute(subdiag_B, H, conv_threshold))
+        plan = KrylovPlan(n, rank, batch_size, G.dtype, G.device, lead)
+        result = subdiag_mult_precomputed(precomputed, x)
+        with torch.no_grad():
+            # Twice, as the workspaces are reused
+            result_plan = subdiag_mult_precomputed(precomputed, x, plan)
+            result_plan = subdiag_mult_precomputed(precomputed, x, plan)
+        # These max differences should be 0
+        print((result - result_plan).abs().max().item())
+
+
+def krylov_plan_benchmark(n=1024, rank=4, batch_sizes=(1, 4, 16, 64), repeat=50):
+    """Compare the inference latency of @subdiag_mult_precomputed with and without a KrylovPlan."""
+    import time
+    synchronize = torch.cuda.synchronize if device.type == 'cuda' else lambda: None
+    subdiag_A, subdiag_B = torch.rand(n-1, device=device), torch.rand(n-1, device=device)
+    G, H = torch.rand((rank, n), device=device), torch.rand((rank, n), device=device)
+    precomputed = subdiag_mult_precompute(subdiag_A, subdiag_B, G, H)
+    for batch_size in batch_sizes:
+        x = torch.rand((batch_size, n), device=device)
+        elapsed = {}
+        for name, plan in [('no plan', None), ('plan', KrylovPlan(n, rank, batch_size, G.dtype, G.device))]:
+            with torch.no_grad():
+                subdiag_mult_precomputed(precomputed, x, plan)  # warmup
+                synchronize()
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    subdiag_mult_precomputed(precomputed, x, plan)
+                synchronize()
+                elapsed[name] = (time.perf_counter() - start) / repeat
+        print(f'n={n} batch_size={batch_size}: no plan {elapsed["no plan"] * 1e6:.0f}us, '
+              f'plan {elapsed["plan"] * 1e6:.0f}us, speedup {elapsed["no plan"] / elapsed["plan"]:.2f}x')
+
+
+def test_subdiag_mult_channels():
+    in_channels, out_channels, rank, n, batch_size = 3, 2, 2, 100, 10
+    subdiag_A = torch.rand(in_channels, out_channels, n - 1, dtype=torch.double, device=device, requires_grad=True)
+    subdiag_B = torch.rand(in_channels, out_channels, n - 1, dtype=torch.double, device=device, requires_grad=True)
+    G = torch.rand(in_channels, out_channels, rank, n, dtype=torch.double, device=device, requires_grad=True)
+    H = torch.rand(in_channels, out_channels, rank, n, dtype=torch.double, device=device, requires_grad=True)
+    x = torch.rand(in_channels, batch_size, n, dtype=torch.double, device=device, requires_grad=True)
+    inputs = (subdiag_A, subdiag_B, G, H, x)
+    result = subdiag_mult_channels(*inputs)
+    result_loop = torch.stack([sum(subdiag_mult(subdiag_A[i, j], subdiag_B[i, j], G[i, j], H[i, j], x[i])
+                                   for i in range(in_channels)) for j in range(out_channels)])
+    grad = torch.autograd.grad(result.sum(), inputs)
+    grad_loop = torch.autograd.grad(result_loop.sum(), inputs)
+    # These max relative differences should be small
+    print(((result - result_loop).abs().max() / result_loop.abs().max()).item())
+    print(max(((g - g_loop).abs().max() / g_loop.abs().max()).item() for g, g_loop in zip(grad, grad_loop)))
+
+
+def tridiag_mult_benchmark(sizes=(256, 1024, 4096, 8192), batch_size=16, rank=4, repeat=5):
+    """Time @tridiag_mult with the default block size against m = sqrt(n)
+    without the cap and against @tridiag_mult_slow, to show how it scales with n.
+    """
+    import time
+    synchronize = torch.cuda.synchronize if device.type == 'cuda' else lambda: None
+    for n in sizes:
+        subdiag, superdiag = torch.rand(n-1, device=device) / 4, torch.rand(n-1, device=device) / 4
+        diag = torch.rand(n, device=device) / 4
+        G, H = torch.rand((rank, n), device=device), torch.rand((rank, n), device=device)
+        x = torch.rand((batch_size, n), device=device)
+        inputs = (subdiag, diag, superdiag, subdiag, diag, superdiag, G, H, x)
+        m, m_sqrt = tridiag_block_size(n), tridiag_block_size(n, max_block_size=n)
+        fs = [(f'blocked m={m}', tridiag_mult)]
+        if m_sqrt != m:
+            fs.append((f'blocked m={m_sqrt}', functools.partial(tridiag_mult, block_size=m_sqrt)))
+        if n <= slow_max_n:
+            fs.append(('slow', tridiag_mult_slow))
+        for name, f in fs:
+            f(*inputs)  # warmup
+            synchronize()
+            start = time.perf_counter()
+            for _ in range(repeat):
+                f(*inputs)
+            synchronize()
+            elapsed = (time.perf_counter() - start) / repeat
+            print(f'n={n} {name}: {elapsed * 1e3:.2f}ms, {elapsed / n ** 2 * 1e9:.2f}ns / n^2')
+
+
 def test_tridiag_mult():
     m = 10
     n = 1 << m
     batch_size = 50
     rank = 16
-    subdiag = torch.rand(n-1, requires_grad=True, device=device) / 2
-    diag = torch.rand(n, requires_grad=True, device=device) / 2
-    superdiag = torch.rand(n-1, requires_grad=True, device=device) / 2
+    subdiag = torch.rand(n-1, requires_grad=True, device=device) / 4
+    diag = torch.rand(n, requires_grad=True, device=device) / 4
+    superdiag = torch.rand(n-1, requires_grad=True, device=device) / 4
     u = torch.rand((batch_size, n), requires_grad=True, device=device)
     v = torch.rand((rank, n), requires_grad=True, device=device)
     K = Krylov(tridiag_linear_map(subdiag, diag, superdiag, 0.5, 0.5), v)
     K_old = Krylov(tridiag_linear_map_slow(subdiag, diag, superdiag, 0.5, 0.5), v)
     print((K - K_old).abs().max().item())
     trid_slow = tridiag_mult_slow(subdiag, diag, superdiag, subdiag, diag, superdiag, v, v, u)
+    grad_slow, = torch.autograd.grad(trid_slow.sum(), subdiag, retain_graph=True)
+    corners = (torch.tensor(0.5, requires_grad=True, device=device), torch.tensor(0.5, requires_grad=True, device=device))
+    trid_corners_slow = tridiag_mult_slow(subdiag, diag, superdiag, subdiag, diag, superdiag, v, v, u, corners, corners)
+    grad_corners_slow = torch.autograd.grad(trid_corners_slow.sum(), corners, retain_graph=True)
+    trid = tridiag_mult(subdiag, diag, superdiag, subdiag, diag, superdiag, v, v, u)
+    grad, = torch.autograd.grad(trid.sum(), subdiag, retain_graph=True)
+    trid_corners = tridiag_mult(subdiag, diag, superdiag, subdiag, diag, superdiag, v, v, u, corners, corners)
+    grad_corners = torch.autograd.grad(trid_corners.sum(), corners, retain_graph=True)
+    # These max relative differences should be small
+    print(((trid - trid_slow).abs().max() / trid_slow.abs().max()).item())
+    print(((grad - grad_slow).abs().max() / grad_slow.abs().max()).item())
+    print(((trid_corners - trid_corners_slow).abs().max() / trid_corners_slow.abs().max()).item())
+    for g, g_slow in zip(grad_corners, grad_corners_slow):
+        print(((g - g_slow).abs() / g_slow.abs()).item())
 
 
 # TODO: broken, move test into subpackage
@@ -1095,4 +2155,10 @@ if __name__ == "__main__":
     test_krylov_transpose_multiply()
     test_krylov_multiply()
     test_subdiag_mult()
+    test_subdiag_mult_corner()
+    test_subdiag_mult_precomputed()
+    test_krylov_plan()
+    test_subdiag_mult_lean()
+    test_subdiag_mult_non_power_of_2()
+    test_subdiag_mult_channels()
     test_tridiag_mult()
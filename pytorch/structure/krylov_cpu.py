@@ -0,0 +1,389 @@
+"""Multiply by Krylov matrices of subdiagonal operators on the CPU, with numpy
+arrays and pyFFTW.
+
+This is the CPU inference engine for the fast algorithm in structure.krylov:
+the same recursion, but with preallocated aligned buffers and FFTW plans, so a
+call does no planning and little allocation. FFTW's batched transforms run over
+the batch and rank dimensions together, and are split across @threads threads.
+
+Planning with FFTW_MEASURE takes seconds for large n, so:
+- Engines are cached process-wide, keyed by shape (see @get_engine), and the
+  functional interface (@krylov_transpose_multiply, @krylov_multiply,
+  @subdiag_mult) rounds the batch size up to a power of 2 so that variable batch
+  sizes reuse a handful of engines.
+- FFTW wisdom is loaded from @wisdom_path before the first plan and saved back
+  whenever planning learned something new, so later processes plan instantly.
+"""
+import os
+import pickle
+import threading
+
+import numpy as np
+import pyfftw
+
+# Where FFTW wisdom is persisted across processes
+wisdom_path = os.environ.get('STRUCTURED_NETS_FFTW_WISDOM',
+                             os.path.join(os.path.expanduser('~'), '.cache', 'structured-nets', 'fftw_wisdom.pkl'))
+autosave_wisdom = True
+planner_effort = 'FFTW_MEASURE'
+# Batches larger than this are processed in chunks of this size
+max_batch_bucket = 256
+
+_wisdom_loaded = False
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def load_wisdom(path=None):
+    """Import FFTW wisdom saved by @save_wisdom. Returns whether any was loaded."""
+    global _wisdom_loaded
+    _wisdom_loaded = True
+    path = wisdom_path if path is None else path
+    try:
+        with open(path, 'rb') as f:
+            wisdom = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return False
+    return any(pyfftw.import_wisdom(wisdom))
+
+
+def save_wisdom(path=None):
+    """Export the FFTW wisdom accumulated in this process (including what was loaded) to disk."""
+    path = wisdom_path if path is None else path
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # Write then rename, so that concurrent processes never read a partial file
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(pyfftw.export_wisdom(), f)
+    os.replace(tmp_path, path)
+
+
+def _plan(input_array, output_array, direction, threads):
+    return pyfftw.FFTW(input_array, output_array, direction=direction,
+                       flags=[planner_effort, 'FFTW_DESTROY_INPUT'], threads=threads)
+
+
+class _Engine():
+    """Common setup of the engines: wisdom, threads and dtypes."""
+
+    def __init__(self, n, batch_size=1, rank=1, dtype=np.float64, threads=None):
+        m = int(np.log2(n))
+        assert n == 1 << m, 'n must be a power of 2'
+        self.n = n
+        self.m = m
+        self.batch_size = batch_size
+        self.rank = rank
+        self.dtype = np.dtype(dtype)
+        self.complex_dtype = np.result_type(self.dtype, np.complex64)
+        self.threads = pyfftw.config.NUM_THREADS if threads is None else threads
+        self.lock = threading.Lock()
+        if not _wisdom_loaded:
+            load_wisdom()
+        wisdom = pyfftw.export_wisdom()
+        self.plan_ffts()
+        if autosave_wisdom and pyfftw.export_wisdom() != wisdom:
+            try:
+                save_wisdom()
+            except OSError:
+                pass
+
+    def empty(self, shape, complex=False):
+        return pyfftw.empty_aligned(shape, dtype=self.complex_dtype if complex else self.dtype)
+
+
+class KrylovTransposeMultiply(_Engine):
+    """Multiply Krylov(A, v)^T @ u when A is zero except on the subdiagonal.
+    """
+
+    def plan_ffts(self):
+        n, m, batch_size, rank = self.n, self.m, self.batch_size, self.rank
+        self.S_storage = [self.empty((batch_size + rank, n))] * m
+        self.S_f_storage = [self.empty((batch_size + rank, 1 << d, (1 << (m - d - 1)) + 1), complex=True) for d in range(m)]
+        self.T_f_storage = [self.empty((batch_size, rank, (1 << (m - d - 1)) + 1), complex=True) for d in range(m)]
+        self.T_storage = [self.empty((batch_size, rank, 1 << (m - d))) for d in range(m)]
+        self.ffts_forward_pass = []
+        for d, (S, S_f, T_f, T) in enumerate(zip(self.S_storage, self.S_f_storage, self.T_f_storage, self.T_storage)):
+            S = S.reshape((batch_size + rank, 1 << d, 1 << (m - d)))
+            fft_time2freq = _plan(S, S_f, 'FFTW_FORWARD', self.threads)
+            fft_freq2time = _plan(T_f, T, 'FFTW_BACKWARD', self.threads)
+            self.ffts_forward_pass.append((fft_time2freq, fft_freq2time))
+
+    def __call__(self, subdiag, v, u):
+        """Multiply Krylov(A, v)^T @ u when A is zero except on the subdiagonal.
+        We don't use bit reversal here.
+        Parameters:
+            subdiag: array of shape (n - 1, )
+            v: array of shape (rank, n)
+            u: array of shape (batch_size, n)
+        Returns:
+            product: array of shape (batch_size, rank, n)
+        """
+        n, m, batch_size, rank = self.n, self.m, self.batch_size, self.rank
+        u, v = u.reshape(batch_size, n), v.reshape(rank, n)
+        result = np.zeros((batch_size, rank, n), dtype=self.dtype)
+        # T_00_sum = u @ v.T
+        T_00_sum = (u[:, np.newaxis] * v).sum(axis=-1)
+        result[:, :, 0] += T_00_sum
+        T_01 = u.reshape(batch_size, n, 1).astype(self.dtype)  # Copy since we'll be changing this array directly
+        T_10 = v.reshape(rank, n, 1)
+        T_11 = np.ones(n, dtype=self.dtype)
+        for d in range(m)[::-1]:
+            n1, n2 = 1 << d, 1 << (m - d - 1)
+            S = self.S_storage[d].reshape((batch_size + rank, n1, 2 * n2))
+            S_f = self.S_f_storage[d]
+            T_f = self.T_f_storage[d]
+            T = self.T_storage[d]
+            fft_time2freq, fft_freq2time = self.ffts_forward_pass[d]
+
+            S_01, S_10, S_11 = T_01, T_10, T_11
+            S[:, :, n2:] = 0.0
+            S0_10_mult_subdiag, S1_01 = S[:rank, :, :n2], S[rank:rank + batch_size, :, :n2]
+            S0_10_mult_subdiag[:] = S_10[:, ::2] * subdiag[(n2 - 1)::(2 * n2), np.newaxis]
+            S1_01[:] = S_01[:, 1::2]
+
+            # polynomial multiplications
+            S_f = fft_time2freq(S, output_array=S_f)
+            S0_10_f, S1_01_f = S_f[:rank], S_f[rank:rank + batch_size]
+            T_00_f_sum = T_f
+            # Batched matmul over frequencies, much faster than einsum
+            T_00_f_sum[:] = np.matmul(S1_01_f.transpose(2, 0, 1), S0_10_f.transpose(2, 1, 0)).transpose(1, 2, 0)
+            T = fft_freq2time(T_f, output_array=T)
+            T_00_sum = T
+
+            # polynomial additions
+            result[:, :, 1:2*n2] += T_00_sum[..., :-1]
+            S0_11_mult_subdiag = S_11[::2] * subdiag[(n2 - 1)::(2 * n2)]
+            T_01 = S_01.reshape(batch_size, n1, 2 * n2)
+            T_01[:, :, n2:] *= S0_11_mult_subdiag[:, np.newaxis]
+            T_10 = np.concatenate((S_10[:, 1::2], S0_10_mult_subdiag * S_11[1::2][:, np.newaxis]), axis=-1)
+            T_11 = S0_11_mult_subdiag * S_11[1::2]
+
+        return result
+
+
+class KrylovMultiply(_Engine):
+    """Multiply Krylov(A, v) @ w when A is zero except on the subdiagonal.
+    """
+
+    def plan_ffts(self):
+        self.plan_ffts_forward_pass_u_zero()
+        self.plan_ffts_backward_pass()
+
+    def plan_ffts_forward_pass_u_zero(self):
+        n, m, rank = self.n, self.m, self.rank
+        self.S_storage = [self.empty((rank, n))] * m
+        self.S_f_storage = [self.empty((rank, 1 << d, (1 << (m - d - 1)) + 1), complex=True) for d in range(m)]
+        self.ffts_forward_pass = []
+        for d, (S, S_f) in enumerate(zip(self.S_storage, self.S_f_storage)):
+            S = S.reshape((rank, 1 << d, 1 << (m - d)))
+            fft_time2freq = _plan(S, S_f, 'FFTW_FORWARD', self.threads)
+            self.ffts_forward_pass.append(fft_time2freq)
+
+    def plan_ffts_backward_pass(self):
+        n, m, batch_size, rank = self.n, self.m, self.batch_size, self.rank
+        self.dT_storage = [self.empty((batch_size, rank, 1 << (m - d))) for d in range(m)]
+        self.dT_f_storage = [self.empty((batch_size, rank, (1 << (m - d - 1)) + 1), complex=True) for d in range(m)]
+        self.dS_f_storage = [self.empty((batch_size, 1 << d, (1 << (m - d - 1)) + 1), complex=True) for d in range(m)]
+        self.dS_storage = [self.empty((batch_size, n))] * m
+        self.ffts_backward_pass = []
+        for d, (dT, dT_f, dS_f, dS) in enumerate(zip(self.dT_storage, self.dT_f_storage, self.dS_f_storage, self.dS_storage)):
+            dS = dS.reshape((batch_size, 1 << d, 1 << (m - d)))
+            fft_time2freq = _plan(dT, dT_f, 'FFTW_FORWARD', self.threads)
+            fft_freq2time = _plan(dS_f, dS, 'FFTW_BACKWARD', self.threads)
+            self.ffts_backward_pass.append((fft_time2freq, fft_freq2time))
+
+    def __call__(self, subdiag, v, w):
+        """Multiply Krylov(A, v) @ w when A is zero except on the subdiagonal.
+        Parameters:
+            subdiag: array of shape (n - 1, )
+            v: array of shape (rank, n)
+            w: array of shape (batch_size, rank, n)
+        Returns:
+            product: array of shape (batch_size, n)
+        """
+        n, m, batch_size, rank = self.n, self.m, self.batch_size, self.rank
+        # Forward pass. Since K @ w can be computed by autodiffing K^T @ u, we
+        # carry out the forward pass K^T @ u for u = 0 here to save the
+        # intermediate values. This code is exactly the same as the function
+        # @krylov_transpose_multiply, specialized to the case where u = 0.
+        save_for_backward = [None] * m
+        T_10 = v.reshape(rank, n, 1)
+        T_11 = np.ones(n, dtype=self.dtype)
+        for d in range(m)[::-1]:
+            n1, n2 = 1 << d, 1 << (m - d - 1)
+            S = self.S_storage[d].reshape((rank, n1, 2 * n2))
+            S_f = self.S_f_storage[d]
+            fft_time2freq = self.ffts_forward_pass[d]
+            S_10, S_11 = T_10, T_11
+            S0_10_mult_subdiag = S[:, :, :n2]
+            S0_10_mult_subdiag[:] = S_10[:, ::2] * subdiag[(n2 - 1)::(2 * n2), np.newaxis]
+            S[:, :, n2:] = 0.0
+            S0_10_mult_subdiag_f = fft_time2freq(S, output_array=S_f)
+            T_10 = np.concatenate((S_10[:, 1::2], S0_10_mult_subdiag * S_11[1::2][:, np.newaxis]), axis=-1)
+            S0_11_mult_subdiag = S_11[::2] * subdiag[(n2 - 1)::(2 * n2)]
+            save_for_backward[d] = S0_10_mult_subdiag_f, S0_11_mult_subdiag
+            T_11 = S0_11_mult_subdiag * S_11[1::2]
+
+        # Backward pass
+        w, v = w.reshape(batch_size, rank, n), v.reshape((rank, n))
+        dT_01 = np.zeros((batch_size, 1, n), dtype=self.dtype)
+
+        for d in range(m):
+            n1, n2 = 1 << d, 1 << (m - d - 1)
+            dT = self.dT_storage[d]
+            dT_f = self.dT_f_storage[d]
+            dS_f = self.dS_f_storage[d]
+            dS = self.dS_storage[d].reshape((batch_size, n1, 2 * n2))
+            fft_time2freq, fft_freq2time = self.ffts_backward_pass[d]
+
+            S0_10_mult_subdiag_f, S0_11_mult_subdiag = save_for_backward[d]
+            dS_01 = np.empty((batch_size, 2 * n1, n2), dtype=self.dtype)
+            dS_01[:, ::2] = dT_01[:, :, :n2]
+            dT_00_sum = dT
+            dT_00_sum[:, :, :2*n2 - 1] = w[:, :, 1:2*n2]
+            dT_00_sum[:, :, -1] = 0.0
+
+            dT_00_sum_f = fft_time2freq(dT, output_array=dT_f)
+            dS1_01_f = dS_f
+            S0_10_mult_subdiag_f_conj = np.conjugate(S0_10_mult_subdiag_f, out=S0_10_mult_subdiag_f)
+            dS1_01_f[:] = np.matmul(dT_00_sum_f.transpose(2, 0, 1), S0_10_mult_subdiag_f_conj.transpose(2, 0, 1)).transpose(1, 2, 0)
+
+            dS1_01 = fft_freq2time(dS_f, output_array=dS)
+            dS_01[:, 1::2] = dT_01[:, :, n2:] * S0_11_mult_subdiag[:, np.newaxis] + dS1_01[:, :, :n2]
+            dT_01 = dS_01
+
+        du = w[:, :, 0] @ v + dT_01.squeeze(axis=-1)
+        return du
+
+
+def get_engine(cls, n, batch_size=1, rank=1, dtype=np.float64, threads=None):
+    """Return the process-wide instance of @cls (KrylovTransposeMultiply or
+    KrylovMultiply) for this shape, planning it on first use.
+    """
+    threads = pyfftw.config.NUM_THREADS if threads is None else threads
+    key = (cls, n, batch_size, rank, np.dtype(dtype), threads)
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = cls(n, batch_size, rank, dtype, threads)
+        return _engines[key]
+
+
+def batch_bucket(batch_size):
+    """Smallest power of 2 that is at least @batch_size, capped at @max_batch_bucket."""
+    return min(1 << max(batch_size - 1, 0).bit_length(), max_batch_bucket)
+
+
+def _bucketed(cls, subdiag, v, x, threads):
+    """Run the engine @cls on x of shape (batch_size, ...) through the batch
+    buckets, padding n to a power of 2. Zero padding doesn't change the result:
+    A is lower triangular, so the leading n x n block of the Krylov matrix of the
+    padded problem is the Krylov matrix of the original one.
+    """
+    batch_size, n = x.shape[0], x.shape[-1]
+    rank = v.shape[0]
+    n_padded = 1 << max(n - 1, 1).bit_length()
+    dtype = np.result_type(subdiag, v, x, np.float32)
+    if n_padded != n:
+        subdiag = np.concatenate((subdiag, np.zeros(n_padded - n, dtype=subdiag.dtype)))
+        v = np.concatenate((v, np.zeros((rank, n_padded - n), dtype=v.dtype)), axis=-1)
+    bucket = batch_bucket(batch_size)
+    engine = get_engine(cls, n_padded, bucket, rank, dtype, threads)
+    out_shape = (rank, n) if cls is KrylovTransposeMultiply else (n, )
+    result = np.empty((batch_size, ) + out_shape, dtype=dtype)
+    x_padded = np.zeros((bucket, ) + x.shape[1:-1] + (n_padded, ), dtype=dtype)
+    with engine.lock:
+        for start in range(0, batch_size, bucket):
+            end = min(start + bucket, batch_size)
+            x_padded[:end - start, ..., :n] = x[start:end]
+            x_padded[end - start:] = 0.0
+            result[start:end] = engine(subdiag, v, x_padded)[:end - start, ..., :n]
+    return result
+
+
+def krylov_transpose_multiply(subdiag, v, u, threads=None):
+    """Multiply Krylov(A, v_i)^T @ u when A is zero except on the subdiagonal.
+    Any n and batch size; see @_bucketed.
+    Parameters:
+        subdiag: array of shape (n - 1, )
+        v: array of shape (rank, n)
+        u: array of shape (batch_size, n)
+        threads: number of FFTW threads, defaults to pyfftw.config.NUM_THREADS
+    Returns:
+        product: array of shape (batch_size, rank, n)
+    """
+    return _bucketed(KrylovTransposeMultiply, subdiag, v, u, threads)
+
+
+def krylov_multiply(subdiag, v, w, threads=None):
+    """Multiply \sum_i Krylov(A, v_i) @ w_i when A is zero except on the subdiagonal.
+    Any n and batch size; see @_bucketed.
+    Parameters:
+        subdiag: array of shape (n - 1, )
+        v: array of shape (rank, n)
+        w: array of shape (batch_size, rank, n)
+        threads: number of FFTW threads, defaults to pyfftw.config.NUM_THREADS
+    Returns:
+        product: array of shape (batch_size, n)
+    """
+    return _bucketed(KrylovMultiply, subdiag, v, w, threads)
+
+
+def subdiag_mult(subdiag_A, subdiag_B, G, H, x, threads=None):
+    """Multiply \sum_i Krylov(A, G_i) @ Krylov(B, H_i)^T @ x when A and B are zero except on the subdiagonal.
+    Numpy version of structure.krylov.subdiag_mult.
+    Parameters:
+        subdiag_A: array of shape (n - 1, )
+        subdiag_B: array of shape (n - 1, )
+        G: array of shape (rank, n)
+        H: array of shape (rank, n)
+        x: array of shape (batch_size, n)
+        threads: number of FFTW threads, defaults to pyfftw.config.NUM_THREADS
+    Returns:
+        product: array of shape (batch_size, n)
+    """
+    KT_out = krylov_transpose_multiply(subdiag_B, H, x, threads)
+    return krylov_multiply(subdiag_A, G, KT_out, threads)
+
+
+def test_subdiag_mult():
+    import torch
+    from . import krylov as kry
+    rank = 3
+    for n, batch_size in [(1024, 5), (1000, 1), (100, 300)]:
+        subdiag_A, subdiag_B = np.random.random(n - 1), np.random.random(n - 1)
+        G, H = np.random.random((rank, n)), np.random.random((rank, n))
+        x = np.random.random((batch_size, n))
+        result = subdiag_mult(subdiag_A, subdiag_B, G, H, x)
+        result_torch = kry.subdiag_mult_slow(*[torch.tensor(a) for a in (subdiag_A, subdiag_B, G, H, x)]).numpy()
+        # These should be small
+        print(np.abs(result - result_torch).max() / np.abs(result_torch).max())
+    result_float = subdiag_mult(*[a.astype(np.float32) for a in (subdiag_A, subdiag_B, G, H, x)])
+    print(result_float.dtype, np.abs(result_float - result_torch).max() / np.abs(result_torch).max())
+
+
+def subdiag_mult_benchmark(n=1024, rank=4, batch_sizes=(1, 16, 64), repeat=50):
+    """Compare @subdiag_mult with structure.krylov.subdiag_mult in PyTorch."""
+    import time
+    import torch
+    from . import krylov as kry
+    subdiag_A, subdiag_B = np.random.random(n - 1), np.random.random(n - 1)
+    G, H = np.random.random((rank, n)), np.random.random((rank, n))
+    for batch_size in batch_sizes:
+        x = np.random.random((batch_size, n))
+        args = (subdiag_A, subdiag_B, G, H, x)
+        args_torch = [torch.tensor(a) for a in args]
+        elapsed = {}
+        for name, f in [('pytorch', lambda: kry.subdiag_mult(*args_torch)), ('fftw', lambda: subdiag_mult(*args))]:
+            with torch.no_grad():
+                f()  # warmup, and planning
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    f()
+                elapsed[name] = (time.perf_counter() - start) / repeat
+        print(f'n={n} batch_size={batch_size}: pytorch {elapsed["pytorch"] * 1e6:.0f}us, '
+              f'fftw {elapsed["fftw"] * 1e6:.0f}us, speedup {elapsed["pytorch"] / elapsed["fftw"]:.2f}x')
+
+
+if __name__ == '__main__':
+    test_subdiag_mult()
+    subdiag_mult_benchmark()
@@ -1,27 +1,73 @@
+import time
+import warnings
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.nn.parameter import Parameter
 from torch.autograd import Variable
 
 from . import toeplitz as toep
 from . import krylov as kry
 from . import circulant as circ
+from . import vandermonde as vand
 from . import fastfood as ff
+from . import autotune
+from . import backends
+from .complex_utils import rfft, compute_dtype, to_compute_dtype, autocast_dtype
 
 from utils import descendants
 
 class Layer(nn.Module):
+    """
+    Structured linear map from layer_size inputs to hidden_size outputs (hidden_size defaults to layer_size).
+    Rectangular LDR layers are tiled by a grid of in_blocks x out_blocks square
+    blocks of size block_size = min(layer_size, hidden_size); the last input
+    block is zero-padded and the outputs past hidden_size are dropped.
+    Their parameters have leading dimensions block_shape = (in_blocks, out_blocks),
+    or () for square layers.
+    A grouped layer (see GroupedStructuredLinear) is a stack of groups independent
+    square layers, with parameters of leading dimensions block_shape = (groups, ):
+    it multiplies an input of shape (groups, batch_size, layer_size), or
+    (batch_size, layer_size) shared by the groups, into an output of shape
+    (groups, batch_size, hidden_size), or its sum over the groups if sum_groups.
+    """
     class_type = None
     abbrev = None
+    groups = None
+    sum_groups = False
+    # Number of runs of each multiply when choosing between dense and structured
+    dense_timing_repeat = 3
 
     def name(self):
         return self.__class__.abbrev
 
-    def __init__(self, layer_size=None, bias=True, **kwargs):
+    def __init_subclass__(cls, **kwargs):
+        """The forward of each class type is its own multiply, kept as
+        structured_forward: Layer.forward dispatches between it, the dense
+        matrix, the registered backends and the specialised graphs, so that
+        the hooks of nn.Module.__call__ run around all of them.
+        """
+        super().__init_subclass__(**kwargs)
+        if 'forward' in cls.__dict__:
+            cls.structured_forward = cls.__dict__['forward']
+            cls.forward = Layer.forward
+
+    def __init__(self, layer_size=None, bias=True, hidden_size=None, **kwargs):
         super().__init__()
         self.layer_size = layer_size
+        self.hidden_size = layer_size if hidden_size is None else hidden_size
         self.bias = bias
+        self.frozen = False
+        self._frozen_cache = None
+        self._frozen_key = None
+        self.backend = None
+        self._graphs = {}
+        self.multiply_backend = None
+        self.dense = False
+        self._dense_cache = None
+        self._dense_key = None
+        self._dense_choices = {}
         self.__dict__.update(kwargs)
         self.reset_parameters()
 
@@ -29,17 +75,277 @@ class Layer(nn.Module):
         assert self.layer_size is not None
         self.b = None
         if self.bias:
-            self.b = Parameter(torch.zeros(self.layer_size))
+            # One bias per group, broadcast against the outputs of shape (groups, batch_size, hidden_size)
+            shape = (self.groups, 1, self.hidden_size) if self.groups and not self.sum_groups else (self.hidden_size, )
+            self.b = Parameter(torch.zeros(shape))
+        self.block_size = min(self.layer_size, self.hidden_size)
+        self.in_blocks = -(-self.layer_size // self.block_size)
+        self.out_blocks = -(-self.hidden_size // self.block_size)
+        self.block_shape = () if self.layer_size == self.hidden_size else (self.in_blocks, self.out_blocks)
+        if self.groups:
+            assert self.layer_size == self.hidden_size, 'The layers of a group must be square'
+            assert type(self).group_mult is not Layer.group_mult, f'{self.class_type} layers can\'t be grouped'
+            self.block_shape = (self.groups, )
 
     def apply_bias(self, out):
+        # Like nn.Linear, the output is in the autocast dtype (if enabled), so
+        # activations stay in half precision between layers. The fast
+        # multiplies run in at least single precision internally.
+        dtype = autocast_dtype(out.device)
+        if dtype is not None:
+            out = out.to(dtype)
         if self.b is not None:
-            return self.b + out
+            return self.b.to(out.dtype) + out
         else:
             return out
 
+    def split_blocks(self, x):
+        """(batch_size, layer_size) -> (in_blocks, batch_size, block_size), the layout of the *_mult_channels functions."""
+        x = F.pad(x, (0, self.in_blocks * self.block_size - self.layer_size))
+        return x.reshape(x.shape[0], self.in_blocks, self.block_size).transpose(0, 1)
+
+    def merge_blocks(self, out):
+        """(out_blocks, batch_size, block_size) -> (batch_size, hidden_size)"""
+        out = out.transpose(0, 1).reshape(out.shape[1], self.out_blocks * self.block_size)
+        return out[:, :self.hidden_size]
+
+    def blocks_mult(self, block_mult, x):
+        """Multiply x by the grid of blocks one block at a time, for the classes
+        without a batched multi-channel multiply.
+        block_mult(index, x_i) multiplies x_i by the block at index = (i, j),
+        or by the whole matrix if the layer is square (index = ()).
+        """
+        if not self.block_shape:
+            return block_mult((), x)
+        x = self.split_blocks(x)
+        out = [sum(block_mult((i, j), x[i]) for i in range(self.in_blocks)) for j in range(self.out_blocks)]
+        return self.merge_blocks(torch.stack(out))
+
+    def group_mult(self, x, sum_groups=False):
+        """Multiply x by the layers of the groups, without the bias (see the class docstring).
+        Implemented by the classes that can be grouped.
+        """
+        raise NotImplementedError
+
+    def map_blocks(self, f):
+        """Stack f(index) over the indices of the blocks, into a Tensor with leading dimensions block_shape."""
+        if not self.block_shape:
+            return f(())
+        out = [f(index) for index in np.ndindex(*self.block_shape)]
+        return torch.stack(out).reshape(self.block_shape + out[0].shape)
+
     def loss(self):
         return 0
 
+    def freeze(self):
+        """Inference mode: cache the part of the forward pass that only depends
+        on the parameters (e.g. FFTs of the generators), so each forward only
+        does the input-dependent work.
+        The cache is recomputed whenever a parameter changes, and is not used
+        when gradients wrt the parameters are needed.
+        """
+        self.frozen = True
+        self._frozen_cache = None
+        return self
+
+    def unfreeze(self):
+        self.frozen = False
+        self._frozen_cache = None
+        return self
+
+    def precompute(self):
+        """Compute the parameter-only tensors used by forward when frozen.
+        Subclasses with such work override this.
+        """
+        return None
+
+    def parameters_key(self):
+        """Identify the current values of the parameters and buffers: they are
+        changed either in place (bumping their version) or replaced (e.g. by
+        reset_parameters or .to(device)).
+        """
+        return [(t.data_ptr(), t._version, t.dtype, t.device) for t in list(self.parameters()) + list(self.buffers())]
+
+    def needs_grad(self):
+        return torch.is_grad_enabled() and any(p.requires_grad for p in self.parameters())
+
+    def frozen_cache(self):
+        """Return the output of precompute if the layer is frozen, else None.
+        """
+        if not self.frozen or self.needs_grad():
+            return None
+        key = self.parameters_key()
+        if self._frozen_cache is None or key != self._frozen_key:
+            with torch.no_grad():
+                self._frozen_cache = self.precompute()
+            self._frozen_key = key
+        return self._frozen_cache
+
+    def specialize(self, backend='trace'):
+        """Inference mode: run each input shape through a compiled graph
+        specialised to that shape (and dtype, device and autocast dtype).
+        The batch sizes are rounded up to a power of 2 (the inputs are padded
+        with zeros), so that variable batch sizes share a few graphs.
+        Graphs are built on the first call with a new shape, and rebuilt
+        whenever a parameter changes. Like the frozen cache, they are not used
+        when gradients wrt the parameters or the input are needed.
+        backend: 'trace' (TorchScript trace, then torch.jit.freeze, which folds
+            all the parameter-only work into constants) or 'inductor' (torch.compile).
+        """
+        assert backend in ('trace', 'inductor'), 'backend must be trace or inductor'
+        self.backend = backend
+        self._graphs = {}
+        return self
+
+    def unspecialize(self):
+        self.backend = None
+        self._graphs = {}
+        return self
+
+    def graph(self, x):
+        """Return the graph specialised to the input x, or None if it can't be used."""
+        if self.backend is None or self.needs_grad() or (torch.is_grad_enabled() and x.requires_grad):
+            return None
+        batch_size = x.shape[-2]
+        pad = (1 << (batch_size - 1).bit_length()) - batch_size
+        x = F.pad(x, (0, 0, 0, pad))
+        key = (tuple(x.shape), x.dtype, x.device, autocast_dtype(x.device))
+        params_key = self.parameters_key()
+        if key not in self._graphs or self._graphs[key][1] != params_key:
+            # Only keep graphs for the current parameters
+            self._graphs = {k: v for k, v in self._graphs.items() if v[1] == params_key}
+            with torch.no_grad(), warnings.catch_warnings():
+                # Run eagerly first, so that the autotuning, the frozen cache
+                # and the Krylov plans are done outside of the graph capture
+                self.structured_forward(x)
+                # The graphs are specialised to the shapes by design, so the
+                # warnings about sizes converted to Python values don't apply
+                warnings.simplefilter('ignore')
+                # The graphs only capture the multiply, the hooks run around them in forward
+                if self.backend == 'trace':
+                    graph = torch.jit.trace_module(self, {'structured_forward': x}, check_trace=False)
+                    graph = torch.jit.freeze(graph.eval(), preserved_attrs=['structured_forward']).structured_forward
+                else:
+                    graph = torch.compile(self.structured_forward, dynamic=False)
+            self._graphs[key] = graph, params_key
+        graph = self._graphs[key][0]
+        return graph if pad == 0 else lambda x: graph(F.pad(x, (0, 0, 0, pad)))[..., :batch_size, :]
+
+    def backend_args(self, index, x):
+        """Arguments of the backends of this class type (see structure.backends)
+        to multiply x by the block at index.
+        """
+        raise NotImplementedError
+
+    def select_backend(self, x):
+        """Return the registered backend chosen for this layer and input (see
+        structure.backends), or None to use the layer's own forward.
+        multiply_backend: name of the backend preferred for this layer, or None.
+        """
+        if self.groups:  # The backends multiply one block at a time
+            return None
+        autograd = self.needs_grad() or (torch.is_grad_enabled() and x.requires_grad)
+        return backends.select(self.class_type, x, self.block_size, autograd, self.multiply_backend)
+
+    def to_dense(self):
+        """Return the matrix W of shape (layer_size, hidden_size) of the layer,
+        so that forward(x) = x @ W + b, by running the identity through the
+        structured multiply as a batch of layer_size rows. For grouped layers,
+        W has shape (groups, layer_size, hidden_size), one matrix per group.
+        Gradients flow to the parameters.
+        """
+        p = next(self.parameters())
+        eye = torch.eye(self.layer_size, dtype=p.dtype, device=p.device)
+        with torch.autocast(p.device.type, enabled=False):
+            if self.groups:
+                return self.group_mult(eye)
+            W = self.structured_forward(eye)
+        return W - self.b.to(W.dtype) if self.b is not None else W
+
+    def densify(self, mode='auto'):
+        """Inference mode: multiply by the dense matrix of the layer (see
+        to_dense), cached and recomputed whenever a parameter changes.
+        Like the frozen cache, it's not used when gradients are needed.
+        mode: True to always use the dense matrix, or 'auto' to choose per call
+            between the dense and the structured multiply, whichever is faster
+            for the batch size (see dense_dispatch).
+        """
+        assert mode in (True, 'auto'), 'mode must be True or auto'
+        self.dense = mode
+        self._dense_cache = None
+        self._dense_choices = {}
+        return self
+
+    def undensify(self):
+        self.dense = False
+        self._dense_cache = None
+        self._dense_choices = {}
+        return self
+
+    def dense_cache(self):
+        key = self.parameters_key()
+        if self._dense_cache is None or key != self._dense_key:
+            with torch.no_grad():
+                self._dense_cache = self.to_dense()
+            self._dense_key = key
+        return self._dense_cache
+
+    def dense_mult(self, x):
+        W = self.dense_cache()
+        out = x @ W.to(x.dtype)
+        return self.apply_bias(out.sum(dim=0) if self.sum_groups else out)
+
+    def dense_dispatch(self, x):
+        """Multiply x with the cached dense matrix or the structured multiply.
+        In 'auto' mode the choice is measured per batch size (rounded up to a
+        power of 2), dtype and device: the first call of a batch size warms up
+        the structured multiply (e.g. its frozen cache, plans or graphs), the
+        second one times both (best of dense_timing_repeat runs) and keeps the
+        fastest for the later calls.
+        """
+        if self.dense == 'auto':
+            key = (1 << (x.shape[-2] - 1).bit_length(), x.dtype, x.device)
+            choice = self._dense_choices.get(key)
+            if choice is None:
+                self._dense_choices[key] = 'measure'
+                return self.structured_call(x)
+            if choice == 'measure':
+                self.dense_cache()
+                synchronize = torch.cuda.synchronize if x.is_cuda else lambda: None
+                times = []
+                for f in [self.structured_call, self.dense_mult]:
+                    best = float('inf')
+                    for _ in range(self.dense_timing_repeat):
+                        synchronize()
+                        start = time.perf_counter()
+                        out = f(x)
+                        synchronize()
+                        best = min(best, time.perf_counter() - start)
+                    times.append(best)
+                choice = self._dense_choices[key] = times[1] < times[0]
+                return out
+            if not choice:
+                return self.structured_call(x)
+        return self.dense_mult(x)
+
+    def structured_call(self, x):
+        backend = self.select_backend(x)
+        if backend is not None:
+            return self.apply_bias(self.blocks_mult(lambda index, x: backend(*self.backend_args(index, x)), x))
+        graph = self.graph(x)
+        return graph(x) if graph is not None else self.structured_forward(x)
+
+    def structured_forward(self, x):
+        """The multiply of the class type, its own forward (see __init_subclass__)."""
+        raise NotImplementedError
+
+    def forward(self, x, *args, **kwargs):
+        if args or kwargs or torch.jit.is_tracing():
+            return self.structured_forward(x, *args, **kwargs)
+        if self.dense and not self.needs_grad() and not (torch.is_grad_enabled() and x.requires_grad):
+            return self.dense_dispatch(x)
+        return self.structured_call(x)
+
 class Unconstrained(Layer):
     class_type = 'unconstrained'
     abbrev = 'u'
@@ -47,25 +353,21 @@ class Unconstrained(Layer):
     def name(self):
         return self.__class__.abbrev + str(self.hidden_size)
 
-    def __init__(self, layer_size, hidden_size=None, **kwargs):
-        if hidden_size is None:
-            hidden_size = layer_size
-        super().__init__(layer_size, hidden_size=hidden_size, **kwargs)
-
     def reset_parameters(self):
         super().reset_parameters()
         self.W = Parameter(torch.Tensor(self.layer_size, self.hidden_size))
         self.init_stddev = np.sqrt(1./self.layer_size)
         torch.nn.init.normal_(self.W, std=self.init_stddev)
         self.mask = None
-        if self.bias:
-            self.b = Parameter(torch.zeros(self.hidden_size))
 
     def set_mask(self, mask, device):
         self.mask = Variable(torch.FloatTensor(mask).to(device), requires_grad=False)
         self.W.data *= self.mask.data
         print('Num. nonzero entries after pruning: ', torch.nonzero(self.W).size(0))
 
+    def to_dense(self):
+        return self.W * self.mask if self.mask is not None else self.W
+
     def forward(self, x):
         if self.mask is not None:
             masked_W = self.W*self.mask
@@ -84,12 +386,26 @@ class Circulant(Layer):
 
     def reset_parameters(self):
         super().reset_parameters()
-        self.c = Parameter(torch.Tensor(self.layer_size))
+        self.c = Parameter(torch.Tensor(*self.block_shape, self.block_size))
         self.init_stddev = np.sqrt(1./self.layer_size)
         torch.nn.init.normal_(self.c, std=self.init_stddev)
 
+    def precompute(self):
+        return rfft(self.c)
+
+    def backend_args(self, index, x):
+        return self.c[index], x
+
+    def group_mult(self, x, sum_groups=False):
+        return circ.circulant_multiply_groups(self.c, x, self.frozen_cache(), sum_groups)
+
     def forward(self, x):
-        return self.apply_bias(circ.circulant_multiply(self.c, x))
+        if self.groups:
+            return self.apply_bias(self.group_mult(x, self.sum_groups))
+        if self.block_shape:
+            out = circ.circulant_multiply_channels(self.c, self.split_blocks(x), self.frozen_cache())
+            return self.apply_bias(self.merge_blocks(out))
+        return self.apply_bias(circ.circulant_multiply(self.c, x, self.frozen_cache()))
 
 
 class FastFood(Layer):
@@ -102,21 +418,27 @@ class FastFood(Layer):
         # TODO: check initialization of S (scaling matrix) is correct
         # S,G,B: diagonal, learnable parameters
         # P: permutation, fixed
-        S = np.sqrt(np.random.chisquare(self.layer_size, size=self.layer_size))
-        G = np.random.randn(self.layer_size)
-        S /= np.linalg.norm(G)
-        B = np.random.choice((-1, 1), size=self.layer_size)
-        self.S = Parameter(torch.FloatTensor(S))
-        self.G = Parameter(torch.FloatTensor(G))
-        self.B = Parameter(torch.FloatTensor(B))
-        self.P = torch.LongTensor(np.random.permutation(self.layer_size))
+        # Blocks have size n, the smallest power of 2 >= layer_size (the input is zero-padded),
+        # and k of them are stacked to get hidden_size outputs
+        n = 1 << int(np.ceil(np.log2(self.layer_size)))
+        k = -(-self.hidden_size // n)
+        shape = (n, ) if k == 1 else (k, n)
+        S = np.sqrt(np.random.chisquare(n, size=(k, n)))
+        G = np.random.randn(k, n)
+        S /= np.linalg.norm(G, axis=-1, keepdims=True)
+        B = np.random.choice((-1, 1), size=(k, n))
+        P = np.stack([np.random.permutation(n) for _ in range(k)])
+        self.S = Parameter(torch.FloatTensor(S).reshape(shape))
+        self.G = Parameter(torch.FloatTensor(G).reshape(shape))
+        self.B = Parameter(torch.FloatTensor(B).reshape(shape))
+        self.register_buffer('P', torch.LongTensor(P).reshape(shape))
         #self.init_stddev = np.sqrt(1./self.layer_size)
         #torch.nn.init.normal_(self.S, std=self.init_stddev)
         #torch.nn.init.normal_(self.G, std=self.init_stddev)
         #torch.nn.init.normal_(self.B, std=self.init_stddev)
 
     def forward(self, x):
-        return self.apply_bias(ff.fastfood_multiply(self.S, self.G, self.B, self.P, x))
+        return self.apply_bias(ff.fastfood_multiply(self.S, self.G, self.B, self.P, x, self.hidden_size))
 
 class LowRank(Layer):
     class_type = 'low_rank'
@@ -128,10 +450,14 @@ class LowRank(Layer):
     def __init__(self, layer_size, r=1, **kwargs):
         super().__init__(layer_size, r=r, **kwargs)
 
+    def generator_shapes(self):
+        return (self.r, self.hidden_size), (self.r, self.layer_size)
+
     def reset_parameters(self):
         super().reset_parameters()
-        self.G = Parameter(torch.Tensor(self.r, self.layer_size))
-        self.H = Parameter(torch.Tensor(self.r, self.layer_size))
+        G_shape, H_shape = self.generator_shapes()
+        self.G = Parameter(torch.Tensor(*G_shape))
+        self.H = Parameter(torch.Tensor(*H_shape))
         # self.init_stddev = 0.01
         self.init_stddev = np.power(1. / (self.r * self.layer_size), 1/2)
         torch.nn.init.normal_(self.G, std=self.init_stddev)
@@ -148,7 +474,26 @@ class LowRank(Layer):
         # return lamb*torch.sum(torch.abs(self.G)) + lamb*torch.sum(torch.abs(self.H))
 
 
-class ToeplitzLike(LowRank):
+class LDRLayer(LowRank):
+    """
+    Abstract class for LDR layers, with one pair of generators G, H per square block
+    """
+    class_type = None # abstract
+    abbrev = None
+
+    def generator_shapes(self):
+        shape = self.block_shape + (self.r, self.block_size)
+        return shape, shape
+
+    def krylov_cached_mult(self, K_G, K_H, x):
+        """Multiply by explicit Krylov matrices K_G, K_H of shape block_shape + (rank, n, n)."""
+        if self.block_shape:
+            out = ((self.split_blocks(x)[:, np.newaxis, np.newaxis] @ K_H) @ K_G.transpose(-1, -2)).sum(dim=(0, 2))
+            return self.merge_blocks(out)
+        return ((x @ K_H) @ K_G.transpose(1, 2)).sum(dim=0)
+
+
+class ToeplitzLike(LDRLayer):
     class_type = 'toeplitz'
     abbrev = 't'
 
@@ -156,10 +501,32 @@ class ToeplitzLike(LowRank):
         super().reset_parameters()
         self.corner = False
 
+    def precompute(self):
+        return toep.toeplitz_mult_precompute(self.G, self.H, self.corner)
+
+    def backend_args(self, index, x):
+        return self.G[index], self.H[index], x
+
+    def group_mult(self, x, sum_groups=False):
+        return toep.toeplitz_mult_groups(self.G, self.H, x, self.corner, self.frozen_cache(), sum_groups)
+
     def forward(self, x):
-        out = toep.toeplitz_mult(self.G, self.H, x, self.corner)
+        if self.groups:
+            return self.apply_bias(self.group_mult(x, self.sum_groups))
+        if self.block_shape:
+            out = toep.toeplitz_mult_channels(self.G, self.H, self.split_blocks(x), self.corner, self.frozen_cache())
+            return self.apply_bias(self.merge_blocks(out))
+        out = toep.toeplitz_mult(self.G, self.H, x, self.corner, self.frozen_cache())
         return self.apply_bias(out)
 
+    def stream(self, block_size=None):
+        """Causal filter of time series by this layer, see toeplitz.ToeplitzStream:
+        each output sample is the last output of the layer on the window of the
+        last layer_size input samples. It uses the current parameters.
+        """
+        assert not self.corner and not self.block_shape, 'Streaming needs a square layer without corner'
+        return toep.ToeplitzStream(self.G, self.H, block_size, self.b[-1] if self.b is not None else None)
+
 class ToeplitzLikeC(ToeplitzLike):
     class_type = 'toeplitz_corner'
     abbrev = 'tc'
@@ -168,44 +535,99 @@ class ToeplitzLikeC(ToeplitzLike):
         super().reset_parameters()
         self.corner = True
 
-class HankelLike(LowRank):
+class HankelLike(LDRLayer):
     class_type = 'hankel'
     abbrev = 'h'
 
+    def precompute(self):
+        return toep.toeplitz_mult_precompute(self.G, self.H, True)
+
+    def group_mult(self, x, sum_groups=False):
+        return toep.toeplitz_mult_groups(self.G, self.H, x, True, self.frozen_cache(), sum_groups).flip(-1)
+
     def forward(self, x):
-        out = toep.toeplitz_mult(self.G, self.H, x, True)
+        if self.groups:
+            return self.apply_bias(self.group_mult(x, self.sum_groups))
+        if self.block_shape:
+            out = toep.toeplitz_mult_channels(self.G, self.H, self.split_blocks(x), True, self.frozen_cache())
+            return self.apply_bias(self.merge_blocks(out.flip(-1)))
+        out = toep.toeplitz_mult(self.G, self.H, x, True, self.frozen_cache())
         return self.apply_bias(out.flip(out.dim() - 1))
 
-class VandermondeLike(LowRank):
+class VandermondeLike(LDRLayer):
+    """
+    LDR layer with the operators A = diag(d) and B = Z_0, so that the Krylov
+    matrices of the generators G are Vandermonde matrices scaled by G, or with
+    A = Z_0 and B = diag(d) if transpose. The Vandermonde matrices are applied
+    with the truncated powers of structure.vandermonde, shared by all the generators.
+    """
     class_type = 'vandermonde'
     abbrev = 'v'
 
+    def __init__(self, transpose=False, **kwargs):
+        super().__init__(transpose=transpose, **kwargs)
+        self._powers_size = None
+        self._powers_key = None
+
     def reset_parameters(self):
         super().reset_parameters()
-        self.diag = Parameter(torch.Tensor(self.layer_size))
+        self.diag = Parameter(torch.Tensor(*self.block_shape, self.block_size))
         torch.nn.init.uniform_(self.diag, -0.7, 0.7)
 
+    def powers(self):
+        # want: K_A[i,j,k] = g_i[j] * d[j] ** k = G[i, j] * V[j, k]
+        diag, = to_compute_dtype(self.diag)  # powers up to n lose too much accuracy in half precision
+        # The number of powers is only recomputed (a host sync) when the nodes
+        # change, and it's a constant of the specialised graphs, which are
+        # rebuilt then too
+        key = (self.diag.data_ptr(), self.diag._version, diag.dtype, diag.device)
+        if self._powers_size is None or key != self._powers_key:
+            self._powers_size = vand.vandermonde_size(diag, self.block_size)
+            self._powers_key = key
+        return vand.vandermonde_powers(diag, self.block_size, self._powers_size)
+
+    def precompute(self):
+        return self.powers(), toep.toeplitz_krylov_spectrum(self.G if self.transpose else self.H)
+
     def forward(self, x):
-        # want: K_A[i,j,k] = g_i[j] * d[j] ** k
-        # K_A = kry.Krylov(lambda v: self.diag * v, self.G)
-        n = x.size(-1)
-        d_ = self.diag.unsqueeze(1) ** torch.arange(n, dtype=x.dtype, device=x.device)
-        K_A = self.G.unsqueeze(-1) * d_
-
-        # K_B = kry.Krylov(lambda v: torch.cat((v[...,1:],0*v[...,:1]),dim=-1), self.H)
-        # out = (x @ K_B) @ K_A.transpose(1,2)
-
-        out = toep.toeplitz_krylov_transpose_multiply(self.H, x)
-        out = out.transpose(0,1) @ K_A.transpose(1,2)
-        out = torch.sum(out, dim=0)
-        return self.apply_bias(out)
+        cache = self.frozen_cache()
+        V, v_f = cache if cache is not None else (self.powers(), None)
+        G, H = self.G.to(V.dtype), self.H.to(V.dtype)
+        n = self.block_size
+        if self.transpose:
+            # \sum_r Krylov(Z_0, G_r) @ (V * H_r)^T @ x
+            if self.block_shape:
+                x_blocks = self.split_blocks(x.to(V.dtype))
+                xH = (x_blocks[:, np.newaxis, :, np.newaxis] * H[:, :, np.newaxis]).flatten(2, 3)
+                w = vand.vandermonde_transpose_mult(V, xH, n).reshape(H.shape[:2] + (x.shape[0], self.r, n))
+                # Sum over the input blocks and the generators in the transform of each output block
+                w = w.permute(1, 2, 0, 3, 4).reshape(self.out_blocks, x.shape[0], -1, n)
+                G = G.transpose(0, 1).reshape(self.out_blocks, -1, n)
+                v_f = v_f.transpose(0, 1).reshape(self.out_blocks, -1, v_f.shape[-1]) if v_f is not None else [None] * self.out_blocks
+                out = torch.stack([toep.toeplitz_krylov_multiply(G[j], w[j], v_f=v_f[j]) for j in range(self.out_blocks)])
+                return self.apply_bias(self.merge_blocks(out).to(x.dtype))
+            w = vand.vandermonde_transpose_mult(V, x.to(V.dtype)[:, np.newaxis] * H, n)
+            return self.apply_bias(toep.toeplitz_krylov_multiply(G, w, v_f=v_f).to(x.dtype))
 
-        # transpose Vandermonde:
-        # K_H = kry.Krylov(lambda v: self.diag * v, self.H)
-        # out = toep.toeplitz_krylov_multiply(self.G, torch.transpose(x @ K_H, 0,1))
+        # \sum_r (V * G_r) @ Krylov(Z_0, H_r)^T @ x
+        if self.block_shape:
+            # Stack the generators of the blocks of each input block, so that its transform is shared
+            H_f = toep.toeplitz_krylov_spectrum(H) if v_f is None else v_f
+            x_blocks = self.split_blocks(x.to(V.dtype))
+            w = torch.stack([toep.toeplitz_krylov_transpose_multiply(H[i].reshape(-1, n), x_blocks[i],
+                                                                     v_f=H_f[i].reshape(-1, H_f.shape[-1]))
+                             for i in range(self.in_blocks)])
+            # (in_blocks, batch_size, out_blocks * rank, n) -> (in_blocks, out_blocks, batch_size * rank, n)
+            w = w.reshape(w.shape[:2] + H.shape[1:]).transpose(1, 2).flatten(2, 3)
+            out = vand.vandermonde_mult(V, w).reshape(w.shape[:2] + (x.shape[0], self.r, n))
+            out = (out * G[:, :, np.newaxis]).sum(dim=(0, 3))
+            return self.apply_bias(self.merge_blocks(out).to(x.dtype))
+        w = toep.toeplitz_krylov_transpose_multiply(H, x.to(V.dtype), v_f=v_f)
+        out = (vand.vandermonde_mult(V, w) * G).sum(dim=1)
+        return self.apply_bias(out.to(x.dtype))
 
 
-class LearnedOperator(LowRank):
+class LearnedOperator(LDRLayer):
     """
     Abstract class for learned displacement operators
     Contains parameters such as tie_operators
@@ -219,18 +641,65 @@ class LearnedOperator(LowRank):
 class LDRSubdiagonal(LearnedOperator):
     class_type = 'subdiagonal'
     abbrev = 'sd'
+    # Use the hand-written backward that doesn't store the intermediate values
+    # of the recursion (slower, but needs much less memory for training)
+    memory_efficient = False
+    # Number of input shapes to keep a KrylovPlan for
+    max_plans = 8
 
     def reset_parameters(self):
         super().reset_parameters()
-        self.subd_A = Parameter(torch.ones(self.layer_size-1))
+        self.subd_A = Parameter(torch.ones(*self.block_shape, self.block_size-1))
         if self.tie_operators:
             self.subd_B = self.subd_A
         else:
-            self.subd_B = Parameter(torch.ones(self.layer_size-1))
+            self.subd_B = Parameter(torch.ones(*self.block_shape, self.block_size-1))
+        self._plans = {}
+
+    def precompute(self):
+        return kry.subdiag_mult_precompute(self.subd_A, self.subd_B, self.G, self.H)
+
+    def backend_args(self, index, x):
+        return self.subd_A[index], self.subd_B[index], self.G[index], self.H[index], x
+
+    def krylov_plan(self, x, dtype):
+        """KrylovPlan (workspaces for the fast multiply without autograd) for
+        inputs like x and computations in dtype, cached per batch size, dtype
+        and device. None if gradients are needed, or when tracing (the
+        workspaces would become constants of the graph).
+        """
+        if self.needs_grad() or (torch.is_grad_enabled() and x.requires_grad) or torch.jit.is_tracing():
+            return None
+        key = (x.shape[-2], dtype, x.device)
+        if key not in self._plans:
+            if len(self._plans) >= self.max_plans:
+                self._plans.pop(next(iter(self._plans)))
+            self._plans[key] = kry.KrylovPlan(self.block_size, self.r, x.shape[-2], dtype, x.device, self.block_shape)
+        return self._plans[key]
+
+    def group_mult(self, x, sum_groups=False):
+        cache = self.frozen_cache()
+        dtype = cache[0].dtype if cache is not None else compute_dtype(self.subd_A, self.subd_B, self.G, self.H, x)
+        return kry.subdiag_mult_groups(self.subd_A, self.subd_B, self.G, self.H, x, precomputed=cache,
+                                       plan=self.krylov_plan(x, dtype), sum_groups=sum_groups)
 
     def forward(self, x):
-        out = kry.subdiag_mult(self.subd_A, self.subd_B, self.G, self.H, x)
-        #out = kry.subdiag_mult_conv(self.subd_A, self.subd_B, self.G, self.H, x)
+        if self.groups:
+            return self.apply_bias(self.group_mult(x, self.sum_groups))
+        cache = self.frozen_cache()
+        if self.memory_efficient and cache is None:
+            out = self.blocks_mult(lambda index, x: kry.subdiag_mult_lean(self.subd_A[index], self.subd_B[index],
+                                                                         self.G[index], self.H[index], x), x)
+        elif self.block_shape:
+            dtype = cache[0].dtype if cache is not None else compute_dtype(self.subd_A, self.subd_B, self.G, self.H, x)
+            out = kry.subdiag_mult_channels(self.subd_A, self.subd_B, self.G, self.H, self.split_blocks(x),
+                                            precomputed=cache, plan=self.krylov_plan(x, dtype))
+            out = self.merge_blocks(out)
+        elif cache is not None:
+            out = kry.subdiag_mult_precomputed(cache, x, self.krylov_plan(x, cache[0].dtype))
+        else:
+            # Dispatch to the implementation measured to be fastest for this shape
+            out = autotune.subdiag_mult(self.subd_A, self.subd_B, self.G, self.H, x)
         return self.apply_bias(out)
 
 class LDRSubdiagonalC(LDRSubdiagonal):
@@ -238,12 +707,41 @@ class LDRSubdiagonalC(LDRSubdiagonal):
     abbrev = 'sdc'
 
     def reset_parameters(self):
+        assert not self.groups, 'Subdiagonal layers with corners can\'t be grouped'
         super().reset_parameters()
-        self.corner_A = Parameter(torch.tensor(0.0))
-        self.corner_B = Parameter(torch.tensor(0.0))
+        self.corner_A = Parameter(torch.zeros(self.block_shape))
+        self.corner_B = Parameter(torch.zeros(self.block_shape))
+
+    def explicit_cache(self):
+        # The explicit Krylov matrices take O(rank * n^2) memory
+        return self.block_size <= kry.slow_max_n
+
+    def precompute(self):
+        if self.explicit_cache():
+            # Inference is then a product by the cached Krylov matrices
+            K_G = self.map_blocks(lambda index: kry.krylov_subdiag_fast(self.subd_A[index], self.G[index], self.corner_A[index].item()))
+            K_H = self.map_blocks(lambda index: kry.krylov_subdiag_fast(self.subd_B[index], self.H[index], self.corner_B[index].item()))
+            return K_G, K_H
+        # Otherwise the parameter-only part of the fast algorithm, per block
+        return {index: kry.subdiag_mult_corner_precompute(self.subd_A[index], self.subd_B[index], self.G[index],
+                                                          self.H[index], self.corner_A[index], self.corner_B[index])
+                for index in np.ndindex(*self.block_shape)}
+
+    def backend_args(self, index, x):
+        return super().backend_args(index, x) + (self.corner_A[index], self.corner_B[index])
+
+    def block_mult(self, index, x):
+        return autotune.subdiag_mult(self.subd_A[index], self.subd_B[index], self.G[index], self.H[index], x,
+                                     corner_A=self.corner_A[index], corner_B=self.corner_B[index])
 
     def forward(self, x):
-        out = kry.subdiag_mult_cuda(self.subd_A, self.subd_B, self.G, self.H, x, corner_A=self.corner_A, corner_B=self.corner_B)
+        cache = self.frozen_cache()
+        if cache is None:
+            out = self.blocks_mult(self.block_mult, x)
+        elif self.explicit_cache():
+            out = self.krylov_cached_mult(*cache, x)
+        else:
+            out = self.blocks_mult(lambda index, x: kry.subdiag_mult_corner_precomputed(cache[index], x), x)
         return self.apply_bias(out)
 
 class LDRTridiagonal(LearnedOperator):
@@ -252,22 +750,45 @@ class LDRTridiagonal(LearnedOperator):
 
     def reset_parameters(self):
         super().reset_parameters()
-        self.subd_A = Parameter(torch.ones(self.layer_size-1))
-        self.diag_A = Parameter(torch.zeros(self.layer_size))
-        self.supd_A = Parameter(torch.zeros(self.layer_size-1))
+        n = self.block_size
+        self.subd_A = Parameter(torch.ones(*self.block_shape, n-1))
+        self.diag_A = Parameter(torch.zeros(*self.block_shape, n))
+        self.supd_A = Parameter(torch.zeros(*self.block_shape, n-1))
         if self.tie_operators:
             self.subd_B = self.subd_A
             self.diag_B = self.diag_A
             self.supd_B = self.supd_A
         else:
-            self.subd_B = Parameter(torch.ones(self.layer_size-1))
-            self.diag_B = Parameter(torch.zeros(self.layer_size))
-            self.supd_B = Parameter(torch.zeros(self.layer_size-1))
+            self.subd_B = Parameter(torch.ones(*self.block_shape, n-1))
+            self.diag_B = Parameter(torch.zeros(*self.block_shape, n))
+            self.supd_B = Parameter(torch.zeros(*self.block_shape, n-1))
         self.corners_A = (0.0,0.0)
         self.corners_B = (0.0,0.0)
 
+    def block_corners(self, corners, index):
+        """Corners of the block at index (real numbers are shared by all blocks)."""
+        return tuple(c[index] if isinstance(c, torch.Tensor) else c for c in corners)
+
+    def precompute(self):
+        def krylov(subd, diag, supd, corners, v, index):
+            corners = tuple(float(c) for c in self.block_corners(corners, index))
+            return kry.Krylov(kry.tridiag_linear_map(subd[index], diag[index], supd[index], *corners), v[index])
+        K_G = self.map_blocks(lambda index: krylov(self.subd_A, self.diag_A, self.supd_A, self.corners_A, self.G, index))
+        K_H = self.map_blocks(lambda index: krylov(self.subd_B, self.diag_B, self.supd_B, self.corners_B, self.H, index))
+        return K_G, K_H
+
+    def block_mult(self, index, x):
+        return kry.tridiag_mult(self.subd_A[index], self.diag_A[index], self.supd_A[index],
+                                self.subd_B[index], self.diag_B[index], self.supd_B[index], self.G[index], self.H[index], x,
+                                corners_A=self.block_corners(self.corners_A, index),
+                                corners_B=self.block_corners(self.corners_B, index))
+
     def forward(self, x):
-        out = kry.tridiag_mult_slow(self.subd_A, self.diag_A, self.supd_A, self.subd_B, self.diag_B, self.supd_B, self.G, self.H, x, corners_A=self.corners_A, corners_B=self.corners_B)
+        cache = self.frozen_cache()
+        if cache is not None:
+            out = self.krylov_cached_mult(*cache, x)
+        else:
+            out = self.blocks_mult(self.block_mult, x)
         return self.apply_bias(out)
 
 class LDRTridiagonalC(LDRTridiagonal):
@@ -276,8 +797,9 @@ class LDRTridiagonalC(LDRTridiagonal):
 
     def reset_parameters(self):
         super().reset_parameters()
-        self.corners_A = (Parameter(torch.tensor(0.0)), Parameter(torch.tensor(0.0)))
-        self.corners_B = (Parameter(torch.tensor(0.0)), Parameter(torch.tensor(0.0)))
+        # ParameterList so that the corners are registered and trained
+        self.corners_A = nn.ParameterList([Parameter(torch.zeros(self.block_shape)), Parameter(torch.zeros(self.block_shape))])
+        self.corners_B = nn.ParameterList([Parameter(torch.zeros(self.block_shape)), Parameter(torch.zeros(self.block_shape))])
 
 
 # create a map from class names to the Python class
@@ -286,6 +808,454 @@ for cls in descendants(Layer):
     if cls.class_type is None: continue
     class_map[cls.class_type] = cls
     class_map[cls.abbrev] = cls
+    backends.aliases[cls.abbrev] = cls.class_type
 
 def StructuredLinear(class_type, **kwargs):
     return class_map[class_type](**kwargs)
+
+
+def can_group(class_type):
+    """Whether layers of class_type can be grouped by GroupedStructuredLinear."""
+    cls = class_map[class_type]
+    return cls.group_mult is not Layer.group_mult and cls is not LDRSubdiagonalC
+
+
+def GroupedStructuredLinear(class_type, groups, layer_size, sum_groups=False, **kwargs):
+    """Stack of groups independent square layers of class_type and size layer_size,
+    multiplied in one call of the batched kernels (see the Layer docstring).
+    The generators (and operators) of the groups are stacked along the leading dimension.
+    Supported for the circulant, Toeplitz-like, Hankel-like and subdiagonal classes.
+    Parameters:
+        groups: number of layers
+        sum_groups: whether the output is the sum of the outputs of the groups
+            (summed in the frequency domain by the FFT-based classes)
+    """
+    return class_map[class_type](layer_size=layer_size, groups=groups, sum_groups=sum_groups, **kwargs)
+
+
+def compile(model, backend='trace'):
+    """
+    Specialise every structured layer in model (any nn.Module) to the shapes it is called with.
+    See Layer.specialize
+    """
+    for module in model.modules():
+        if isinstance(module, Layer):
+            module.specialize(backend)
+    return model
+
+def uncompile(model):
+    for module in model.modules():
+        if isinstance(module, Layer):
+            module.unspecialize()
+    return model
+
+
+def densify(model, mode='auto'):
+    """Multiply by the cached dense matrices of the structured layers in model
+    (for all batch sizes if mode is True, or where it's faster if 'auto'), see Layer.densify.
+    """
+    for module in model.modules():
+        if isinstance(module, Layer):
+            module.densify(mode)
+    return model
+
+
+def undensify(model):
+    for module in model.modules():
+        if isinstance(module, Layer):
+            module.undensify()
+    return model
+
+
+def test_compile():
+    import os
+    import tempfile
+    import models.nets as nets
+    from itertools import product
+    torch.manual_seed(0)
+    batch_size = 4
+    for class_type, (layer_size, hidden_size) in product(['u', 'c', 'f', 'lr', 't', 'tc', 'h', 'v', 'sd', 'sdc', 'td', 'tdc'],
+                                                         [(60, 60), (60, 150), (150, 60)]):
+        layer = StructuredLinear(class_type, layer_size=layer_size, hidden_size=hidden_size, r=2)
+        x = torch.randn(batch_size, layer_size)
+        out_eager = layer(x)
+        compile(layer)
+        with torch.no_grad():
+            out = layer(x)
+            layer(x)
+        assert len(layer._graphs) == 1
+        # Gradients go through the eager forward
+        assert layer(x).requires_grad
+        # The graphs are rebuilt after a parameter update
+        with torch.no_grad():
+            next(layer.parameters()).add_(0.1)
+            out_update = layer(x)
+            out_update_eager = uncompile(layer)(x)
+        # These max differences should be small
+        print(class_type, layer_size, hidden_size, (out - out_eager).abs().max().item(),
+              (out_update - out_update_eager).abs().max().item())
+    # A whole model, specialised to two batch sizes
+    model = nets.MLP(784, 10, class_type='sd', layer_size=784, r=2, bias=True, num_layers=2,
+                     memory_efficient=False, fastfood_head=False)
+    x = torch.randn(batch_size, 784)
+    out_eager = model(x)
+    # nets uses the layer classes of structure.layer, not those of __main__
+    sl = nets.sl
+    sl.compile(model)
+    with torch.no_grad():
+        out = model(x)
+        model(x[:1])
+        # Batch sizes are rounded up to a power of 2, so 3 uses the graphs of 4
+        out_3 = model(x[:3])
+    assert all(len(layer._graphs) == 2 for layer in model.layers)
+    print('MLP', (out - out_eager).abs().max().item(), (out_3 - out_eager[:3]).abs().max().item())
+    # With a cold tuning cache, the shapes are tuned by the eager warmup run, not in the graph capture
+    cache_path, autotune_enabled = autotune.cache_path, autotune.autotune_enabled
+    autotune.cache_path, autotune.autotune_enabled = os.path.join(tempfile.mkdtemp(), 'subdiag_tuning.json'), True
+    try:
+        autotune.load_cache()
+        for class_type in ['sd', 'sdc']:
+            layer = sl.StructuredLinear(class_type, layer_size=64, r=2)
+            x = torch.randn(batch_size, 64)
+            out_eager = layer(x)
+            with torch.no_grad():
+                out = sl.compile(layer)(x)
+            assert any(key.startswith(f'{class_type}|n=64|') and key.endswith('|fwd') for key in autotune.load_cache())
+            print(class_type, 'cold tuning cache', (out - out_eager).abs().max().item())
+    finally:
+        autotune.cache_path, autotune.autotune_enabled = cache_path, autotune_enabled
+        autotune.load_cache()
+    # torch.compile captures each fast multiply as a single graph, without graph breaks
+    n, rank = 100, 2
+    subdiag_A, subdiag_B = torch.rand(n - 1), torch.rand(n - 1)
+    G, H, x = torch.randn(rank, n), torch.randn(rank, n), torch.randn(batch_size, n)
+    for f, inputs in [(kry.subdiag_mult, (subdiag_A, subdiag_B, G, H, x)), (toep.toeplitz_mult, (G, H, x)),
+                      (circ.circulant_multiply, (G[0], x))]:
+        f_compiled = torch.compile(f, fullgraph=True, dynamic=False, backend='aot_eager')
+        print(f.__name__, (f_compiled(*inputs) - f(*inputs)).abs().max().item())
+
+
+def test_backends():
+    torch.manual_seed(0)
+    x = torch.rand(4, 64, dtype=torch.double)
+    for class_type, hidden_size in [(c, h) for c in ['c', 't', 'tc', 'sd', 'sdc'] for h in [64, 150]]:
+        layer = StructuredLinear(class_type, layer_size=64, hidden_size=hidden_size, r=2).double()
+        with torch.no_grad():
+            out = layer(x)
+            # These max differences should be small
+            for name in backends.list_backends(class_type, x):
+                with backends.use_backend(name, class_type, force=True):
+                    print(class_type, hidden_size, name, (layer(x) - out).abs().max().item())
+    # The layer's choice is skipped when it can't compute the gradients
+    layer = StructuredLinear('sd', layer_size=64, r=2, multiply_backend='slow_fast')
+    x = torch.rand(4, 64)
+    print(layer.select_backend(x), layer(x).requires_grad)
+    layer.multiply_backend = 'numpy'
+    with torch.no_grad():
+        print(layer.select_backend(x))
+    print(layer.select_backend(x))
+
+
+def test_hooks():
+    """The hooks run once per call, around any of the multiplies that forward dispatches to."""
+    torch.manual_seed(0)
+    x = torch.randn(4, 64)
+    for class_type in ['t', 'sd']:
+        layer = StructuredLinear(class_type, layer_size=64, r=2)
+        calls = []
+        layer.register_forward_pre_hook(lambda module, inputs: calls.append('pre'))
+        layer.register_forward_hook(lambda module, inputs, out: out + 1)
+        layer.register_forward_hook(lambda module, inputs, out: calls.append('post'))
+        with torch.no_grad():
+            out_eager = layer(x)
+            for mode in ['dense', 'graph', 'backend']:
+                calls.clear()
+                if mode == 'dense':
+                    out = layer.densify(True)(x)
+                    layer.undensify()
+                elif mode == 'graph':
+                    layer.specialize()
+                    layer(x)
+                    out = layer(x)
+                    assert len(layer._graphs) == 1
+                    layer.unspecialize()
+                else:
+                    with backends.use_backend('numpy', class_type, force=True):
+                        out = layer(x)
+                assert calls == ['pre', 'post'] * (2 if mode == 'graph' else 1), (mode, calls)
+                # The output hook is applied once, so this max difference should be small
+                print(class_type, mode, (out - out_eager).abs().max().item())
+
+
+def test_to_dense():
+    torch.manual_seed(0)
+    batch_size = 5
+    for class_type in [c.class_type for c in set(class_map.values())]:
+        for layer_size, hidden_size in [(60, 60), (60, 150), (150, 60)]:
+            layer = StructuredLinear(class_type, layer_size=layer_size, hidden_size=hidden_size, r=2)
+            with torch.no_grad():
+                for p in layer.parameters():
+                    p.add_(0.1 * torch.rand_like(p))
+            x = torch.randn(batch_size, layer_size)
+            W = layer.to_dense()
+            assert W.shape == (layer_size, hidden_size)
+            out = layer(x)
+            # Dense for all batch sizes, then chosen per batch size
+            with torch.no_grad():
+                out_dense = layer.densify(True)(x)
+                layer.densify('auto')
+                out_auto = [layer(x) for _ in range(3)]
+            assert layer(x).requires_grad  # training goes through the structured multiply
+            # These max relative differences should be small
+            scale = out.abs().max().item()
+            print(class_type, layer_size, hidden_size, (x @ W + layer.b - out).abs().max().item() / scale,
+                  (out_dense - out).abs().max().item() / scale,
+                  max((o - out).abs().max().item() for o in out_auto) / scale, list(layer._dense_choices.values()))
+            layer.undensify()
+
+
+def test_grouped():
+    torch.manual_seed(0)
+    groups, layer_size, batch_size = 3, 60, 5
+    for class_type in ['c', 't', 'tc', 'h', 'sd']:
+        for sum_groups in [False, True]:
+            grouped = GroupedStructuredLinear(class_type, groups, layer_size, sum_groups, r=2).double()
+            with torch.no_grad():
+                for p in grouped.parameters():
+                    p.add_(0.1 * torch.rand_like(p))
+            # The same layers, one at a time
+            layers = [StructuredLinear(class_type, layer_size=layer_size, r=2, bias=False).double() for _ in range(groups)]
+            with torch.no_grad():
+                for g, layer in enumerate(layers):
+                    for name, p in layer.named_parameters():
+                        p.copy_(getattr(grouped, name)[g])
+            W = grouped.to_dense()
+            for x in [torch.randn(groups, batch_size, layer_size, dtype=torch.double),
+                      torch.randn(batch_size, layer_size, dtype=torch.double)]:
+                x_ = x if x.dim() == 3 else x.expand(groups, -1, -1)
+                out_loop = torch.stack([layer(x_[g]) for g, layer in enumerate(layers)])
+                out_loop = (out_loop.sum(dim=0) if sum_groups else out_loop) + grouped.b
+                out = grouped(x)
+                # Gradients of the main parameters (c, or the generators G)
+                name = 'c' if class_type == 'c' else 'G'
+                grad = torch.autograd.grad(out.sum(), getattr(grouped, name))[0]
+                grad_loop = torch.stack([torch.autograd.grad(out_loop.sum(), getattr(layer, name), retain_graph=True)[0]
+                                         for layer in layers])
+                with torch.no_grad():
+                    out_frozen = grouped.freeze()(x)
+                    grouped.unfreeze()
+                    out_dense = grouped.densify(True)(x)
+                    grouped.undensify()
+                # These max differences should be small
+                print(class_type, sum_groups, x.dim(), (out - out_loop).abs().max().item(),
+                      (grad - grad_loop).abs().max().item(), (out_frozen - out_loop).abs().max().item(),
+                      (out_dense - out_loop).abs().max().item())
+            assert W.shape == (groups, layer_size, layer_size)
+
+
+def test_vandermonde():
+    torch.manual_seed(0)
+    shift = lambda v: F.pad(v[..., :-1], (1, 0))
+    for transpose in [False, True]:
+        for layer_size, hidden_size in [(64, 64), (64, 150), (150, 64)]:
+            layer = StructuredLinear('v', layer_size=layer_size, hidden_size=hidden_size, r=2, transpose=transpose).double()
+            # Explicit Krylov matrices of the operators diag(d) and Z_0
+            scale = lambda index: kry.Krylov(lambda v: layer.diag[index] * v, (layer.H if transpose else layer.G)[index])
+            K_D = layer.map_blocks(scale)
+            K_Z = layer.map_blocks(lambda index: kry.Krylov(shift, (layer.G if transpose else layer.H)[index]))
+            K_G, K_H = (K_Z, K_D) if transpose else (K_D, K_Z)
+            x = torch.randn(5, layer_size, dtype=torch.double)
+            out = layer(x)
+            out_slow = layer.krylov_cached_mult(K_G, K_H, x) + layer.b
+            grad = torch.autograd.grad(out.sum(), layer.diag)[0]
+            grad_slow = torch.autograd.grad(out_slow.sum(), layer.diag)[0]
+            with torch.no_grad():
+                out_frozen = layer.freeze()(x)
+            # These max relative differences should be small
+            print(transpose, layer_size, hidden_size, ((out - out_slow).abs().max() / out_slow.abs().max()).item(),
+                  ((grad - grad_slow).abs().max() / grad_slow.abs().max()).item(),
+                  ((out_frozen - out_slow).abs().max() / out_slow.abs().max()).item())
+
+
+def vandermonde_benchmark(layer_sizes=(256, 1024), batch_size=64, rank=4, repeat=10):
+    """Compare the training step (forward and backward) and inference latency of
+    the Vandermonde-like layers with unconstrained layers of the same size.
+    """
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    synchronize = torch.cuda.synchronize if device.type == 'cuda' else lambda: None
+    for layer_size in layer_sizes:
+        x = torch.randn(batch_size, layer_size, device=device)
+        for class_type in ['u', 'v']:
+            layer = StructuredLinear(class_type, layer_size=layer_size, r=rank).to(device)
+            elapsed = {}
+            for mode in ['train', 'inference']:
+                with torch.set_grad_enabled(mode == 'train'):
+                    best = np.inf
+                    for _ in range(repeat):
+                        synchronize()
+                        start = time.perf_counter()
+                        out = layer(x)
+                        if mode == 'train':
+                            out.sum().backward()
+                        synchronize()
+                        best = min(best, time.perf_counter() - start)
+                elapsed[mode] = best
+            print(f'{layer.name()} n={layer_size} batch_size={batch_size}: '
+                  + ', '.join(f'{mode} {t * 1e6:.0f}us' for mode, t in elapsed.items()))
+
+
+def grouped_benchmark(class_types=('c', 't', 'sd'), layer_size=512, groups=6, batch_size=64, repeat=20):
+    """Compare the latency of groups structured layers whose outputs are summed
+    (e.g. the second layer of models.nets.LDRLDR), one layer at a time and grouped,
+    for training (forward and backward) and inference (frozen, no grad).
+    """
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    synchronize = torch.cuda.synchronize if device.type == 'cuda' else lambda: None
+    x = torch.randn(groups, batch_size, layer_size, device=device)
+    for class_type in class_types:
+        layers = nn.ModuleList([StructuredLinear(class_type, layer_size=layer_size, r=4) for _ in range(groups)]).to(device)
+        grouped = GroupedStructuredLinear(class_type, groups, layer_size, sum_groups=True, r=4).to(device)
+        setups = {'loop': lambda x: sum(layer(x[g]) for g, layer in enumerate(layers)), 'grouped': grouped}
+        elapsed = {}
+        for mode in ['train', 'inference']:
+            for name, f in setups.items():
+                for module in [layers, grouped]:
+                    [l.freeze() if mode == 'inference' else l.unfreeze() for l in module.modules() if isinstance(l, Layer)]
+                with torch.set_grad_enabled(mode == 'train'):
+                    best = np.inf
+                    for _ in range(repeat):
+                        synchronize()
+                        start = time.perf_counter()
+                        out = f(x)
+                        if mode == 'train':
+                            out.sum().backward()
+                        synchronize()
+                        best = min(best, time.perf_counter() - start)
+                elapsed[mode, name] = best
+            print(f'{groups}x{class_type} n={layer_size} batch_size={batch_size} {mode}: '
+                  + ', '.join(f'{name} {elapsed[mode, name] * 1e6:.0f}us' for name in setups)
+                  + f', speedup {elapsed[mode, "loop"] / elapsed[mode, "grouped"]:.2f}x')
+
+
+def dense_benchmark(class_types=('c', 't', 'sd', 'lr'), layer_size=256, batch_sizes=(1, 64, 4096), repeat=20):
+    """Compare the inference latency (no grad) of the structured multiply, the
+    cached dense matrix and the automatic choice between them, per batch size.
+    """
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    synchronize = torch.cuda.synchronize if device.type == 'cuda' else lambda: None
+    for class_type in class_types:
+        layer = StructuredLinear(class_type, layer_size=layer_size, r=16 if class_type == 'lr' else 4).to(device)
+        for batch_size in batch_sizes:
+            x = torch.randn(batch_size, layer_size, device=device)
+            elapsed = {}
+            for name, mode in [('structured', False), ('dense', True), ('auto', 'auto')]:
+                layer.undensify() if not mode else layer.densify(mode)
+                with torch.no_grad():
+                    for _ in range(3):  # warmup, and measurement of the auto mode
+                        layer(x)
+                    synchronize()
+                    start = time.perf_counter()
+                    for _ in range(repeat):
+                        layer(x)
+                    synchronize()
+                elapsed[name] = (time.perf_counter() - start) / repeat
+            print(f'{class_type} n={layer_size} batch_size={batch_size}: '
+                  + ', '.join(f'{name} {t * 1e6:.0f}us' for name, t in elapsed.items()))
+            layer.undensify()
+
+
+def compile_benchmark(class_types=('c', 't', 'sd', 'f'), layer_size=784, num_layers=2, batch_sizes=(1, 8, 32),
+                      repeat=50, rounds=5, backend='trace'):
+    """Compare the inference latency (no grad) of an MLP of structured layers at
+    small batch sizes: eager, eager with frozen layers (see Layer.freeze), and
+    with the graphs specialised by @compile. Reports the best of several rounds.
+    """
+    import time
+    import models.nets as nets
+    sl = nets.sl
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    synchronize = torch.cuda.synchronize if device.type == 'cuda' else lambda: None
+    setups = {'eager': lambda model: sl.uncompile(nets.unfreeze(model)),
+              'frozen': lambda model: sl.uncompile(nets.freeze(model)),
+              backend: lambda model: sl.compile(nets.unfreeze(model), backend)}
+    for class_type in class_types:
+        model = nets.MLP(layer_size, 10, class_type=class_type, layer_size=layer_size, r=4, bias=True,
+                         num_layers=num_layers, memory_efficient=False, fastfood_head=False).to(device)
+        for batch_size in batch_sizes:
+            x = torch.randn(batch_size, layer_size, device=device)
+            elapsed = {}
+            with torch.no_grad():
+                for name, setup in setups.items():
+                    setup(model)
+                    model(x)  # warmup, and build the cache or the graphs
+                    for _ in range(rounds):
+                        synchronize()
+                        start = time.perf_counter()
+                        for _ in range(repeat):
+                            model(x)
+                        synchronize()
+                        elapsed[name] = min(elapsed.get(name, np.inf), (time.perf_counter() - start) / repeat)
+            print(f'MLP {num_layers}x{class_type} n={layer_size} batch_size={batch_size}: '
+                  + ', '.join(f'{name} {t * 1e6:.0f}us' for name, t in elapsed.items())
+                  + f', speedup {elapsed["eager"] / elapsed[backend]:.2f}x')
+
+
+def test_stream():
+    torch.manual_seed(0)
+    layer_size, batch_size, length = 64, 3, 200
+    layer = StructuredLinear('t', layer_size=layer_size, r=2).double()
+    x = torch.randn(batch_size, length, dtype=torch.double)
+    windows = F.pad(x, (layer_size - 1, 0)).unfold(-1, layer_size, 1)
+    with torch.no_grad():
+        result = layer(windows)[..., -1]
+    stream = layer.stream(block_size=16)
+    out = torch.cat([stream(x[:, t:t + 1]) for t in range(length)], dim=-1)
+    # This max difference should be small
+    print(out.shape[-1], (out - result[:, :out.shape[-1]]).abs().max().item())
+
+
+def stream_benchmark(layer_sizes=(256, 1024, 4096), batch_size=8, length=8192, rank=4):
+    """Compare the time per sample of filtering streams with a causal Toeplitz-like
+    layer, by its forward on the window of the last layer_size samples at each
+    sample, and by layer.stream (for its default block size, and a smaller one).
+    """
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    synchronize = torch.cuda.synchronize if device.type == 'cuda' else lambda: None
+    for layer_size in layer_sizes:
+        layer = StructuredLinear('t', layer_size=layer_size, r=rank).to(device)
+        x = torch.randn(batch_size, length, device=device)
+        windows = F.pad(x, (layer_size - 1, 0)).unfold(-1, layer_size, 1)
+        elapsed = {}
+        with torch.no_grad():
+            # The windows are already materialized, so this is a lower bound of the per step cost
+            steps = min(length, 256)
+            synchronize()
+            start = time.perf_counter()
+            for t in range(steps):
+                layer(windows[:, t])[:, -1]
+            synchronize()
+            elapsed['window'] = (time.perf_counter() - start) / steps
+            for block_size in [layer_size, layer_size // 16]:
+                stream = layer.stream(block_size)
+                synchronize()
+                start = time.perf_counter()
+                for t in range(length):
+                    stream(x[:, t:t + 1])
+                synchronize()
+                elapsed[f'stream({block_size})'] = (time.perf_counter() - start) / length
+        print(f't n={layer_size} batch_size={batch_size}: '
+              + ', '.join(f'{name} {t * 1e6:.1f}us/sample' for name, t in elapsed.items()))
+
+if __name__ == '__main__':
+    test_vandermonde()
+    vandermonde_benchmark()
+    test_grouped()
+    grouped_benchmark()
+    test_to_dense()
+    dense_benchmark()
+    test_backends()
+    test_hooks()
+    test_compile()
+    compile_benchmark()
+    test_stream()
+    stream_benchmark()
@@ -1,50 +1,163 @@
 '''Functions to multiply by a Toeplitz-like matrix.
 '''
+import os
+
 import numpy as np
 import torch
+import torch.nn.functional as F
 
-from .complex_utils import complex_mult, conjugate
-from .krylov import Krylov
+from .complex_utils import rfft, irfft, fft, ifft, compute_dtype, upcast
+from .krylov import Krylov, slow_max_n
+from . import backends
 
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 ##### Fast multiplication for the Toeplitz-like case
 
-def toeplitz_krylov_transpose_multiply(v, u, f=0.0):
+# Default max_chunk_numel of toeplitz_mult, no limit unless set (e.g. to 2^23 on CPU
+# for n around 2^20, where the unchunked intermediates take several GB)
+toeplitz_max_chunk_numel = float(os.environ.get('STRUCTURED_NETS_TOEPLITZ_MAX_CHUNK_NUMEL', 'inf'))
+
+# Cache of the scaling vectors of toeplitz_roots and negacyclic_twiddles, per (n, f, dtype, device)
+_roots = {}
+
+
+def toeplitz_roots(n, f, dtype=torch.float, device=device):
+    """Compute the scaling vectors that diagonalize Z_f by the DFT.
+    They are cached, so they must not be modified in place.
+    Parameters:
+        n: size of Z_f
+        f: nonzero real number
+    Returns:
+        eta: (n, ), eta[k] = |f|^{k/n}, times e^{i pi k/n} if f < 0
+        eta_inverse: (n, ), 1 / eta
+    """
+    key = ('roots', n, f, dtype, torch.device(device))
+    if key not in _roots:
+        mod = abs(f) ** (torch.arange(n, dtype=dtype, device=device) / n)
+        if f > 0:
+            arg = torch.ones(n, dtype=dtype, device=device)
+        else:  # Find primitive roots of -1
+            angles = torch.arange(n, dtype=dtype, device=device) / n * np.pi
+            arg = torch.polar(torch.ones_like(angles), angles)
+        _roots[key] = mod * arg, (1.0 / mod) * arg.conj()
+    return _roots[key]
+
+
+def negacyclic_twiddles(n, dtype=torch.float, device=device):
+    """Twiddle factors zeta^k, k < n / 2, of @negacyclic_fft, with zeta = e^{i pi / n}. Cached."""
+    key = ('negacyclic', n, dtype, torch.device(device))
+    if key not in _roots:
+        angles = torch.arange(n // 2, dtype=dtype, device=device) / n * np.pi
+        twiddles = torch.polar(torch.ones_like(angles), angles)
+        _roots[key] = twiddles, twiddles.conj()
+    return _roots[key]
+
+
+def negacyclic_fft(x):
+    """Transform of the real x of even length n that diagonalizes the
+    negacyclic shift Z_{-1}: the values of the polynomial x(z) at half of the
+    roots of z^n + 1 (the others are their conjugates), by a complex FFT of
+    length n / 2 of x[:n/2] + i x[n/2:], twisted by zeta^k.
+    Parameters:
+        x: real Tensor of shape (..., n)
+    Returns:
+        x_f: complex Tensor of shape (..., n / 2)
+    """
+    half = x.shape[-1] // 2
+    x = upcast(x)
+    twiddles, _ = negacyclic_twiddles(2 * half, x.dtype, x.device)
+    return fft(torch.complex(x[..., :half], x[..., half:]) * twiddles)
+
+
+def negacyclic_ifft(X):
+    """Inverse of @negacyclic_fft: real Tensor of shape (..., n) from X of shape (..., n / 2)."""
+    half = X.shape[-1]
+    _, twiddles_inverse = negacyclic_twiddles(2 * half, X.real.dtype, X.device)
+    x = ifft(X) * twiddles_inverse
+    return torch.cat((x.real, x.imag), dim=-1)
+
+
+def cycle_fast(n, f):
+    """Whether the Z_f-circulant products of size n use real transforms: f = 1
+    (circulant, rfft) or f = -1 with n even (negacyclic, half-length FFT).
+    """
+    return f == 1 or (f == -1 and n % 2 == 0)
+
+
+def cycle_transform(x, f, transpose=False):
+    """Transform of the real x (..., n) that diagonalizes Z_f, f != 0, so that
+    f-circulant products are pointwise products of the transforms. With
+    transpose, the transform of the input of a product by the transpose of an
+    f-circulant matrix, which is then inverted with cycle_inverse(..., transpose=True).
+    The transforms of different f, n and transpose are not interchangeable.
+    """
+    n = x.shape[-1]
+    if cycle_fast(n, f):
+        # The transpose of the f-circulant matrix of v has the conjugate transform (v is real and |f| = 1)
+        x_f = rfft(x) if f == 1 else negacyclic_fft(x)
+        return x_f.conj() if transpose else x_f
+    dtype = compute_dtype(x)
+    eta, eta_inverse = toeplitz_roots(n, f, dtype, x.device)
+    return ifft(eta_inverse * x) if transpose else fft(eta * x)
+
+
+def cycle_inverse(X, f, n, transpose=False):
+    """Real Tensor of shape (..., n) from the product of transforms X of @cycle_transform."""
+    if cycle_fast(n, f):
+        X = X.conj() if transpose else X
+        return irfft(X, n) if f == 1 else negacyclic_ifft(X)
+    eta, eta_inverse = toeplitz_roots(n, f, X.real.dtype, X.device)
+    # We only need the real part
+    return (eta * fft(X)).real if transpose else (eta_inverse * ifft(X)).real
+
+
+def toeplitz_krylov_spectrum(v, f=0.0):
+    """Compute the transform of v used by toeplitz_krylov_transpose_multiply
+    and toeplitz_krylov_multiply. It only depends on the parameters, so it can
+    be computed once and passed in as v_f.
+    Parameters:
+        v: (rank, n)
+        f: real number
+    Returns:
+        v_f: complex, (rank, n + 1) if f == 0, else @cycle_transform(v, f)
+    """
+    n = v.shape[-1]
+    v = v.to(compute_dtype(v))
+    if f != 0.0:
+        return cycle_transform(v, f)
+    else:
+        return rfft(v, 2 * n)
+
+
+def toeplitz_krylov_transpose_multiply(v, u, f=0.0, v_f=None):
     """Multiply Krylov(Z_f, v_i)^T @ u.
     Parameters:
         v: (rank, n)
         u: (batch_size, n)
         f: real number
+        v_f: optional, precomputed toeplitz_krylov_spectrum(v, f)
     Returns:
         product: (batch, rank, n)
     """
     _, n = u.shape
     _, n_ = v.shape
     assert n == n_, 'u and v must have the same last dimension'
+    dtype = compute_dtype(v, u)
+    if v_f is None:
+        v_f = toeplitz_krylov_spectrum(v, f)
     if f != 0.0:  # cycle version
-        # Computing the roots of f
-        mod = abs(f) ** (torch.arange(n, dtype=u.dtype, device=u.device) / n)
-        if f > 0:
-            arg = torch.stack((torch.ones(n, dtype=u.dtype, device=u.device),
-                               torch.zeros(n, dtype=u.dtype, device=u.device)), dim=-1)
-        else:  # Find primitive roots of -1
-            angles = torch.arange(n, dtype=u.dtype, device=u.device) / n * np.pi
-            arg = torch.stack((torch.cos(angles), torch.sin(angles)), dim=-1)
-        eta = mod[:, np.newaxis] * arg
-        eta_inverse = (1.0 / mod)[:, np.newaxis] * conjugate(arg)
-        u_f = torch.ifft(eta_inverse * u[..., np.newaxis], 1)
-        v_f = torch.fft(eta * v[..., np.newaxis], 1)
-        uv_f = complex_mult(u_f[:, np.newaxis], v_f[np.newaxis])
-        uv = torch.fft(uv_f, 1)
-        # We only need the real part of complex_mult(eta, uv)
-        return eta[..., 0] * uv[..., 0] - eta[..., 1] * uv[..., 1]
+        u_f = cycle_transform(u.to(dtype), f, transpose=True)
+        uv_f = u_f[:, np.newaxis] * v_f[np.newaxis]
+        product = cycle_inverse(uv_f, f, n, transpose=True)
     else:
-        u_f = torch.rfft(torch.cat((u.flip(1), torch.zeros_like(u)), dim=-1), 1)
-        v_f = torch.rfft(torch.cat((v, torch.zeros_like(v)), dim=-1), 1)
-        uv_f = complex_mult(u_f[:, np.newaxis], v_f[np.newaxis])
-        return torch.irfft(uv_f, 1, signal_sizes=(2 * n, ))[..., :n].flip(2)
+        # Krylov(Z_0, v)^T @ u is the correlation of u and v, the first n entries
+        # of irfft(U conj(V)). rfft zero-pads to length 2 * n, so no need to concatenate zeros.
+        u_f = rfft(u, 2 * n)
+        uv_f = u_f[:, np.newaxis] * v_f[np.newaxis].conj()
+        product = irfft(uv_f, 2 * n)[..., :n]
+    return product.to(u.dtype)
 
 
 def toeplitz_krylov_multiply_by_autodiff(v, w, f=0.0):
@@ -68,12 +181,13 @@ def toeplitz_krylov_multiply_by_autodiff(v, w, f=0.0):
     return result
 
 
-def toeplitz_krylov_multiply(v, w, f=0.0):
+def toeplitz_krylov_multiply(v, w, f=0.0, v_f=None):
     """Multiply \sum_i Krylov(Z_f, v_i) @ w_i.
     Parameters:
         v: (rank, n)
         w: (batch_size, rank, n)
         f: real number
+        v_f: optional, precomputed toeplitz_krylov_spectrum(v, f)
     Returns:
         product: (batch, n)
     """
@@ -81,44 +195,279 @@ def toeplitz_krylov_multiply(v, w, f=0.0):
     rank_, n_ = v.shape
     assert n == n_, 'w and v must have the same last dimension'
     assert rank == rank_, 'w and v must have the same rank'
+    dtype = compute_dtype(v, w)
+    if v_f is None:
+        v_f = toeplitz_krylov_spectrum(v, f)
     if f != 0.0:  # cycle version
-        # Computing the roots of f
-        mod = abs(f) ** (torch.arange(n, dtype=w.dtype, device=w.device) / n)
-        if f > 0:
-            arg = torch.stack((torch.ones(n, dtype=w.dtype, device=w.device),
-                               torch.zeros(n, dtype=w.dtype, device=w.device)), dim=-1)
-        else:  # Find primitive roots of -1
-            angles = torch.arange(n, dtype=w.dtype, device=w.device) / n * np.pi
-            arg = torch.stack((torch.cos(angles), torch.sin(angles)), dim=-1)
-        eta = mod[:, np.newaxis] * arg
-        eta_inverse = (1.0 / mod)[:, np.newaxis] * conjugate(arg)
-        w_f = torch.fft(eta * w[..., np.newaxis], 1)
-        v_f = torch.fft(eta * v[..., np.newaxis], 1)
-        wv_sum_f = complex_mult(w_f, v_f).sum(dim=1)
-        wv_sum = torch.ifft(wv_sum_f, 1)
-        # We only need the real part of complex_mult(eta_inverse, wv_sum)
-        return eta_inverse[..., 0] * wv_sum[..., 0] - eta_inverse[..., 1] - wv_sum[..., 1]
+        w_f = cycle_transform(w.to(dtype), f)
+        wv_sum_f = (w_f * v_f).sum(dim=1)
+        product = cycle_inverse(wv_sum_f, f, n)
     else:
-        w_f = torch.rfft(torch.cat((w, torch.zeros_like(w)), dim=-1), 1)
-        v_f = torch.rfft(torch.cat((v, torch.zeros_like(v)), dim=-1), 1)
-        wv_sum_f = complex_mult(w_f, v_f).sum(dim=1)
-        return torch.irfft(wv_sum_f, 1, signal_sizes=(2 * n, ))[..., :n]
+        # rfft zero-pads to length 2 * n, so no need to concatenate zeros
+        w_f = rfft(w, 2 * n)
+        wv_sum_f = (w_f * v_f).sum(dim=1)
+        product = irfft(wv_sum_f, 2 * n)[..., :n]
+    return product.to(w.dtype)
+
 
+def toeplitz_input_transform(x, cycle=True):
+    """Transform of the input x (..., n) of toeplitz_mult (f = (1, -1) if cycle, else (0, 0))."""
+    return cycle_transform(x, -1, transpose=True) if cycle else rfft(x, 2 * x.shape[-1])
 
-def toeplitz_mult(G, H, x, cycle=True):
+
+def toeplitz_intermediate_transform(x_f, H_f, n, cycle=True):
+    """From the transforms of x and H, the transforms of the intermediate products
+    Krylov(Z_{f_B}, H_r)^T @ x, in the domain of the multiplies by Krylov(Z_{f_A}, G_r).
+    The domains of f_A and f_B are different (for f = (0, 0), the product
+    must be truncated to its first n entries in between), so this is the only
+    round trip through the time domain, and the sum over the rank is then done
+    in the frequency domain.
+    Parameters:
+        x_f: output of toeplitz_input_transform, of shape (..., batch_size, m)
+        H_f: spectrum of H from toeplitz_mult_precompute, of shape (..., rank, m),
+            broadcast against x_f[..., np.newaxis, :]
+    Returns:
+        w_f: complex Tensor of shape (..., batch_size, rank, m')
+    """
+    if cycle:
+        return cycle_transform(cycle_inverse(x_f[..., np.newaxis, :] * H_f, -1, n, transpose=True), 1)
+    # Krylov(Z_0, h)^T @ x is the correlation of x and h, the first n entries of irfft(X conj(H))
+    w = irfft(x_f[..., np.newaxis, :] * H_f.conj(), 2 * n)
+    w[..., n:] = 0
+    return rfft(w)
+
+
+def toeplitz_output_transform(out_f, n, cycle=True):
+    """Output of toeplitz_mult from the transform of \sum_r Krylov(Z_{f_A}, G_r) @ w_r."""
+    return cycle_inverse(out_f, 1, n) if cycle else irfft(out_f, 2 * n)[..., :n]
+
+
+def toeplitz_mult(G, H, x, cycle=True, precomputed=None, max_chunk_numel=None):
     """Multiply \sum_i Krylov(Z_f, G_i) @ Krylov(Z_f, H_i) @ x.
+    The intermediate product stays in the frequency domain, except for the
+    round trip of @toeplitz_intermediate_transform.
+    The intermediate products (batch_size, rank, n) are done in chunks of rows
+    of x and of the rank with at most about max_chunk_numel entries, whose
+    contributions are accumulated in the frequency domain. For large n (e.g.
+    2^20), that bounds the memory to a few times that of x and of the output,
+    at some cost in time (about 20% for f = (0, 0) at n = 2^20), so it's opt-in.
     Parameters:
         G: Tensor of shape (rank, n)
         H: Tensor of shape (rank, n)
         x: Tensor of shape (batch_size, n)
         cycle: whether to use f = (1, -1) or f = (0, 0)
+        precomputed: optional, output of toeplitz_mult_precompute(G, H, cycle)
+        max_chunk_numel: size of the intermediates of one chunk.
+            Defaults to toeplitz_max_chunk_numel, no limit unless it's set.
     Returns:
         product: Tensor of shape (batch_size, n)
     """
-    # f = (1,-1) if cycle else (1,1)
+    n = x.shape[-1]
+    G_f, H_f = precomputed if precomputed is not None else toeplitz_mult_precompute(G, H, cycle)
+    # The intermediate product stays in (at least) single precision
+    x_f = toeplitz_input_transform(x.to(compute_dtype(G, H, x)), cycle)
+    if max_chunk_numel is None:
+        max_chunk_numel = toeplitz_max_chunk_numel
+    batch_size, (rank, m) = x_f.shape[0], G_f.shape
+    if batch_size * rank * m <= max_chunk_numel:
+        w_f = toeplitz_intermediate_transform(x_f, H_f, n, cycle)
+        return toeplitz_output_transform((w_f * G_f).sum(dim=-2), n, cycle).to(x.dtype)
+    ranks = int(min(rank, max(1, max_chunk_numel // m)))
+    rows = int(min(batch_size, max(1, max_chunk_numel // (ranks * m))))
+    out_f = []
+    for start in range(0, batch_size, rows):
+        chunk_f = None
+        for r in range(0, rank, ranks):
+            w_f = toeplitz_intermediate_transform(x_f[start:start + rows], H_f[r:r + ranks], n, cycle)
+            wG_f = (w_f * G_f[r:r + ranks]).sum(dim=-2)
+            chunk_f = wG_f if chunk_f is None else chunk_f + wG_f
+        out_f.append(chunk_f)
+    return toeplitz_output_transform(torch.cat(out_f), n, cycle).to(x.dtype)
+
+
+def toeplitz_mult_channels(G, H, x, cycle=True, precomputed=None, max_chunk_numel=None):
+    """Multiply by a block matrix with in_channels x out_channels Toeplitz-like blocks:
+    out_j = \sum_i \sum_r Krylov(Z_f, G_ijr) @ Krylov(Z_f, H_ijr)^T @ x_i.
+    Each input channel is transformed once, and the sum over input channels and
+    rank is done in the frequency domain, so there is one inverse transform per
+    output channel at the end.
+    The (in_channel, out_channel) pairs are batched in chunks whose intermediate
+    products (chunk, batch_size, rank, n) have at most about max_chunk_numel
+    entries. On CPU, chunks that don't fit in cache are limited by memory
+    bandwidth, so by default they are kept small there; on GPU all pairs are
+    batched together.
+    Parameters:
+        G: Tensor of shape (in_channels, out_channels, rank, n)
+        H: Tensor of shape (in_channels, out_channels, rank, n)
+        x: Tensor of shape (in_channels, batch_size, n)
+        cycle: whether to use f = (1, -1) or f = (0, 0)
+        precomputed: optional, output of toeplitz_mult_precompute(G, H, cycle)
+        max_chunk_numel: size of the intermediates of one chunk of pairs.
+            Defaults to 2^18 on CPU and no limit on other devices.
+    Returns:
+        product: Tensor of shape (out_channels, batch_size, n)
+    """
+    in_channels, out_channels, rank, n = G.shape
+    batch_size = x.shape[1]
+    G_f, H_f = precomputed if precomputed is not None else toeplitz_mult_precompute(G, H, cycle)
+    G_f, H_f = G_f.flatten(0, 1), H_f.flatten(0, 1)
+    # Same transforms as in toeplitz_mult
+    x_f = toeplitz_input_transform(x.to(compute_dtype(G, H, x)), cycle)
+    if max_chunk_numel is None:
+        max_chunk_numel = 1 << 18 if x.device.type == 'cpu' else float('inf')
+    pairs = torch.arange(in_channels * out_channels, device=x.device)
+    in_index, out_index = pairs // out_channels, pairs % out_channels
+    chunk = int(min(len(pairs), max(1, max_chunk_numel // (batch_size * rank * x_f.shape[-1]))))
+    out_f = None
+    for start in range(0, len(pairs), chunk):
+        pair = slice(start, start + chunk)
+        w_f = toeplitz_intermediate_transform(x_f[in_index[pair]], H_f[pair, np.newaxis], n, cycle)
+        wG_f = (w_f * G_f[pair, np.newaxis]).sum(dim=2)
+        if out_f is None:
+            out_f = torch.zeros((out_channels, ) + wG_f.shape[1:], dtype=wG_f.dtype, device=wG_f.device)
+        out_f.index_add_(0, out_index[pair], wG_f)
+    return toeplitz_output_transform(out_f, n, cycle).to(x.dtype)
+
+
+def toeplitz_mult_groups(G, H, x, cycle=True, precomputed=None, sum_groups=False):
+    """Multiply by groups independent Toeplitz-like matrices:
+    out_g = \sum_r Krylov(Z_f, G_gr) @ Krylov(Z_f, H_gr)^T @ x_g,
+    or by all of them if x is shared by the groups. All the groups go through
+    the same transforms at once, and if sum_groups, \sum_g out_g is summed in
+    the frequency domain, so there is a single inverse transform at the end.
+    Parameters:
+        G: Tensor of shape (groups, rank, n)
+        H: Tensor of shape (groups, rank, n)
+        x: Tensor of shape (groups, batch_size, n), or (batch_size, n) shared by the groups
+        cycle: whether to use f = (1, -1) or f = (0, 0)
+        precomputed: optional, output of toeplitz_mult_precompute(G, H, cycle)
+        sum_groups: whether to return the sum of the outputs of the groups
+    Returns:
+        product: Tensor of shape (groups, batch_size, n), or (batch_size, n) if sum_groups
+    """
+    n = G.shape[-1]
+    G_f, H_f = precomputed if precomputed is not None else toeplitz_mult_precompute(G, H, cycle)
+    # Same transforms as in toeplitz_mult, with a leading dimension for the groups
+    x_f = toeplitz_input_transform(x.to(compute_dtype(G, H, x)), cycle)
+    w_f = toeplitz_intermediate_transform(x_f, H_f[:, np.newaxis], n, cycle)
+    out_f = (w_f * G_f[:, np.newaxis]).sum(dim=2)
+    if sum_groups:
+        out_f = out_f.sum(dim=0)
+    return toeplitz_output_transform(out_f, n, cycle).to(x.dtype)
+
+
+def toeplitz_mult_precompute(G, H, cycle=True):
+    """Compute the transforms of G and H used by toeplitz_mult, which only
+    depend on the parameters.
+    Parameters:
+        G: Tensor of shape (rank, n), (in_channels, out_channels, rank, n) or (groups, rank, n)
+        H: Tensor of shape (rank, n), (in_channels, out_channels, rank, n) or (groups, rank, n)
+        cycle: whether to use f = (1, -1) or f = (0, 0)
+    Returns:
+        precomputed: tuple (G_f, H_f)
+    """
     f = (1, -1) if cycle else (0, 0)
-    transpose_out = toeplitz_krylov_transpose_multiply(H, x, f[1])
-    return toeplitz_krylov_multiply(G, transpose_out, f[0])
+    return toeplitz_krylov_spectrum(G, f[0]), toeplitz_krylov_spectrum(H, f[1])
+
+
+##### Streaming the Toeplitz-like case
+
+def toeplitz_causal_filter(G, H):
+    """Coefficients of the last row of M = \sum_r Krylov(Z_0, G_r) @ Krylov(Z_0, H_r)^T.
+    On the sliding window of the last n samples of a stream, row n - 1 of M is
+    a causal FIR filter: out[t] = \sum_j a[j] x[t - n + 1 + j]. Row n - 1 of
+    Krylov(Z_0, g) is g reversed and Krylov(Z_0, h)^T is upper triangular, so a
+    is the linear convolution of the reversed G_r with H_r, truncated to n.
+    Parameters:
+        G: Tensor of shape (..., rank, n)
+        H: Tensor of shape (..., rank, n)
+    Returns:
+        a: Tensor of shape (..., n)
+    """
+    n = G.shape[-1]
+    dtype = compute_dtype(G, H)
+    a_f = (rfft(G.to(dtype).flip(-1), 2 * n) * rfft(H.to(dtype), 2 * n)).sum(dim=-2)
+    return irfft(a_f, 2 * n)[..., :n]
+
+
+class ToeplitzStream:
+    """Causal filtering of streams by a Toeplitz-like matrix M with f = (0, 0).
+    The output sample out[t] is the last entry of M @ x[t - n + 1 : t + 1], M
+    applied to the window of the last n input samples (zeros before the start
+    of the stream), see toeplitz_causal_filter.
+    Samples can be pushed one at a time or in chunks of any length. They are
+    filtered in blocks of block_size by uniformly partitioned overlap-save: the
+    filter is split into ceil(n / block_size) partitions whose spectra are
+    computed once, and each block costs one FFT and one inverse FFT of size
+    2 block_size, plus the products of the partitions with the spectra of the
+    last blocks. With the default block_size = n, that's O(log n) per sample.
+    The outputs of a block are returned once it's complete, so smaller blocks
+    lower the latency, for O(log block_size + n / block_size) per sample.
+    The parameters are copied (without gradients) at construction.
+    Parameters:
+        G: Tensor of shape (..., rank, n)
+        H: Tensor of shape (..., rank, n)
+        block_size: defaults to n
+        bias: optional scalar, or Tensor broadcastable with the outputs without the time dimension
+    """
+
+    def __init__(self, G, H, block_size=None, bias=None):
+        self.n = G.shape[-1]
+        self.block_size = self.n if block_size is None else block_size
+        self.partitions = -(-self.n // self.block_size)
+        self.dtype = compute_dtype(G, H)
+        with torch.no_grad():
+            # Impulse response c, out[t] = \sum_m c[m] x[t - m], split into the partitions
+            c = toeplitz_causal_filter(G, H).flip(-1)
+            c = F.pad(c, (0, self.partitions * self.block_size - self.n))
+            c = c.reshape(c.shape[:-1] + (self.partitions, self.block_size))
+            self.filter_f = rfft(c, 2 * self.block_size)
+            self.bias = bias.detach().to(self.dtype).unsqueeze(-1) if isinstance(bias, torch.Tensor) else bias
+        self.reset()
+
+    def reset(self):
+        """Restart the streams, with zeros before the next samples."""
+        # Buffer of the samples of the incomplete block and their number, the
+        # last complete block, and the spectra of the frames of the last partitions - 1 blocks
+        self.pending, self.count, self.previous, self.history = None, 0, None, None
+
+    def push(self, x):
+        """Append samples to the streams.
+        Parameters:
+            x: Tensor of shape (..., length), the next samples of each stream
+        Returns:
+            out: Tensor of shape (..., length'), the outputs of the blocks
+                completed by x (length' is a multiple of block_size)
+        """
+        B, P = self.block_size, self.partitions
+        x = x.to(self.dtype)
+        if self.pending is None:
+            batch_shape = torch.broadcast_shapes(x.shape[:-1], self.filter_f.shape[:-2])
+            self.pending = x.new_zeros(batch_shape + (B, ))
+            self.previous = x.new_zeros(batch_shape + (B, ))
+            self.history = self.filter_f.new_zeros(batch_shape + (P - 1, B + 1))
+        count, length = self.count, x.shape[-1]
+        k = (count + length) // B
+        if k == 0:
+            # Only fill the buffer, so that a sample costs O(1) until the block is complete
+            self.pending[..., count:count + length] = x
+            self.count += length
+            return self.pending[..., :0].clone()
+        x = x.expand(self.pending.shape[:-1] + (length, ))
+        blocks = torch.cat((self.pending[..., :count], x[..., :k * B - count]), dim=-1)
+        self.count = count + length - k * B
+        self.pending[..., :self.count] = x[..., length - self.count:]
+        # Overlap-save frames: each block preceded by the previous one
+        frames = torch.cat((self.previous, blocks), dim=-1).unfold(-1, 2 * B, B)
+        self.previous = blocks[..., -B:]
+        spectra = torch.cat((self.history, rfft(frames)), dim=-2)
+        # The frame of block i is multiplied by partition p of the filter for the output of block i + p
+        out_f = sum(self.filter_f[..., p:p + 1, :] * spectra[..., P - 1 - p:P - 1 - p + k, :] for p in range(P))
+        self.history = spectra[..., spectra.shape[-2] - (P - 1):, :]
+        out = irfft(out_f, 2 * B)[..., B:].reshape(blocks.shape)
+        return out + self.bias if self.bias is not None else out
+
+    __call__ = push
 
 
 ##### Slow multiplication for the Toeplitz-like case
@@ -190,6 +539,16 @@ def toeplitz_mult_slow_fast(G, H, x, cycle=True):
     return ((x @ K_H) @ K_G.transpose(1, 2)).sum(dim=0)
 
 
+##### Backends of the Toeplitz-like multiplies, see structure.backends
+
+for class_type, cycle in [('toeplitz', False), ('toeplitz_corner', True)]:
+    backends.register(class_type, 'fast', lambda G, H, x, cycle=cycle: toeplitz_mult(G, H, x, cycle))
+    backends.register(class_type, 'slow', lambda G, H, x, cycle=cycle: toeplitz_mult_slow(G, H, x, cycle),
+                      max_n=slow_max_n)
+    backends.register(class_type, 'slow_fast', lambda G, H, x, cycle=cycle: toeplitz_mult_slow_fast(G, H, x, cycle),
+                      max_n=slow_max_n)
+
+
 def test_toeplitz_mult():
     v = torch.tensor([[0,1,0,-1],[0,1,2,3]], dtype=torch.float, device=device, requires_grad=True)
     u = torch.tensor([[1,1,1,1],[0,1,2,3]], dtype=torch.float, device=device, requires_grad=True)
@@ -235,6 +594,110 @@ def test_toeplitz_mult():
     print((result - result_slow_fast).abs().mean().item())
     print((grad - grad_slow_fast).abs().max().item())
     print((grad - grad_slow_fast).abs().mean().item())
+    # Precomputing the transforms of G and H shouldn't change the result
+    for cycle in [True, False]:
+        result = toeplitz_mult(v, v, u, cycle)
+        result_precomputed = toeplitz_mult(v, v, u, cycle, toeplitz_mult_precompute(v, v, cycle))
+        print((result - result_precomputed).abs().max().item())
+        # Neither should chunking the rows and the rank (these relative differences should be small)
+        result = toeplitz_mult(v, v, u, cycle, max_chunk_numel=float('inf'))
+        grad, = torch.autograd.grad(result.sum(), v)
+        for max_chunk_numel in [3 * rank * n, 5 * n]:
+            result_chunked = toeplitz_mult(v, v, u, cycle, max_chunk_numel=max_chunk_numel)
+            grad_chunked, = torch.autograd.grad(result_chunked.sum(), v)
+            print(((result - result_chunked).abs().max() / result.abs().max()).item(),
+                  ((grad - grad_chunked).abs().max() / grad.abs().max()).item())
+
+
+def test_cycle_transform():
+    # The real transforms of f = 1 and f = -1 should give the same products as the complex transforms with eta
+    n, rank, batch_size = 64, 2, 5
+    v = torch.randn(rank, n, dtype=torch.double, device=device)
+    u = torch.randn(batch_size, n, dtype=torch.double, device=device)
+    for f in [1.0, -1.0]:
+        eta, eta_inverse = toeplitz_roots(n, f, torch.double, device)
+        slow = (eta_inverse * ifft(fft(eta * v) * fft(eta * u[:, np.newaxis]))).real
+        slow_transpose = (eta * fft(ifft(eta_inverse * u[:, np.newaxis]) * fft(eta * v))).real
+        fast = cycle_inverse(cycle_transform(v, f) * cycle_transform(u[:, np.newaxis], f), f, n)
+        fast_transpose = cycle_inverse(cycle_transform(u[:, np.newaxis], f, True) * cycle_transform(v, f), f, n, True)
+        # These max differences should be small
+        print((fast - slow).abs().max().item(), (fast_transpose - slow_transpose).abs().max().item(),
+              (negacyclic_ifft(negacyclic_fft(u)) - u).abs().max().item())
+
+
+def test_toeplitz_mult_channels():
+    in_channels, out_channels, rank, n, batch_size = 3, 2, 2, 64, 10
+    G = torch.randn(in_channels, out_channels, rank, n, dtype=torch.double, device=device, requires_grad=True)
+    H = torch.randn(in_channels, out_channels, rank, n, dtype=torch.double, device=device, requires_grad=True)
+    x = torch.randn(in_channels, batch_size, n, dtype=torch.double, device=device, requires_grad=True)
+    for cycle in [True, False]:
+        for max_chunk_numel in [1, None]:
+            result = toeplitz_mult_channels(G, H, x, cycle, max_chunk_numel=max_chunk_numel)
+            result_loop = torch.stack([sum(toeplitz_mult(G[i, j], H[i, j], x[i], cycle) for i in range(in_channels))
+                                       for j in range(out_channels)])
+            grad = torch.autograd.grad(result.sum(), (G, H, x))
+            grad_loop = torch.autograd.grad(result_loop.sum(), (G, H, x))
+            # These max differences should be small
+            print((result - result_loop).abs().max().item())
+            print(max((g - g_loop).abs().max().item() for g, g_loop in zip(grad, grad_loop)))
+
+
+def test_toeplitz_mult_groups():
+    groups, rank, n, batch_size = 3, 2, 64, 10
+    G = torch.randn(groups, rank, n, dtype=torch.double, device=device, requires_grad=True)
+    H = torch.randn(groups, rank, n, dtype=torch.double, device=device, requires_grad=True)
+    x = torch.randn(groups, batch_size, n, dtype=torch.double, device=device, requires_grad=True)
+    for cycle in [True, False]:
+        for x_ in [x, x[0]]:
+            x_loop = x_ if x_.dim() == 3 else x_.expand(groups, -1, -1)
+            result_loop = torch.stack([toeplitz_mult(G[g], H[g], x_loop[g], cycle) for g in range(groups)])
+            # These max differences should be small
+            print((toeplitz_mult_groups(G, H, x_, cycle) - result_loop).abs().max().item())
+            print((toeplitz_mult_groups(G, H, x_, cycle, sum_groups=True) - result_loop.sum(dim=0)).abs().max().item())
+
+
+def test_toeplitz_stream():
+    rank, n, batch_size, length = 2, 64, 3, 300
+    G = torch.randn(rank, n, dtype=torch.double, device=device)
+    H = torch.randn(rank, n, dtype=torch.double, device=device)
+    x = torch.randn(batch_size, length, dtype=torch.double, device=device)
+    # Reference: the last output of toeplitz_mult on the window of the last n samples
+    windows = F.pad(x, (n - 1, 0)).unfold(-1, n, 1)
+    result = toeplitz_mult(G, H, windows.reshape(-1, n), cycle=False)[:, -1].reshape(batch_size, length)
+    for block_size in [None, 16, 7]:
+        stream = ToeplitzStream(G, H, block_size)
+        # Chunks of irregular lengths, down to single samples
+        chunks, start = [], 0
+        for size in [1, 1, 5, 40, 100, 3, 150]:
+            chunks.append(stream(x[:, start:start + size]))
+            start += size
+        out = torch.cat(chunks, dim=-1)
+        # This max difference should be small
+        print(block_size, out.shape[-1], (out - result[:, :out.shape[-1]]).abs().max().item())
+
+def toeplitz_mult_benchmark(n=1 << 16, batch_size=16, rank=4, repeat=10):
+    """Time the default (unchunked) path of toeplitz_mult against explicit chunking."""
+    import time
+    G, H = torch.randn(rank, n, device=device), torch.randn(rank, n, device=device)
+    x = torch.randn(batch_size, n, device=device)
+    for cycle in [True, False]:
+        times = {}
+        for name, max_chunk_numel in [('default', None), ('unchunked', float('inf')),
+                                      ('chunked', rank * n)]:
+            toeplitz_mult(G, H, x, cycle, max_chunk_numel=max_chunk_numel)
+            elapsed = []
+            for _ in range(repeat):
+                if x.is_cuda:
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                toeplitz_mult(G, H, x, cycle, max_chunk_numel=max_chunk_numel)
+                if x.is_cuda:
+                    torch.cuda.synchronize()
+                elapsed.append(time.perf_counter() - start)
+            times[name] = min(elapsed)
+            print(f'cycle={cycle} {name}: {times[name] * 1e3:.3f}ms')
+        # The default must not pay for chunking
+        assert times['default'] <= 1.25 * times['unchunked'] + 1e-3, times
 
 
 def test_memory():
@@ -250,4 +713,8 @@ def test_memory():
 # TODO: move test into subpackage
 if __name__ == '__main__':
     test_toeplitz_mult()
+    test_cycle_transform()
+    test_toeplitz_mult_channels()
+    test_toeplitz_mult_groups()
+    test_toeplitz_stream()
     # test_memory()
@@ -0,0 +1,99 @@
+'''Functions to multiply by Vandermonde matrices V[j, k] = d_j^k, the Krylov
+matrices of the diagonal operator D = diag(d) used by the Vandermonde-like layers.
+
+Multiplying by V evaluates polynomials at the nodes d_j, and by V^T computes
+power sums. The fast multipoint evaluation by a subproduct tree is
+O(n log^2 n), but the polynomials of the tree have coefficients that grow
+exponentially with n: with nodes in (-0.7, 0.7) it's already inaccurate in
+double precision at n = 512, and meaningless at n = 1024.
+Instead, the powers are truncated. When |d_j| <= rho < 1, the terms d_j^k with
+k >= K = log(eps (1 - rho)) / log(rho) are below the precision eps, even summed
+over k, so only the first K columns of V are materialized (K is about 50 in
+single precision for rho = 0.7, whatever the size n). The multiplies are then
+matmuls of size K n per row, and V is shared by all the generators. When
+max |d_j| >= 1, all the n columns are needed, and the multiplies fall back to
+O(n^2) per row (with a warning).
+Finding K reads max |d_j| on the host, so callers computing the powers often
+(e.g. the layers) should cache it for the current values of the nodes.
+'''
+import warnings
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+
+def vandermonde_size(diag, n, dtype=None):
+    """Number of powers of the nodes diag above the precision of dtype (defaults to that of diag).
+    It's n, i.e. no truncation, if some node has |d_j| >= 1.
+    This synchronizes with the device of diag.
+    """
+    eps = torch.finfo(diag.dtype if dtype is None else dtype).eps
+    rho = diag.detach().abs().max().item()
+    if rho >= 1.0:
+        warnings.warn(f'Vandermonde nodes with |d| = {rho:.3g} >= 1: all the {n} powers are needed, '
+                      'so the multiplies are O(n^2) per row')
+        return n
+    if rho == 0.0:
+        return 1
+    return int(min(n, max(1, np.ceil(np.log(eps * (1 - rho)) / np.log(rho)))))
+
+
+def vandermonde_powers(diag, n, K=None):
+    """Compute the first columns of the Vandermonde matrices of the nodes diag.
+    Parameters:
+        diag: Tensor of shape (..., m)
+        n: number of columns of the full matrices
+        K: number of columns to compute, defaults to vandermonde_size(diag, n)
+    Returns:
+        V: Tensor of shape (..., m, K), V[..., j, k] = diag[..., j]^k
+    """
+    if K is None:
+        K = vandermonde_size(diag, n)
+    V = diag.unsqueeze(-1) ** torch.arange(K, dtype=diag.dtype, device=diag.device)
+    # The powers of the small nodes underflow to subnormal numbers, which make
+    # the matmuls on CPU an order of magnitude slower. They are below the precision anyway.
+    return torch.where(V.abs() < torch.finfo(V.dtype).tiny, torch.zeros_like(V), V)
+
+
+def vandermonde_mult(V, w):
+    """Evaluate the polynomials with coefficients w at the nodes: out[..., j] = \sum_k w[..., k] d_j^k.
+    Parameters:
+        V: output of vandermonde_powers(diag, n), of shape (..., m, K)
+        w: Tensor of shape (..., batch_size, n)
+    Returns:
+        product: Tensor of shape (..., batch_size, m)
+    """
+    return w[..., :V.shape[-1]] @ V.transpose(-1, -2)
+
+
+def vandermonde_transpose_mult(V, c, n):
+    """Compute the power sums out[..., k] = \sum_j c[..., j] d_j^k for k < n.
+    Parameters:
+        V: output of vandermonde_powers(diag, n), of shape (..., m, K)
+        c: Tensor of shape (..., batch_size, m)
+    Returns:
+        product: Tensor of shape (..., batch_size, n)
+    """
+    return F.pad(c @ V, (0, n - V.shape[-1]))
+
+
+def test_vandermonde_mult():
+    n, batch_size = 1024, 10
+    for dtype in [torch.float, torch.double]:
+        for scale in [0.7, 0.99, 1.01]:
+            diag = (2 * torch.rand(n, dtype=torch.double, device=device) - 1) * scale
+            w = torch.randn(batch_size, n, dtype=torch.double, device=device)
+            V_full = diag.unsqueeze(-1) ** torch.arange(n, dtype=diag.dtype, device=device)
+            V = vandermonde_powers(diag.to(dtype), n)
+            # These max relative differences should be small, of the order of the precision of dtype
+            slow, fast = w @ V_full.t(), vandermonde_mult(V, w.to(dtype))
+            slow_t, fast_t = w @ V_full, vandermonde_transpose_mult(V, w.to(dtype), n)
+            print(dtype, scale, V.shape[-1], ((fast - slow).abs().max() / slow.abs().max()).item(),
+                  ((fast_t - slow_t).abs().max() / slow_t.abs().max()).item())
+
+
+if __name__ == '__main__':
+    test_vandermonde_mult()
@@ -14,7 +14,7 @@ import sys
 sys.path.insert(0,'../../pytorch/')
 
 import structure.toeplitz_cpu as toep
-import structure.scratch.krylovfast as subd
+import structure.krylov_cpu as subd
 plt.rcParams['font.family'] = 'serif'
 
 def test_unstructured(n,trials,reps):
@@ -51,7 +51,7 @@ v = np.random.normal(size={n})
 def test_sd(n,r,trials,reps):
     sd_setup_str = '''
 import numpy as np
-import structure.scratch.krylovfast as subd
+import structure.krylov_cpu as subd
 np.random.seed(0)
 G = np.random.normal(size=({r}, {n}))
 H = np.random.normal(size=({r}, {n}))